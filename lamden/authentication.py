@@ -14,6 +14,124 @@ CERT_DIR = 'cilsocks'
 DEFAULT_DIR = pathlib.Path.home() / CERT_DIR
 DEFAULT_DOMAIN = '*'
 
+log = get_logger('zmq.auth')
+
+# Governance membership only changes through writes to these keys
+MEMBER_KEYS = {'masternodes.S:members', 'delegates.S:members'}
+
+
+def curve_key(vk: str):
+    # Convert to bytes if hex string
+    bvk = bytes.fromhex(vk)
+
+    try:
+        pk = crypto_sign_ed25519_pk_to_curve25519(bvk)
+    # Error is thrown if the VK is not within the possibility space of the ED25519 algorithm
+    except RuntimeError:
+        log.error('ED25519 Cryptographic error. The key provided is not within the cryptographic key space.')
+        return None
+
+    return z85.encode(pk)
+
+
+class KeyRegistry:
+    # Curve public keys of every node we talk to, kept in memory. The key files are only written so they survive restarts.
+    def __init__(self, cert_dir):
+        self.cert_dir = pathlib.Path(cert_dir)
+        self.cert_dir.mkdir(parents=True, exist_ok=True)
+
+        # vk -> z85 encoded curve public key
+        self.keys = {}
+        self.allowed = set()
+
+        # Keys persisted by the last run. The curve key is derived from the vk in the file name.
+        for filename in self.cert_dir.glob('*.key'):
+            try:
+                key = curve_key(filename.stem)
+            except (ValueError, TypeError):
+                log.warning(f'Skipping {filename.name}. Its name is not a verifying key.')
+                continue
+
+            if key is not None:
+                self.keys[filename.stem] = key
+                self.allowed.add(key)
+
+    def filename(self, vk):
+        return self.cert_dir / f'{vk}.key'
+
+    def add(self, vk: str):
+        if vk in self.keys:
+            return self.keys[vk]
+
+        key = curve_key(vk)
+        if key is None:
+            return None
+
+        self.keys[vk] = key
+        self.allowed.add(key)
+
+        _write_key_file(self.filename(vk), banner=_cert_public_banner, public_key=key.decode('utf-8'))
+
+        return key
+
+    def remove(self, vk: str):
+        key = self.keys.pop(vk, None)
+        if key is None:
+            return
+
+        self.allowed.discard(key)
+
+        try:
+            self.filename(vk).unlink()
+        except FileNotFoundError:
+            pass
+
+    def replace(self, vks):
+        vks = set(vks)
+
+        for vk in list(self.keys.keys()):
+            if vk not in vks:
+                self.remove(vk)
+
+        for vk in vks:
+            self.add(vk)
+
+    def get(self, vk: str):
+        return self.keys.get(vk)
+
+    def flush(self):
+        self.keys.clear()
+        self.allowed.clear()
+
+        shutil.rmtree(str(self.cert_dir))
+        self.cert_dir.mkdir(parents=True, exist_ok=True)
+
+    # Credentials provider interface for the ZAP authenticator
+    def callback(self, domain, key):
+        return key in self.allowed
+
+
+def block_changes_members(block):
+    for subblock in block.get('subblocks') or []:
+        for tx in subblock['transactions']:
+            for delta in tx.get('state') or []:
+                if delta['key'] in MEMBER_KEYS:
+                    return True
+    return False
+
+
+registries = {}
+
+
+def get_key_registry(cert_dir=DEFAULT_DIR):
+    # One registry per directory, shared by the authenticator and the router send paths
+    cert_dir = str(cert_dir)
+
+    if cert_dir not in registries:
+        registries[cert_dir] = KeyRegistry(cert_dir)
+
+    return registries[cert_dir]
+
 
 class SocketAuthenticator:
     def __init__(self, client: ContractingClient, ctx: zmq.asyncio.Context, bootnodes: dict={},
@@ -23,7 +141,7 @@ class SocketAuthenticator:
         self.client = client
 
         self.cert_dir = pathlib.Path.home() / cert_dir
-        self.cert_dir.mkdir(parents=True, exist_ok=True)
+        self.keys = get_key_registry(self.cert_dir)
 
         self.ctx = ctx
 
@@ -36,6 +154,9 @@ class SocketAuthenticator:
 
         self.bootnodes = bootnodes
 
+        # Last applied governance members. None until the first refresh.
+        self.members = None
+
         # This should throw an exception if the socket already exist
         try:
             self.authenticator = AsyncioAuthenticator(context=self.ctx, loop=self.loop)
@@ -48,9 +169,13 @@ class SocketAuthenticator:
             for node in bootnodes.keys():
                 self.add_verifying_key(node)
 
-            self.authenticator.configure_curve(domain=self.domain, location=self.cert_dir)
+            self.configure()
+
+    def refresh_governance_sockets(self, block=None):
+        # Blocks that do not write the member lists cannot change who is allowed to connect
+        if block is not None and self.members is not None and not block_changes_members(block):
+            return self.members
 
-    def refresh_governance_sockets(self):
         masternode_list = self.client.get_var(
             contract='masternodes',
             variable='S',
@@ -63,35 +188,35 @@ class SocketAuthenticator:
             arguments=['members']
         )
 
-        self.flush_all_keys()
+        members = masternode_list + delegate_list
 
-        for mn in masternode_list:
-            self.add_verifying_key(mn)
+        if self.members is None:
+            # First refresh drops every key that is not a member, including bootnodes and keys from the last run
+            self.keys.replace(members)
+        else:
+            removed = set(self.members) - set(members)
+            added = set(members) - set(self.members)
 
-        for dl in delegate_list:
-            self.add_verifying_key(dl)
+            for vk in removed:
+                self.keys.remove(vk)
 
-        self.log.info(f'Refreshing keys for {len(masternode_list)} masters and {len(delegate_list)} delegates.')
+            for vk in added:
+                self.keys.add(vk)
 
-        self.authenticator.configure_curve(domain=self.domain, location=self.cert_dir)
+            if len(removed) + len(added) > 0:
+                self.log.info(f'Governance changed. {len(added)} keys added, {len(removed)} keys removed.')
 
-    def add_verifying_key(self, vk: str):
-        # Convert to bytes if hex string
-        bvk = bytes.fromhex(vk)
+        self.members = members
 
-        try:
-            pk = crypto_sign_ed25519_pk_to_curve25519(bvk)
-        # Error is thrown if the VK is not within the possibility space of the ED25519 algorithm
-        except RuntimeError:
-            self.log.error('ED25519 Cryptographic error. The key provided is not within the cryptographic key space.')
-            return
+        self.log.info(f'Refreshing keys for {len(masternode_list)} masters and {len(delegate_list)} delegates.')
+
+        return members
 
-        zvk = z85.encode(pk).decode('utf-8')
-        _write_key_file(self.cert_dir / f'{vk}.key', banner=_cert_public_banner, public_key=zvk)
+    def add_verifying_key(self, vk: str):
+        self.keys.add(vk)
 
     def flush_all_keys(self):
-        shutil.rmtree(str(self.cert_dir))
-        self.cert_dir.mkdir(parents=True, exist_ok=True)
+        self.keys.flush()
 
     def configure(self):
-        self.authenticator.configure_curve(domain=self.domain, location=self.cert_dir)
+        self.authenticator.configure_curve_callback(domain=self.domain, credentials_provider=self.keys)
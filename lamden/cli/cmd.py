@@ -1,9 +1,11 @@
 import argparse
 from lamden.cli.start import start_node, join_network
 # from lamden.cli.update import verify_access, verify_pkg, trigger, vote, check_ready_quorum
-from lamden.storage import BlockStorage
+from lamden.storage import BlockStorage, NonceStorage
 from contracting.client import ContractDriver, ContractingClient
 from lamden.contracts import sync
+from lamden import snapshot
+from lamden.journal import StateJournal
 
 
 def flush(args):
@@ -28,6 +30,67 @@ def flush(args):
         print('Invalid option. < blocks | state | all >')
 
 
+def indexes(args):
+    storages = [
+        BlockStorage(create_indexes=False),
+        NonceStorage(create_indexes=False),
+        StateJournal(create_indexes=False)
+    ]
+
+    if args.action == 'build':
+        # Unique indexes cannot be built over duplicates, which older nodes could store
+        found = {}
+        for s in storages:
+            found.update(s.count_duplicates())
+
+        if len(found) > 0:
+            print(f'Duplicate documents: {", ".join(f"{name} ({n})" for name, n in found.items())}.')
+            print('Remove them with "lamden indexes dedupe" before building the indexes.')
+            return
+
+        for s in storages:
+            s.build_indexes()
+        print('Indexes built.')
+    elif args.action == 'verify':
+        missing = []
+        for s in storages:
+            missing.extend(s.missing_indexes())
+
+        if len(missing) == 0:
+            print('All indexes present.')
+        else:
+            print(f'Missing indexes: {", ".join(missing)}')
+    elif args.action == 'dedupe':
+        removed = sum(s.remove_duplicates() for s in storages)
+        print(f'Removed {removed} duplicate documents. The oldest copy of each was kept.')
+    else:
+        print('Invalid option. < build | verify | dedupe >')
+
+
+def snapshots(args):
+    if args.action == 'export':
+        height, block_hash = snapshot.export_snapshot(args.path, driver=ContractDriver(), nonces=NonceStorage())
+        print(f'Exported block #{height} ({block_hash}) to {args.path}.')
+    elif args.action == 'import':
+        height, block_hash = snapshot.import_snapshot(args.path, driver=ContractDriver(), nonces=NonceStorage())
+        print(f'Imported block #{height} ({block_hash}). Start the node to catch up from #{height + 1}.')
+    elif args.action == 'verify':
+        header = snapshot.verify_snapshot(args.path)
+        print(f'Snapshot of block #{header["height"]} ({header["hash"]}) is valid.')
+    else:
+        print('Invalid option. < export | import | verify >')
+
+
+def rollback(args):
+    driver = ContractDriver()
+    journal = StateJournal()
+
+    if journal.rollback_to(args.height, driver=driver, nonces=NonceStorage(), blocks=BlockStorage()):
+        print(f'Rolled back to block #{args.height}.')
+    else:
+        print(f'Cannot roll back to block #{args.height}. Earliest journaled block is #{journal.earliest_height()}.')
+
+
 def setup_cilparser(parser):
     # create parser for update commands
     subparser = parser.add_subparsers(title='subcommands', description='Network update commands',
@@ -41,16 +104,32 @@ def setup_cilparser(parser):
     start_parser.add_argument('-wp', '--webserver_port', type=int, default=18080)
     start_parser.add_argument('-p', '--pid', type=int, default=-1)
     start_parser.add_argument('-b', '--bypass_catchup', type=bool, default=False)
+    start_parser.add_argument('-j', '--journal', type=bool, default=None)
+    start_parser.add_argument('-jb', '--journal_blocks', type=int, default=0)
+    start_parser.add_argument('-cn', '--compact_nbn', type=bool, default=False)
 
     flush_parser = subparser.add_parser('flush')
     flush_parser.add_argument('storage_type', type=str)
 
+    indexes_parser = subparser.add_parser('indexes')
+    indexes_parser.add_argument('action', type=str)
+
+    snapshot_parser = subparser.add_parser('snapshot')
+    snapshot_parser.add_argument('action', type=str)
+    snapshot_parser.add_argument('path', type=str)
+
+    rollback_parser = subparser.add_parser('rollback')
+    rollback_parser.add_argument('height', type=int)
+
     join_parser = subparser.add_parser('join')
     join_parser.add_argument('node_type', type=str)
     join_parser.add_argument('-k', '--key', type=str)
     join_parser.add_argument('-m', '--mn_seed', type=str)
     join_parser.add_argument('-mp', '--mn_seed_port', type=int, default=18080)
     join_parser.add_argument('-wp', '--webserver_port', type=int, default=18080)
+    join_parser.add_argument('-j', '--journal', type=bool, default=None)
+    join_parser.add_argument('-jb', '--journal_blocks', type=int, default=0)
+    join_parser.add_argument('-cn', '--compact_nbn', type=bool, default=False)
 
     sync_parser = subparser.add_parser('sync')
 
@@ -73,6 +152,15 @@ def main():
     elif args.command == 'flush':
         flush(args)
 
+    elif args.command == 'indexes':
+        indexes(args)
+
+    elif args.command == 'snapshot':
+        snapshots(args)
+
+    elif args.command == 'rollback':
+        rollback(args)
+
     elif args.command == 'join':
         join_network(args)
 
@@ -12,6 +12,8 @@ from pymongo import MongoClient
 from pymongo.errors import ServerSelectionTimeoutError
 
 from lamden.crypto.wallet import Wallet
+from lamden.storage import CachedNonceStorage
+from lamden.journal import StateJournal
 from lamden.nodes.masternode.masternode import Masternode
 from lamden.nodes.delegate.delegate import Delegate
 
@@ -103,6 +105,16 @@ def resolve_raw_constitution(text):
     return j
 
 
+def make_journal(args):
+    # Masternodes answer historical reads from the webserver, so they keep the state journal unless told not to
+    enabled = args.journal if args.journal is not None else args.node_type == 'masternode'
+    if not enabled:
+        return None
+
+    # 0 keeps the history of every block
+    return StateJournal(max_blocks=args.journal_blocks or None)
+
+
 def start_node(args):
     assert args.node_type == 'masternode' or args.node_type == 'delegate', \
         'Provide node type as "masternode" or "delegate"'
@@ -139,7 +151,10 @@ def start_node(args):
             constitution=const,
             webserver_port=args.webserver_port,
             bypass_catchup=args.bypass_catchup,
-            node_type=args.node_type
+            node_type=args.node_type,
+            nonces=CachedNonceStorage(),
+            journal=make_journal(args),
+            compact_nbn=args.compact_nbn
         )
     elif args.node_type == 'delegate':
         n = Delegate(
@@ -149,7 +164,9 @@ def start_node(args):
             bootnodes=bootnodes,
             constitution=const,
             bypass_catchup=args.bypass_catchup,
-            node_type=args.node_type
+            node_type=args.node_type,
+            nonces=CachedNonceStorage(),
+            journal=make_journal(args)
         )
 
     loop = asyncio.get_event_loop()
@@ -195,7 +212,10 @@ def join_network(args):
             webserver_port=args.webserver_port,
             bootnodes=bootnodes,
             seed=mn_seed,
-            node_type=args.node_type
+            node_type=args.node_type,
+            nonces=CachedNonceStorage(),
+            journal=make_journal(args),
+            compact_nbn=args.compact_nbn
         )
     elif args.node_type == 'delegate':
         start_mongo()
@@ -206,7 +226,9 @@ def join_network(args):
             constitution=const,
             bootnodes=bootnodes,
             seed=mn_seed,
-            node_type=args.node_type
+            node_type=args.node_type,
+            nonces=CachedNonceStorage(),
+            journal=make_journal(args)
         )
 
     loop = asyncio.get_event_loop()
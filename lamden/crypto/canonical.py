@@ -90,4 +90,47 @@ def block_from_subblocks(subblocks, previous_hash: str, block_num: int) -> dict:
         'subblocks': deserialized_subblocks
     }
 
-    return block
\ No newline at end of file
+    return block
+
+
+def compact_block(block: dict) -> dict:
+    # Everything in a block but the transactions. Delegates computed those themselves and fill them back in.
+    return {
+        'hash': block['hash'],
+        'number': block['number'],
+        'previous': block['previous'],
+        'compact': True,
+        'subblocks': [{
+            'input_hash': sb['input_hash'],
+            'merkle_root': sb['merkle_leaves'][0],
+            'subblock': sb['subblock'],
+            'signatures': sb['signatures']
+        } for sb in block['subblocks']]
+    }
+
+
+def block_from_compact(compact: dict, contenders: list):
+    # Rebuilds the full block from our own subblock contenders. Returns None if any of them is not the chosen result.
+    own = {sbc['subblock']: sbc for sbc in contenders}
+
+    subblocks = []
+    for sb in compact['subblocks']:
+        sbc = own.get(sb['subblock'])
+
+        if sbc is None or sbc['input_hash'] != sb['input_hash'] or sbc['merkle_tree']['leaves'][0] != sb['merkle_root']:
+            return None
+
+        subblocks.append({
+            'input_hash': sbc['input_hash'],
+            'transactions': sbc['transactions'],
+            'merkle_leaves': sbc['merkle_tree']['leaves'],
+            'subblock': sb['subblock'],
+            'signatures': sb['signatures']
+        })
+
+    block = block_from_subblocks(subblocks, previous_hash=compact['previous'], block_num=compact['number'])
+
+    if block['hash'] != compact['hash']:
+        return None
+
+    return block
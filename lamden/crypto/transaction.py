@@ -215,7 +215,7 @@ def build_transaction(wallet, contract: str, function: str, kwargs: dict, nonce:
 
 # Run through all tests
 def transaction_is_valid(transaction, expected_processor, client: ContractingClient, nonces: storage.NonceStorage, strict=True,
-                         tx_per_block=15, timeout=5):
+                         tx_per_block=15, timeout=5, verified=False):
     # Check basic formatting so we can access via __getitem__ notation without errors
     if not check_format(transaction, rules.TRANSACTION_RULES):
         return TransactionFormattingError
@@ -226,8 +226,9 @@ def transaction_is_valid(transaction, expected_processor, client: ContractingCli
     processor = transaction['payload']['processor']
     sender = transaction['payload']['sender']
 
-    # Checks if correct processor and if signature is valid
-    check_tx_formatting(transaction, expected_processor)
+    # Checks if correct processor and if signature is valid. Skipped if the caller already ran it.
+    if not verified:
+        check_tx_formatting(transaction, expected_processor)
 
     # Gets the expected nonces
     nonce, pending_nonce = get_nonces(sender, processor, nonces)
@@ -12,6 +12,18 @@ if DATA_DIR is None:
 MONGO_DIR = DATA_DIR + '/mongo'
 MONGO_LOG_PATH = MONGO_DIR + '/logs/mongo.log'
 
+# Shared client settings. Timeouts are in milliseconds, a socket timeout of 0 waits forever.
+MONGO_HOST = os.getenv('MONGO_HOST', 'localhost')
+MONGO_PORT = int(os.getenv('MONGO_PORT', 27017))
+MONGO_MAX_POOL_SIZE = int(os.getenv('MONGO_MAX_POOL_SIZE', 100))
+MONGO_MIN_POOL_SIZE = int(os.getenv('MONGO_MIN_POOL_SIZE', 0))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv('MONGO_CONNECT_TIMEOUT_MS', 20000))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv('MONGO_SERVER_SELECTION_TIMEOUT_MS', 30000))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv('MONGO_SOCKET_TIMEOUT_MS', 0))
+
+# Threads used to run blocking storage calls off the event loop
+STORAGE_THREADS = int(os.getenv('STORAGE_THREADS', 4))
+
 
 def config_mongo_dir():
     try:
@@ -77,3 +77,7 @@ PROOF_MESSAGE_RULES = {
     'ip': is_tcp_or_ipc_string
 }
 
+BLOCK_RANGE_RULES = {
+    'start': number_is_formatted,
+    'end': number_is_formatted
+}
@@ -0,0 +1,268 @@
+from contracting.db.driver import ContractDriver
+from contracting.db.encoder import encode, decode
+from pymongo import ASCENDING, DESCENDING, InsertOne
+
+import lamden
+from lamden import storage
+from lamden.logger.base import get_logger
+
+log = get_logger('Journal')
+
+# One document per key a block wrote, holding the value the key had before the block was applied
+WRITE_INDEXES = [
+    [('number', ASCENDING), ('key', ASCENDING)],
+    [('key', ASCENDING), ('number', ASCENDING)]
+]
+# One document per block, holding the block hash and the nonces it overwrote
+BLOCK_INDEXES = [
+    [('number', ASCENDING)]
+]
+
+
+class JournalException(Exception):
+    pass
+
+
+class JournalDriver:
+    # Wraps the raw state driver and remembers the value of every key before its first write while recording
+    def __init__(self, driver, journal=None):
+        self.driver = driver
+        self.journal = journal
+        self.previous = None
+
+    def start(self):
+        self.previous = {}
+
+    def stop(self):
+        previous = self.previous
+        self.previous = None
+        return previous
+
+    def record(self, key):
+        if self.previous is not None and key not in self.previous:
+            self.previous[key] = self.driver.get(key)
+
+    def set(self, key, value):
+        self.record(key)
+        self.driver.set(key, value)
+
+    def delete(self, key):
+        self.record(key)
+        self.driver.delete(key)
+
+    def get_at_height(self, key, height):
+        if self.journal is None:
+            raise JournalException('Historical reads require the state journal.')
+
+        return self.journal.get_at_height(key, height, self.driver)
+
+    def __getitem__(self, key):
+        return self.driver[key]
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        self.delete(key)
+
+    def __getattr__(self, item):
+        return getattr(self.driver, item)
+
+
+class StateJournal:
+    def __init__(self, port=None, config_path=lamden.__path__[0], db='lamden', writes_collection='journal',
+                 blocks_collection='journal_blocks', max_blocks=None, create_indexes=True, host=None):
+        self.config_path = config_path
+
+        self.client = storage.get_client(host=host, port=port)
+        self.db = self.client.get_database(db)
+
+        self.writes = self.db[writes_collection]
+        self.blocks = self.db[blocks_collection]
+
+        # Blocks kept for rollbacks and historical reads. None keeps every block.
+        self.max_blocks = max_blocks
+
+        self.nonces = {}
+
+        if create_indexes:
+            self.build_indexes()
+
+    def build_indexes(self):
+        storage.build_indexes(self.writes, WRITE_INDEXES)
+        storage.build_indexes(self.blocks, BLOCK_INDEXES)
+
+    def missing_indexes(self):
+        return storage.missing_indexes(self.writes, WRITE_INDEXES) + \
+               storage.missing_indexes(self.blocks, BLOCK_INDEXES)
+
+    def count_duplicates(self):
+        return {**storage.count_duplicates(self.writes, WRITE_INDEXES),
+                **storage.count_duplicates(self.blocks, BLOCK_INDEXES)}
+
+    def remove_duplicates(self):
+        return storage.remove_duplicates(self.writes, WRITE_INDEXES) + \
+               storage.remove_duplicates(self.blocks, BLOCK_INDEXES)
+
+    def attach(self, driver: ContractDriver):
+        if not isinstance(driver.driver, JournalDriver):
+            driver.driver = JournalDriver(driver.driver)
+
+        driver.driver.journal = self
+
+        return driver.driver
+
+    def begin_block(self, block, driver: ContractDriver, nonces: storage.NonceStorage):
+        self.attach(driver).start()
+
+        # Nonces live outside of the state driver, so their previous values are read from the block's txs up front
+        self.nonces = {}
+        for tx in storage.BlockStorage.get_txs_from_block(block):
+            if tx.get('state') is None or len(tx['state']) == 0:
+                continue
+
+            sender = tx['transaction']['payload']['sender']
+            processor = tx['transaction']['payload']['processor']
+
+            if (sender, processor) not in self.nonces:
+                self.nonces[(sender, processor)] = nonces.get_nonce(sender=sender, processor=processor)
+
+    def end_block(self, block, driver: ContractDriver):
+        if not isinstance(driver.driver, JournalDriver):
+            return
+
+        previous = driver.driver.stop()
+
+        # Nothing was recorded, the block was not applied
+        if previous is None:
+            return
+
+        number = block['number']
+
+        # Replaying a block overwrites its old entry
+        self.writes.delete_many({'number': number})
+        self.blocks.delete_many({'number': number})
+
+        if len(previous) > 0:
+            self.writes.bulk_write([
+                InsertOne({'number': number, 'key': key, 'value': encode(value)}) for key, value in previous.items()
+            ], ordered=False)
+
+        # The block document is written last. Its presence marks the block's journal as complete.
+        self.blocks.insert_one({
+            'number': number,
+            'hash': block['hash'],
+            'nonces': [[sender, processor, value] for (sender, processor), value in self.nonces.items()]
+        })
+
+        self.nonces = {}
+
+        if self.max_blocks is not None:
+            self.prune(number - self.max_blocks)
+
+    def prune(self, height):
+        self.blocks.delete_many({'number': {'$lte': height}})
+        self.writes.delete_many({'number': {'$lte': height}})
+
+    def earliest_height(self):
+        block = self.blocks.find_one({}, sort=[('number', ASCENDING)])
+        if block is None:
+            return None
+        return block['number']
+
+    def covers(self, height):
+        earliest = self.earliest_height()
+        return earliest is not None and earliest <= height + 1
+
+    def history_limit(self):
+        earliest = self.earliest_height()
+        if earliest is None:
+            return 'This node has no state history yet.'
+
+        # A block's entry holds the state before it, so the history starts one block earlier
+        limit = f'This node has state history from block #{earliest - 1}'
+
+        if self.max_blocks is not None:
+            return f'{limit} and keeps the last {self.max_blocks} blocks.'
+
+        return f'{limit}.'
+
+    def get_previous_value(self, key, height):
+        # The first block after the height that wrote the key holds the value the key had at the height
+        write = self.writes.find_one({'key': key, 'number': {'$gt': height}}, sort=[('number', ASCENDING)])
+
+        if write is None:
+            return False, None
+
+        return True, decode(write['value'])
+
+    def value_at_height(self, key, height, current, value):
+        # value is what the key holds at the current height
+        if height >= current:
+            return value
+
+        if height < 0 or not self.covers(height):
+            raise JournalException(f'State at block #{height} is not journaled. {self.history_limit()}')
+
+        found, previous = self.get_previous_value(key, height)
+
+        if found:
+            return previous
+
+        # Not written since the height, so the current value is the historical one
+        return value
+
+    def get_at_height(self, key, height, driver):
+        # Read the current value first. A block applied during the lookup is journaled and found by it.
+        current = driver.get(storage.BLOCK_NUM_HEIGHT) or 0
+        value = driver.get(key)
+
+        return self.value_at_height(key, height, current, value)
+
+    def can_rollback_to(self, height, current):
+        numbers = [b['number'] for b in self.blocks.find(
+            {'number': {'$gt': height, '$lte': current}}, {'number': True}
+        ).sort('number', DESCENDING)]
+
+        return numbers == list(range(current, height, -1))
+
+    def rollback_to(self, height, driver: ContractDriver, nonces: storage.NonceStorage, blocks=None):
+        current = storage.get_latest_block_height(driver)
+
+        if height >= current:
+            return False
+
+        if not self.can_rollback_to(height, current):
+            log.error(f'Journal does not cover blocks #{height + 1} to #{current}. Cannot roll back.')
+            return False
+
+        driver.clear_pending_state()
+
+        # Undo the newest block first so keys written by several blocks end up at their oldest previous value
+        for number in range(current, height, -1):
+            for write in self.writes.find({'number': number}):
+                value = decode(write['value'])
+
+                if value is None:
+                    driver.driver.delete(write['key'])
+                else:
+                    driver.driver.set(write['key'], value)
+
+            block = self.blocks.find_one({'number': number})
+            for sender, processor, value in block['nonces']:
+                nonces.set_nonce(sender=sender, processor=processor, value=value)
+
+            if blocks is not None:
+                blocks.delete_block(number)
+
+            log.info(f'Rolled back block #{number}.')
+
+        nonces.commit()
+
+        self.prune_after(height)
+
+        return True
+
+    def prune_after(self, height):
+        self.blocks.delete_many({'number': {'$gt': height}})
+        self.writes.delete_many({'number': {'$gt': height}})
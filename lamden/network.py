@@ -1,13 +1,13 @@
 import time
 import hashlib
 import asyncio
-import os
 import zmq.asyncio
 from contracting.db.encoder import encode
 
 from lamden.formatting import rules, primatives
 from lamden.crypto.wallet import Wallet, verify
-from lamden import router
+from lamden import router, authentication
+from lamden.router import BULK
 from lamden.logger.base import get_logger
 
 PROOF_EXPIRY = 15
@@ -18,6 +18,10 @@ JOIN_SERVICE = 'join'           # Unsecured
 IDENTITY_SERVICE = 'identity'   # Unsecured
 PEER_SERVICE = 'peers'
 
+# Seconds to wait before asking the bootnodes again. Doubles after every round that finds no new peers.
+DISCOVERY_BACKOFF = 0.5
+MAX_DISCOVERY_BACKOFF = 30
+
 
 def verify_proof(proof, pepper):
     # Proofs expire after a minute
@@ -89,8 +93,7 @@ class JoinProcessor(router.Processor):
 
         vk = msg.get('vk')
 
-        filename = str(router.DEFAULT_DIR / f'{vk}.key')
-        if not os.path.exists(filename):
+        if authentication.get_key_registry(router.DEFAULT_DIR).get(vk) is None:
             return
 
 
@@ -130,50 +133,89 @@ class Network:
         self.peer_processor = PeerProcessor(peers=self.peers)
         self.log = get_logger('Peers')
 
-        router.add_service(JOIN_SERVICE, self.join_processor)
-        router.add_service(IDENTITY_SERVICE, self.identity_processor)
-        router.add_service(PEER_SERVICE, self.peer_processor)
+        # Peer discovery is not time critical and the unsecured services are open to anyone, so they are kept off the
+        # consensus workers
+        router.add_service(JOIN_SERVICE, self.join_processor, priority=BULK)
+        router.add_service(IDENTITY_SERVICE, self.identity_processor, priority=BULK)
+        router.add_service(PEER_SERVICE, self.peer_processor, priority=BULK)
 
         self.join_msg = {
             'ip': ip_string,
             'vk': self.wallet.verifying_key
         }
 
+        # How long the last start took to find every peer, and in how many rounds
+        self.discovery_time = None
+        self.discovery_rounds = 0
+
     def update_peers(self, peers):
         for peer in peers['peers']:
             self.peers[peer['vk']] = peer['ip']
 
-    async def start(self, bootnodes: dict, vks: list):
+    async def verify_identity(self, vk, ip):
+        response = await router.secure_request(msg={}, service=IDENTITY_SERVICE, wallet=self.wallet, vk=vk, ip=ip,
+                                               ctx=self.ctx)
+
+        if response is None:
+            LOGGER.error(f'No response for identity proof for {ip}')
+            return False
+
+        return True
+
+    async def start(self, bootnodes: dict, vks: list, backoff=DISCOVERY_BACKOFF, max_backoff=MAX_DISCOVERY_BACKOFF):
+        started = time.time()
+        rounds = 0
+        delay = backoff
+
         # Join all bootnodes
         while not self.all_vks_found(vks):
+            # Back off between rounds that find nobody new so a partly offline network is not flooded with joins
+            if rounds > 0:
+                self.log.info(f'{len(self.peers)}/{len(vks)} peers found. Retrying in {delay}s.')
+                await asyncio.sleep(delay)
+
+            rounds += 1
 
             coroutines = [router.secure_request(msg=self.join_msg, service=JOIN_SERVICE, wallet=self.wallet,
                                                 ctx=self.ctx, ip=ip, vk=vk) for vk, ip, in bootnodes.items()]
 
             results = await asyncio.gather(*coroutines)
 
+            # Bootnodes mostly return the same peers. Each unknown peer is checked once per round.
+            candidates = {}
             for result in results:
-                if result is None or result == {'response': 'ok'}:
+                if not isinstance(result, dict) or result.get('peers') is None:
                     continue
 
                 self.log.info(result)
 
                 for peer in result['peers']:
+                    vk = peer.get('vk')
+                    ip = peer.get('ip')
 
-                    response = await router.secure_request(msg={}, service=IDENTITY_SERVICE, wallet=self.wallet,
-                                                           vk=peer.get('vk'),
-                                                           ip=peer.get('ip'), ctx=self.ctx)
-
-                    if response is None:
-                        LOGGER.error(f'No response for identity proof for {peer.get("ip")}')
+                    if vk is None or ip is None or self.peers.get(vk) is not None or vk in candidates:
                         continue
 
-                    if self.peers.get(peer['vk']) is None:
-                        self.peers[peer['vk']] = peer['ip']
-                        self.log.info(f'{peer["vk"]} -> {peer["ip"]}')
+                    candidates[vk] = ip
+
+            verified = await asyncio.gather(*[self.verify_identity(vk, ip) for vk, ip in candidates.items()])
+
+            found = 0
+            for (vk, ip), ok in zip(candidates.items(), verified):
+                if ok:
+                    self.peers[vk] = ip
+                    self.log.info(f'{vk} -> {ip}')
+                    found += 1
+
+            delay = backoff if found > 0 else min(delay * 2, max_backoff)
 
             self.log.info(f'{len(self.peers)}/{len(vks)} peers found.')
-        self.log.info(f'All peers found. Continuing startup process.')
+
+        self.discovery_time = time.time() - started
+        self.discovery_rounds = rounds
+
+        self.log.info(f'All peers found in {self.discovery_time:.2f}s over {rounds} rounds. '
+                      f'Continuing startup process.')
 
     def all_vks_found(self, vks):
         for vk in vks:
@@ -1,13 +1,16 @@
-from lamden import storage, network, router, authentication, rewards, upgrade
+from lamden import storage, network, router, authentication, rewards, upgrade, wire
 from lamden.crypto import canonical
 from lamden.crypto.wallet import Wallet
 from lamden.contracts import sync
+from lamden.nodes import events
 from contracting.db.driver import ContractDriver, encode
 import lamden
 import zmq.asyncio
 import asyncio
 import json
+from collections import deque
 from contracting.client import ContractingClient
+from pymongo.errors import OperationFailure
 import uvloop
 asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 import gc
@@ -20,8 +23,11 @@ WORK_SERVICE = 'work'
 CONTENDER_SERVICE = 'contenders'
 
 GET_BLOCK = 'get_block'
+GET_BLOCKS = 'get_blocks'
 GET_HEIGHT = 'get_height'
 
+MAX_BLOCKS_PER_REQUEST = 50
+
 
 async def get_latest_block_height(wallet: Wallet, vk: str, ip: str, ctx: zmq.asyncio.Context):
     msg = {
@@ -54,23 +60,52 @@ async def get_block(block_num: int, wallet: Wallet, vk: str, ip: str, ctx: zmq.a
         service=BLOCK_SERVICE,
         msg=msg,
         ctx=ctx,
+        reply_codec=wire.STREAMED
     )
 
     return response
 
 
+async def get_blocks(start: int, end: int, wallet: Wallet, vk: str, ip: str, ctx: zmq.asyncio.Context, timeout=5000):
+    msg = {
+        'name': GET_BLOCKS,
+        'arg': {
+            'start': start,
+            'end': end
+        }
+    }
+
+    response = await router.secure_request(
+        ip=ip,
+        vk=vk,
+        wallet=wallet,
+        service=BLOCK_SERVICE,
+        msg=msg,
+        ctx=ctx,
+        timeout=timeout,
+        reply_codec=wire.STREAMED
+    )
+
+    return response
+
+
+class CatchupException(Exception):
+    pass
+
+
 class NewBlock(router.Processor):
     def __init__(self, driver: ContractDriver):
         self.q = []
+        self.new_block = events.Signal()
         self.driver = driver
         self.log = get_logger('NBN')
 
     async def process_message(self, msg):
         self.q.append(msg)
+        self.new_block.notify()
 
     async def wait_for_next_nbn(self):
-        while len(self.q) <= 0:
-            await asyncio.sleep(0)
+        await events.wait_for(lambda: len(self.q) > 0, self.new_block)
 
         nbn = self.q.pop(0)
 
@@ -95,15 +130,22 @@ def ensure_in_constitution(verifying_key: str, constitution: dict):
 class Node:
     def __init__(self, socket_base, ctx: zmq.asyncio.Context, wallet, constitution: dict, bootnodes={}, blocks=storage.BlockStorage(),
                  driver=ContractDriver(), debug=True, store=False, seed=None, bypass_catchup=False, node_type=None,
-                 genesis_path=lamden.contracts.__path__[0], reward_manager=rewards.RewardManager(), nonces=storage.NonceStorage()):
+                 genesis_path=lamden.contracts.__path__[0], reward_manager=rewards.RewardManager(), nonces=storage.NonceStorage(),
+                 journal=None):
 
         self.driver = driver
         self.nonces = nonces
         self.store = store
 
+        # Optional undo journal of every key each block overwrites. Needed for rollback_to.
+        self.journal = journal
+        if self.journal is not None:
+            self.journal.attach(self.driver)
+
         self.seed = seed
 
         self.blocks = blocks
+        self.async_blocks = storage.AsyncBlockStorage(self.blocks)
 
         self.log = get_logger('Base')
         self.log.propagate = debug
@@ -136,6 +178,15 @@ class Node:
             secure=True
         )
 
+        # Long lived connections to the other governance nodes, reused for every consensus message
+        self.pool = router.ConnectionPool(
+            wallet=wallet,
+            ctx=self.ctx,
+            cert_dir=self.socket_authenticator.cert_dir,
+            binary_services=(NEW_BLOCK_SERVICE, WORK_SERVICE, CONTENDER_SERVICE, BLOCK_SERVICE),
+            stream_services=(NEW_BLOCK_SERVICE,)
+        )
+
         self.network = network.Network(
             wallet=wallet,
             ip_string=socket_base,
@@ -146,6 +197,9 @@ class Node:
         self.new_block_processor = NewBlock(driver=self.driver)
         self.router.add_service(NEW_BLOCK_SERVICE, self.new_block_processor)
 
+        # Notified whenever the node starts or stops, so waits end when the node is stopped
+        self.running_changed = events.Signal()
+
         self.running = False
         self.upgrade = False
 
@@ -166,7 +220,7 @@ class Node:
             root=self.genesis_path
         )
 
-    async def catchup(self, mn_seed, mn_vk):
+    async def catchup(self, mn_seed, mn_vk, seeds=None):
         # Get the current latest block stored and the latest block of the network
         self.log.info('Running catchup.')
         current = self.current_height
@@ -183,25 +237,100 @@ class Node:
             self.log.info('No need to catchup. Proceeding.')
             return
 
-        # Increment current by one. Don't count the genesis block.
-        if current == 0:
-            current = 1
-
-        # Find the missing blocks process them
-        for i in range(current, latest + 1):
-            block = await get_block(
-                block_num=i,
-                ip=mn_seed,
-                vk=mn_vk,
-                wallet=self.wallet,
-                ctx=self.ctx
-            )
-            self.process_new_block(block)
+        # Spread the range requests over every masternode we know, starting with the seed
+        if seeds is None:
+            seeds = {}
+
+        peers = [(mn_vk, mn_seed)] + [(vk, ip) for vk, ip in seeds.items() if vk != mn_vk]
+
+        # Fastest masternodes first. The first range, which blocks applying the rest, goes to the fastest one.
+        ranks = router.get_peer_health().rank([vk for vk, _ in peers])
+        peers.sort(key=lambda peer: ranks.index(peer[0]))
+
+        # Find the missing blocks process them. Don't count the genesis block.
+        await self.pipelined_catchup(start=current + 1, end=latest, peers=peers)
 
         # Process any blocks that were made while we were catching up
         while len(self.new_block_processor.q) > 0:
             block = self.new_block_processor.q.pop(0)
-            self.process_new_block(block)
+            await self.process_new_block(block)
+
+    async def request_blocks(self, start, end, peer):
+        vk, ip = peer
+
+        blocks = await get_blocks(start=start, end=end, wallet=self.wallet, vk=vk, ip=ip, ctx=self.ctx)
+
+        if type(blocks) == list:
+            return blocks
+
+        # The peer's block service is overloaded. The range is retried on another peer.
+        if blocks == router.BUSY:
+            return None
+
+        # Masternodes that predate range requests answer with the default OK message. Fall back to single blocks.
+        if type(blocks) == dict:
+            blocks = []
+            for i in range(start, end + 1):
+                block = await get_block(block_num=i, wallet=self.wallet, vk=vk, ip=ip, ctx=self.ctx)
+                if block is None or block.get('number') != i:
+                    break
+                blocks.append(block)
+            return blocks
+
+        return None
+
+    async def pipelined_catchup(self, start, end, peers, max_in_flight=4, max_attempts=3):
+        # Split the missing blocks into ranges the block service will answer in full
+        ranges = deque(
+            (s, min(s + MAX_BLOCKS_PER_REQUEST - 1, end)) for s in range(start, end + 1, MAX_BLOCKS_PER_REQUEST)
+        )
+
+        in_flight = deque()
+        attempts = 0
+        next_peer = 0
+
+        def request(r):
+            nonlocal next_peer
+
+            # Peers that keep failing are skipped until they have rested, unless every peer is failing
+            health = router.get_peer_health()
+            healthy = [peer for peer in peers if health.healthy(peer[0])] or peers
+
+            peer = healthy[next_peer % len(healthy)]
+            next_peer += 1
+
+            return r, asyncio.ensure_future(self.request_blocks(*r, peer=peer))
+
+        while len(ranges) > 0 or len(in_flight) > 0:
+            # Keep several ranges requested ahead of the one being applied
+            while len(ranges) > 0 and len(in_flight) < max_in_flight:
+                in_flight.append(request(ranges.popleft()))
+
+            (range_start, range_end), future = in_flight.popleft()
+            blocks = await future
+
+            # Failed ranges are retried on the next peer at the front of the pipeline so blocks stay in order
+            if blocks is None or len(blocks) == 0 or blocks[0].get('number') != range_start:
+                attempts += 1
+                if attempts > max_attempts * len(peers):
+                    for _, f in in_flight:
+                        f.cancel()
+                    raise CatchupException(f'Could not get blocks {range_start} to {range_end}.')
+
+                in_flight.appendleft(request((range_start, range_end)))
+                continue
+
+            attempts = 0
+
+            for block in blocks:
+                await self.process_new_block(block)
+
+            # Partial ranges are completed before moving on
+            last = blocks[-1]['number']
+            if last < range_end:
+                in_flight.appendleft(request((last + 1, range_end)))
+
+            self.log.info(f'Caught up to block #{last} of {end}.')
 
     def should_process(self, block):
         self.log.info(f'Processing block #{block["number"]}')
@@ -244,6 +373,9 @@ class Node:
         # Check if the block is valid
         if self.should_process(block):
             self.log.info('Storing new block.')
+            if self.journal is not None:
+                self.journal.begin_block(block=block, driver=self.driver, nonces=self.nonces)
+
             # Commit the state changes and nonces to the database
             storage.update_state_with_block(
                 block=block,
@@ -264,28 +396,72 @@ class Node:
 
         self.new_block_processor.clean(self.current_height)
 
-    def process_new_block(self, block):
-        # Update the state and refresh the sockets so new nodes can join
-        self.update_state(block)
-        self.socket_authenticator.refresh_governance_sockets()
-
-        # Store the block if it's a masternode
+    async def process_new_block(self, block):
+        # Store the block if it's a masternode. The write runs on the storage writer thread so the event loop keeps
+        # going. It lands before any state, nonce or journal write, so a failed write leaves the node at the previous
+        # block and the block can be processed again. Storing a block twice is harmless.
         if self.store:
             encoded_block = encode(block)
             encoded_block = json.loads(encoded_block)
 
-            self.blocks.store_block(encoded_block)
+            try:
+                await self.async_blocks.store_block(encoded_block)
+            except Exception:
+                self.log.error(f'Could not store block #{block["number"]}. Not applying it.')
+                raise
+
+        # Update the state and refresh the sockets so new nodes can join
+        self.update_state(block)
+        members = self.socket_authenticator.refresh_governance_sockets(block=block)
+        self.pool.refresh(vks=members)
 
         # Prepare for the next block by flushing out driver and notification state
         # self.new_block_processor.clean()
 
+        # Nonces are committed before the state so a crash in between only replays the block's nonce updates
+        self.nonces.commit()
+
         # Finally, check and initiate an upgrade if one needs to be done
         self.driver.commit()
         self.driver.clear_pending_state()
+
+        # The journal entry includes the rewards, which only reach the state driver on commit
+        if self.journal is not None:
+            self.journal.end_block(block=block, driver=self.driver)
+
         gc.collect() # Force memory cleanup every block
         #self.nonces.flush_pending()
 
+    def rollback_to(self, height):
+        if self.journal is None:
+            self.log.error('Rollback requires the state journal to be enabled.')
+            return False
+
+        blocks = self.blocks if self.store else None
+        rolled_back = self.journal.rollback_to(height=height, driver=self.driver, nonces=self.nonces, blocks=blocks)
+
+        self.current_height = storage.get_latest_block_height(self.driver)
+        self.current_hash = storage.get_latest_block_hash(self.driver)
+
+        # Rolled back blocks may have changed the members, so the keys are read again
+        members = self.socket_authenticator.refresh_governance_sockets()
+        self.pool.refresh(vks=members)
+
+        return rolled_back
+
+    def build_indexes(self):
+        # Not done by the storage constructors, which run as default arguments when this module is imported
+        storages = [self.nonces, self.blocks] if self.store else [self.nonces]
+
+        for s in storages:
+            try:
+                s.build_indexes()
+            except OperationFailure as e:
+                self.log.error(f'Could not build indexes: {e}. Run "lamden indexes dedupe" to remove duplicates.')
+
     async def start(self):
+        self.build_indexes()
+
         asyncio.ensure_future(self.router.serve())
 
         # Get the set of VKs we are looking for from the constitution argument
@@ -310,13 +486,23 @@ class Node:
                         masternode = k
                         masternode_ip = v
             else:
-                masternode = self.constitution['masternodes'][0]
+                # Discovery measured every peer it found, so the fastest masternode that answered is the seed
+                masternodes = [vk for vk in self.constitution['masternodes'] if vk in self.network.peers]
+                masternode = router.get_peer_health().fastest(masternodes) or self.constitution['masternodes'][0]
                 masternode_ip = self.network.peers[masternode]
 
             self.log.info(f'Masternode Seed VK: {masternode}')
 
-            # Use this IP to request any missed blocks
-            await self.catchup(mn_seed=masternode_ip, mn_vk=masternode)
+            # Use this IP to request any missed blocks. Other known masternodes share the load.
+            seeds = {vk: self.network.peers[vk] for vk in self.constitution['masternodes'] if vk in self.network.peers}
+
+            try:
+                await self.catchup(mn_seed=masternode_ip, mn_vk=masternode, seeds=seeds)
+            except CatchupException as e:
+                # A node that is behind the network cannot take part in consensus
+                self.log.error(f'{e} Stopping node.')
+                self.stop()
+                raise
 
         # Refresh the sockets to accept new nodes
         self.socket_authenticator.refresh_governance_sockets()
@@ -324,9 +510,19 @@ class Node:
         # Start running
         self.running = True
 
+    @property
+    def running(self):
+        return self._running
+
+    @running.setter
+    def running(self, running):
+        self._running = running
+        self.running_changed.notify()
+
     def stop(self):
         # Kill the router and throw the running flag to stop the loop
         self.router.stop()
+        self.pool.close()
         self.running = False
 
     def _get_member_peers(self, contract_name):
@@ -1,19 +1,19 @@
 from lamden.nodes.delegate import execution, work
 from lamden import router, network
-from lamden.nodes import base
+from lamden.nodes import base, events
 from lamden.logger.base import get_logger
 import asyncio
 import time
 from lamden.crypto.wallet import verify
 from contracting.execution.executor import Executor
-from lamden.crypto import transaction
+from lamden.crypto import transaction, canonical
 from contracting.client import ContractingClient
 from lamden import storage
 from collections import defaultdict
 WORK_SERVICE = 'work'
 
 
-class WorkProcessor(router.Processor):
+class WorkProcessor(router.CPUProcessor):
     def __init__(self, client: ContractingClient, nonces: storage.NonceStorage, debug=True, expired_batch=5,
                  tx_timeout=5):
         self.new_work = defaultdict(list)
@@ -28,7 +28,27 @@ class WorkProcessor(router.Processor):
         self.client = client
         self.nonces = nonces
 
-    async def process_message(self, msg):
+        self.new_batch = events.Signal()
+
+    def check(self, msg):
+        # Signatures only. Nonces and balances are read from state in apply.
+        if msg['sender'] not in self.masters:
+            return None
+
+        if not verify(vk=msg['sender'], msg=msg['input_hash'], signature=msg['signature']):
+            return None
+
+        bad_transactions = set()
+        for i, tx in enumerate(msg['transactions']):
+            try:
+                transaction.check_tx_formatting(tx, expected_processor=msg['sender'])
+            except transaction.TransactionException as e:
+                self.log.error(f'TX in batch has error: {type(e)}')
+                bad_transactions.add(i)
+
+        return bad_transactions
+
+    async def apply(self, msg, bad_transactions):
         self.log.info(f'Received work from {msg["sender"][:8]}')
         if msg['sender'] not in self.masters:
             self.log.error(f'TX Batch received from non-master {msg["sender"][:8]}')
@@ -42,18 +62,21 @@ class WorkProcessor(router.Processor):
             'sender': msg["sender"]
         }
 
-        if not verify(vk=msg['sender'], msg=msg['input_hash'], signature=msg['signature']):
+        if bad_transactions is None:
             self.log.error(f'Invalidly signed TX Batch received from master {msg["sender"][:8]}')
-            return self.new_work[msg['sender']].append(shim)
+            return self.add_work(shim)
 
         if int(time.time()) - msg['timestamp'] > self.expired_batch:
             self.log.error(f'Expired TX Batch received from master {msg["sender"][:8]}')
-            return self.new_work[msg['sender']].append(shim)
+            return self.add_work(shim)
 
         # Add padded!
         # Iterate and delete transactions from list that fail
         good_transactions = []
-        for tx in msg['transactions']:
+        for i, tx in enumerate(msg['transactions']):
+            if i in bad_transactions:
+                continue
+
             try:
                 transaction.transaction_is_valid(
                     transaction=tx,
@@ -61,7 +84,8 @@ class WorkProcessor(router.Processor):
                     client=self.client,
                     nonces=self.nonces,
                     strict=False,
-                    timeout=self.expired_batch + self.tx_timeout
+                    timeout=self.expired_batch + self.tx_timeout,
+                    verified=True
                 )
                 good_transactions.append(tx)
             except transaction.TransactionException as e:
@@ -70,19 +94,21 @@ class WorkProcessor(router.Processor):
         # Replace transactions with ones that do not pass.
         msg['transactions'] = good_transactions
 
-        self.new_work[msg['sender']].append(msg)
+        self.add_work(msg)
         self.log.info(f'{msg["sender"][:8]} has {len(self.new_work[msg["sender"]])} batches of work to do.')
 
+    def add_work(self, msg):
+        self.new_work[msg['sender']].append(msg)
+        self.new_batch.notify()
+
+    def has_work(self, masters):
+        return any(len(self.new_work[master]) > 0 for master in masters)
+
     async def gather_transaction_batches(self, masters: list, timeout=10):
         # Wait until the queue is filled before starting timeout
         self.masters = masters
 
-        ready = False
-        while not ready:
-            for master in masters:
-                if len(self.new_work[master]) > 0:
-                    ready = True
-            await asyncio.sleep(0)
+        await events.wait_for(lambda: self.has_work(masters), self.new_batch)
 
         # Now wait until the rest come in or the timeout is triggered
         next_work = []
@@ -91,7 +117,10 @@ class WorkProcessor(router.Processor):
             for master in masters:
                 if len(self.new_work[master]) > 0:
                     next_work.append(self.new_work[master].pop(0))
-            await asyncio.sleep(0)
+
+            if len(next_work) < len(masters):
+                await events.wait_for(lambda: self.has_work(masters), self.new_batch,
+                                      timeout=timeout - (time.time() - start))
 
         return next_work
 
@@ -201,6 +230,9 @@ class Delegate(base.Node):
 
         self.upgrade_manager.node_type = 'delegate'
 
+        # Our subblock contenders for the block being decided. Compact new block notifications are rebuilt from them.
+        self.results = []
+
         self.log = get_logger(f'Delegate {self.wallet.vk_pretty[4:12]}')
 
     async def start(self):
@@ -226,8 +258,12 @@ class Delegate(base.Node):
 
     async def update_sockets(self):
         mns = self.get_masternode_peers()
-        iterator = iter(mns.items())
-        vk, ip = next(iterator)
+
+        vk = router.get_peer_health().fastest(list(mns.keys()))
+        if vk is None:
+            return
+
+        ip = mns[vk]
 
         peers = await router.secure_request(
             msg={},
@@ -236,16 +272,47 @@ class Delegate(base.Node):
             wallet=self.wallet,
             ctx=self.ctx,
             vk=vk,
-            ip=ip
+            ip=ip,
+            pool=self.pool
         )
 
-        if peers is not None:
+        if isinstance(peers, dict) and peers.get('peers') is not None:
             self.network.update_peers(peers=peers)
 
+    async def fetch_block(self, number, block_hash):
+        mns = self.get_masternode_peers()
+
+        for vk in router.get_peer_health().rank(list(mns.keys())):
+            block = await base.get_block(block_num=number, wallet=self.wallet, vk=vk, ip=mns[vk], ctx=self.ctx)
+
+            if isinstance(block, dict) and block.get('hash') == block_hash:
+                return block
+
+        return None
+
+    async def expand_block(self, block):
+        if not block.get('compact'):
+            return block
+
+        full = canonical.block_from_compact(block, self.results)
+        if full is not None:
+            return full
+
+        self.log.error(f'Our results do not match block #{block["number"]}. Fetching the full block.')
+        full = await self.fetch_block(block['number'], block['hash'])
+
+        if full is None:
+            self.log.error(f'Could not fetch block #{block["number"]}.')
+
+        return full
+
     async def wait_for_new_block_confirmation(self):
         self.log.info('Waiting for block confirmation...')
         block = await self.new_block_processor.wait_for_next_nbn()
-        self.process_new_block(block)
+        block = await self.expand_block(block)
+
+        if block is not None:
+            await self.process_new_block(block)
 
         await self.update_sockets()
 
@@ -259,8 +326,9 @@ class Delegate(base.Node):
         self.log.info(f'{len(self.new_block_processor.q)} new block(s) to process before execution.')
 
         while len(self.new_block_processor.q) > 0:
-            block = self.new_block_processor.q.pop(0)
-            self.process_new_block(block)
+            block = await self.expand_block(self.new_block_processor.q.pop(0))
+            if block is not None:
+                await self.process_new_block(block)
 
         results = self.transaction_executor.execute_work(
             driver=self.driver,
@@ -271,13 +339,16 @@ class Delegate(base.Node):
             stamp_cost=self.client.get_var(contract='stamp_cost', variable='S', arguments=['value'])
         )
 
+        self.results = results
+
         await router.secure_multicast(
             msg=results,
             service=base.CONTENDER_SERVICE,
             cert_dir=self.socket_authenticator.cert_dir,
             wallet=self.wallet,
             peer_map=self.get_masternode_peers(),
-            ctx=self.ctx
+            ctx=self.ctx,
+            pool=self.pool
         )
 
         self.log.info(f'Work execution complete. Sending to masters.')
@@ -301,3 +372,4 @@ class Delegate(base.Node):
 
     def stop(self):
         self.router.stop()
+        self.pool.close()
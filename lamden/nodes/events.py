@@ -0,0 +1,43 @@
+import asyncio
+import time
+
+
+class Signal:
+    # Wakes the coroutines waiting on it. The data being waited for lives elsewhere and is checked by the waiters.
+    def __init__(self):
+        self.waiters = set()
+
+    def notify(self):
+        for future in self.waiters:
+            if not future.done():
+                future.set_result(True)
+
+        self.waiters.clear()
+
+
+async def wait_for(predicate, *signals, timeout=None):
+    # Returns True once predicate() is true, or False if the timeout in seconds passes first. The predicate is only
+    # checked again when one of the signals is notified, so every change that can make it true must notify one.
+    deadline = None if timeout is None else time.time() + timeout
+
+    while not predicate():
+        wait = None
+
+        if deadline is not None:
+            wait = deadline - time.time()
+            if wait <= 0:
+                return False
+
+        future = asyncio.get_event_loop().create_future()
+        for signal in signals:
+            signal.waiters.add(future)
+
+        try:
+            await asyncio.wait_for(future, wait)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            for signal in signals:
+                signal.waiters.discard(future)
+
+    return True
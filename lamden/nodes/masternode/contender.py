@@ -1,16 +1,41 @@
 from contracting.db.encoder import encode
-from collections import defaultdict
+from collections import defaultdict, deque
 from lamden import router
 from lamden.crypto.canonical import merklize, block_from_subblocks
 from lamden.crypto.wallet import verify
 from lamden.logger.base import get_logger
 from lamden import storage
-import asyncio
+from lamden.nodes import events
 import time
 
 log = get_logger('Contender')
 
-class SBCInbox(router.Processor):
+# How far behind the first contender of a block each delegate's contender arrived, over this many recent blocks
+RESPONSE_SAMPLES = 50
+# Delegates with fewer samples are waited on for the full timeout
+MIN_RESPONSE_SAMPLES = 5
+
+# Once the first contender is in, the others are waited on for this percentile of their delay times TIMEOUT_SLACK,
+# and for at least MIN_STRAGGLER_WAIT seconds
+RESPONSE_PERCENTILE = 0.95
+TIMEOUT_SLACK = 1.5
+MIN_STRAGGLER_WAIT = 0.5
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+
+def contender_key(msg):
+    # Contenders are for the block after the one they name as previous
+    try:
+        return msg[0].get('previous'), msg[0]['signer']
+    except (AttributeError, IndexError, KeyError, TypeError):
+        return None
+
+
+class SBCInbox(router.CPUProcessor):
     def __init__(self, expected_subblocks=4, debug=True):
         self.q = []
         self.expected_subblocks = expected_subblocks
@@ -19,20 +44,50 @@ class SBCInbox(router.Processor):
 
         self.block_q = []
 
-    async def process_message(self, msg):
+        self.new_sbc = events.Signal()
+
+        # When each delegate's first valid contender arrived, by the hash of the block the contender builds on
+        self.arrivals = defaultdict(dict)
+
+        # When contenders came in, until they are checked
+        self.receipts = {}
+
+    def received(self, msg):
+        key = contender_key(msg)
+        if key is not None:
+            self.receipts[key] = time.time()
+
+    def check(self, msg):
         # Ignore bad message types
         # Ignore if not enough subblocks
         # Make sure all the contenders are valid
         if len(msg) != self.expected_subblocks:
             self.log.error('Contender does not have enough subblocks!')
-            return
+            return False
 
         for i in range(len(msg)):
             if not self.sbc_is_valid(msg[i], i):
                 self.log.error('Contender is not valid!')
-                return
+                return False
+
+        return True
+
+    async def apply(self, msg, valid):
+        arrived = self.receipts.pop(contender_key(msg), time.time())
+
+        if valid:
+            previous, signer = contender_key(msg)
+            self.arrivals[previous].setdefault(signer, arrived)
 
             self.q.append(msg)
+            self.new_sbc.notify()
+
+    def forget_other_rounds(self, previous):
+        for key in [k for k in self.receipts if k[0] != previous]:
+            del self.receipts[key]
+
+        for key in [k for k in self.arrivals if k != previous]:
+            del self.arrivals[key]
 
     def sbc_is_valid(self, sbc, sb_idx=0):
         if sbc['subblock'] != sb_idx:
@@ -80,8 +135,7 @@ class SBCInbox(router.Processor):
 
     async def receive_sbc(self):
         self.log.debug('Receiving Subblock Contender...')
-        while len(self.q) <= 0:
-            await asyncio.sleep(0)
+        await events.wait_for(self.has_sbc, self.new_sbc)
 
         return self.q.pop(0)
 
@@ -276,7 +330,8 @@ class BlockContender:
 
 # Can probably move this into the masternode. Move the sbc inbox there and deprecate this class
 class Aggregator:
-    def __init__(self, driver, expected_subblocks=4, seconds_to_timeout=6, debug=True):
+    def __init__(self, driver, expected_subblocks=4, seconds_to_timeout=6, min_straggler_wait=MIN_STRAGGLER_WAIT,
+                 debug=True):
         self.expected_subblocks = expected_subblocks
         self.sbc_inbox = SBCInbox(
             expected_subblocks=self.expected_subblocks,
@@ -285,16 +340,53 @@ class Aggregator:
         self.driver = driver
 
         self.seconds_to_timeout = seconds_to_timeout
+        self.min_straggler_wait = min_straggler_wait
+
+        self.delays = defaultdict(lambda: deque(maxlen=RESPONSE_SAMPLES))
+        self.first = None
+
+        # Hash of the block the current round builds on
+        self.round = None
 
         self.log = get_logger('AGG')
         self.log.propagate = debug
 
-    async def gather_subblocks(self, total_contacts, current_height=0, current_hash='0' * 64, quorum_ratio=0.66, adequate_ratio=0.5, expected_subblocks=4):
+    def end_round(self):
+        # Contenders that came in after the block was decided count too, otherwise slow delegates would never be
+        # measured
+        arrivals = self.sbc_inbox.arrivals.pop(self.round, {})
+
+        if self.first is not None:
+            for vk, arrived in arrivals.items():
+                self.delays[vk].append(arrived - self.first)
+
+        self.first = None
+
+    def straggler_wait(self, delegates):
+        # Delays are measured from the first contender, so they do not grow with the size of the block like the total
+        # response time does
+        if delegates is None or len(delegates) == 0:
+            return self.seconds_to_timeout
+
+        if any(len(self.delays[vk]) < MIN_RESPONSE_SAMPLES for vk in delegates):
+            return self.seconds_to_timeout
+
+        slowest = max(percentile(self.delays[vk], RESPONSE_PERCENTILE) for vk in delegates)
+
+        return min(self.seconds_to_timeout, max(self.min_straggler_wait, slowest * TIMEOUT_SLACK))
+
+    async def gather_subblocks(self, total_contacts, current_height=0, current_hash='0' * 64, quorum_ratio=0.66,
+                               adequate_ratio=0.5, expected_subblocks=4, live=None):
+        # live lists the delegates expected to answer. Quorum is still counted against all total_contacts.
         self.sbc_inbox.expected_subblocks = expected_subblocks
 
         block = storage.get_latest_block_height(self.driver)
 
-        self.log.info(f'Expecting {expected_subblocks} subblocks from {total_contacts} delegates.')
+        expected = total_contacts
+        if live is not None and len(live) > 0:
+            expected = min(len(live), total_contacts)
+
+        self.log.info(f'Expecting {expected_subblocks} subblocks from {expected} of {total_contacts} delegates.')
 
         contenders = BlockContender(
             total_contacts=total_contacts,
@@ -303,24 +395,42 @@ class Aggregator:
             acceptable_consensus=adequate_ratio
         )
 
+        # Contenders for other blocks are late ones from rounds that are over. Their arrival times must not count.
+        self.round = current_hash
+        self.sbc_inbox.forget_other_rounds(current_hash)
+        self.first = None
+
         # Add timeout condition.
         started = time.time()
+        deadline = started + self.seconds_to_timeout
         last_log = started
-        while (not contenders.block_has_consensus() and contenders.responses < contenders.total_contacts) and \
-                time.time() - started < self.seconds_to_timeout:
+        while (not contenders.block_has_consensus() and contenders.responses < expected) and time.time() < deadline:
 
             if self.sbc_inbox.has_sbc():
                 sbcs = await self.sbc_inbox.receive_sbc() # Can probably make this raw sync code
+
+                if sbcs[0].get('previous') != current_hash:
+                    self.log.warning(f'Ignoring contender from {sbcs[0]["signer"][:8]}. It is for another block.')
+                    continue
+
                 self.log.info('Pop it in there.')
                 contenders.add_sbcs(sbcs)
 
+                if self.first is None:
+                    self.first = min(self.sbc_inbox.arrivals[current_hash].values(), default=time.time())
+                    deadline = min(deadline, self.first + self.straggler_wait(live))
+
+                continue
+
             if time.time() - last_log > 5:
                 self.log.error(f'Waiting for contenders for {int(time.time() - started)}s.')
                 last_log = time.time()
 
-            await asyncio.sleep(0)
+            # Sleep until a contender arrives, the timeout is up or it is time to log again
+            timeout = min(deadline - time.time(), 5 - (time.time() - last_log))
+            await events.wait_for(self.sbc_inbox.has_sbc, self.sbc_inbox.new_sbc, timeout=timeout)
 
-        if time.time() - started > self.seconds_to_timeout:
+        if time.time() >= deadline and not contenders.block_has_consensus():
             self.log.error(f'Block timeout. Too many delegates are offline! Kick out the non-responsive ones! {block}')
 
         self.log.info('Done aggregating new block.')
@@ -2,11 +2,12 @@ import asyncio
 import hashlib
 import time
 from lamden import router
+from lamden.crypto import canonical
 from lamden.crypto.wallet import Wallet
-from lamden.storage import BlockStorage, get_latest_block_height
+from lamden.storage import BlockStorage, AsyncBlockStorage, get_latest_block_height
 from lamden.nodes.masternode import contender, webserver
-from lamden.formatting import primatives
-from lamden.nodes import base
+from lamden.formatting import primatives, rules
+from lamden.nodes import base, events
 from contracting.db.driver import ContractDriver
 
 from lamden.logger.base import get_logger
@@ -17,33 +18,51 @@ BLOCK_SERVICE = 'service'
 
 
 class BlockService(router.Processor):
-    def __init__(self, blocks: BlockStorage=None, driver=ContractDriver()):
+    def __init__(self, blocks: BlockStorage=None, driver=ContractDriver(), async_blocks: AsyncBlockStorage=None):
         self.blocks = blocks
         self.driver = driver
 
+        # Share the node's facade when given so reads wait for its deferred block writes
+        self.async_blocks = async_blocks if async_blocks is not None else AsyncBlockStorage(self.blocks)
+
     async def process_message(self, msg):
         response = None
         mn_logger.debug('Got a msg')
         if primatives.dict_has_keys(msg, keys={'name', 'arg'}):
             if msg['name'] == base.GET_BLOCK:
-                response = self.get_block(msg)
+                response = await self.get_block(msg)
+            elif msg['name'] == base.GET_BLOCKS:
+                response = await self.get_blocks(msg)
             elif msg['name'] == base.GET_HEIGHT:
                 response = get_latest_block_height(self.driver)
 
         return response
 
-    def get_block(self, command):
+    async def get_block(self, command):
         num = command.get('arg')
         if not primatives.number_is_formatted(num):
             return None
 
-        block = self.blocks.get_block(num)
+        block = await self.async_blocks.get_block(num)
 
         if block is None:
             return None
 
         return block
 
+    async def get_blocks(self, command):
+        arg = command.get('arg')
+        if not primatives.is_dict(arg) or not primatives.check_format(arg, rules.BLOCK_RANGE_RULES):
+            return None
+
+        if arg['end'] < arg['start']:
+            return None
+
+        # Larger ranges are truncated. The requester continues from the last block it was sent.
+        end = min(arg['end'], arg['start'] + base.MAX_BLOCKS_PER_REQUEST - 1)
+
+        return await self.async_blocks.get_blocks(arg['start'], end)
+
 
 class TransactionBatcher:
     def __init__(self, wallet: Wallet, queue):
@@ -85,7 +104,7 @@ class TransactionBatcher:
 
 
 class Masternode(base.Node):
-    def __init__(self, webserver_port=8080, *args, **kwargs):
+    def __init__(self, webserver_port=8080, compact_nbn=False, *args, **kwargs):
         super().__init__(store=True, *args, **kwargs)
         # Services
         self.webserver_port = webserver_port
@@ -93,6 +112,9 @@ class Masternode(base.Node):
             contracting_client=self.client,
             driver=self.driver,
             blocks=self.blocks,
+            async_blocks=self.async_blocks,
+            nonces=self.nonces,
+            journal=self.journal,
             wallet=self.wallet,
             port=self.webserver_port
         )
@@ -108,11 +130,25 @@ class Masternode(base.Node):
 
         self.router.add_service(base.CONTENDER_SERVICE, self.aggregator.sbc_inbox)
 
+        # Delegates that stop answering heartbeats are not waited on for contenders
+        self.heartbeat = router.Heartbeat(
+            wallet=self.wallet,
+            ctx=self.ctx,
+            peers=self.get_delegate_peers,
+            pool=self.pool,
+            cert_dir=self.socket_authenticator.cert_dir
+        )
+
+        # Send delegates new blocks without their transactions. Every delegate has to understand compact blocks.
+        self.compact_nbn = compact_nbn
+
         # Network upgrade flag
         self.active_upgrade = False
 
     async def start(self):
-        self.router.add_service(base.BLOCK_SERVICE, BlockService(self.blocks, self.driver))
+        self.router.add_service(
+            base.BLOCK_SERVICE, BlockService(self.blocks, self.driver, self.async_blocks), priority=router.BULK
+        )
 
         await super().start()
 
@@ -126,6 +162,8 @@ class Masternode(base.Node):
         # Start the webserver to accept transactions
         await self.webserver.start()
 
+        self.heartbeat.start()
+
         self.log.info('Done starting...')
 
         # If we have no blocks in our database, we are starting a new network from scratch
@@ -144,11 +182,14 @@ class Masternode(base.Node):
         # If another masternode has transactions, it will send use a new block notification.
         # If we have transactions, we will do the opposite. This 'wakes' up the network.
         mn_logger.debug('Waiting for work or blocks...')
-        while len(self.tx_batcher.queue) <= 0 and len(self.new_block_processor.q) <= 0:
-            if not self.running:
-                return
+        await events.wait_for(
+            lambda: len(self.tx_batcher.queue) > 0 or len(self.new_block_processor.q) > 0 or not self.running,
+            self.webserver.new_tx, self.new_block_processor.new_block, self.running_changed
+        )
+
+        if not self.running:
+            return
 
-            await asyncio.sleep(0)
         mn_logger.debug('Work / blocks available. Continuing.')
 
     async def broadcast_new_blockchain_started(self):
@@ -165,7 +206,8 @@ class Masternode(base.Node):
                     **self.get_delegate_peers(),
                     **self.get_masternode_peers()
                 },
-                ctx=self.ctx
+                ctx=self.ctx,
+                pool=self.pool
             )
 
     async def new_blockchain_boot(self):
@@ -181,13 +223,16 @@ class Masternode(base.Node):
     async def wait_for_block(self):
         self.new_block_processor.clean(self.current_height)
 
-        while len(self.new_block_processor.q) <= 0:
-            if not self.running:
-                return
-            await asyncio.sleep(0)
+        await events.wait_for(
+            lambda: len(self.new_block_processor.q) > 0 or not self.running, self.new_block_processor.new_block,
+            self.running_changed
+        )
+
+        if not self.running:
+            return
 
         block = self.new_block_processor.q.pop(0)
-        self.process_new_block(block)
+        await self.process_new_block(block)
 
     async def join_quorum(self):
         # Catchup with NBNs until you have work, the join the quorum
@@ -201,13 +246,16 @@ class Masternode(base.Node):
         members = self.driver.get_var(contract='masternodes', variable='S', arguments=['members'], mark=False)
 
         if len(members) > 1:
-            while len(self.new_block_processor.q) <= 0:
-                if not self.running:
-                    return
-                await asyncio.sleep(0)
+            await events.wait_for(
+                lambda: len(self.new_block_processor.q) > 0 or not self.running, self.new_block_processor.new_block,
+                self.running_changed
+            )
+
+            if not self.running:
+                return
 
             block = self.new_block_processor.q.pop(0)
-            self.process_new_block(block)
+            await self.process_new_block(block)
             self.new_block_processor.clean(self.current_height)
 
         while self.running:
@@ -215,8 +263,14 @@ class Masternode(base.Node):
 
     async def send_work(self):
         # Hangs until upgrade is done
-        while self.upgrade_manager.upgrade:
-            await asyncio.sleep(0)
+        await events.wait_for(
+            lambda: not self.upgrade_manager.upgrade or not self.running, self.upgrade_manager.upgrade_changed,
+            self.running_changed
+        )
+
+        # Stopped before the upgrade finished
+        if self.upgrade_manager.upgrade:
+            return
 
         # Else, batch some more txs
         self.log.info(f'Sending {len(self.tx_batcher.queue)} transactions.')
@@ -228,15 +282,20 @@ class Masternode(base.Node):
             self.log.error('No one online!')
             return False
 
-        await router.secure_multicast(
+        sent = await router.secure_multicast(
             msg=tx_batch,
             service=base.WORK_SERVICE,
             cert_dir=self.socket_authenticator.cert_dir,
             wallet=self.wallet,
             peer_map=self.get_delegate_peers(),
-            ctx=self.ctx
+            ctx=self.ctx,
+            pool=self.pool
         )
 
+        failed = [vk for vk, ok in sent.items() if not ok]
+        if len(failed) > 0:
+            self.log.error(f'Could not send work to {len(failed)} of {len(sent)} delegates.')
+
     async def get_work_processed(self):
         await asyncio.sleep(1)
 
@@ -247,14 +306,17 @@ class Masternode(base.Node):
 
         self.log.info('=== ENTERING BUILD NEW BLOCK STATE ===')
 
+        delegates = self.get_delegate_peers()
+
         block = await self.aggregator.gather_subblocks(
-            total_contacts=len(self.get_delegate_peers()),
+            total_contacts=len(delegates),
+            live=self.heartbeat.live(delegates.keys()),
             expected_subblocks=len(masters),
             current_height=self.current_height,
             current_hash=self.current_hash
         )
 
-        self.process_new_block(block)
+        await self.process_new_block(block)
 
         self.new_block_processor.clean(self.current_height)
 
@@ -267,12 +329,13 @@ class Masternode(base.Node):
         block = await self.get_work_processed()
 
         await router.secure_multicast(
-            msg=block,
+            msg=canonical.compact_block(block) if self.compact_nbn else block,
             service=base.NEW_BLOCK_SERVICE,
             cert_dir=self.socket_authenticator.cert_dir,
             wallet=self.wallet,
             peer_map=self.get_delegate_peers(),
-            ctx=self.ctx
+            ctx=self.ctx,
+            pool=self.pool
         )
 
         await self.hang()
@@ -283,13 +346,16 @@ class Masternode(base.Node):
             cert_dir=self.socket_authenticator.cert_dir,
             wallet=self.wallet,
             peer_map=self.get_masternode_peers(),
-            ctx=self.ctx
+            ctx=self.ctx,
+            pool=self.pool
         )
 
-        self.aggregator.sbc_inbox.q.clear()
+        # Contenders already in for the next block stay queued. The aggregator skips any for older blocks.
+        self.aggregator.end_round()
 
     def stop(self):
         super().stop()
+        self.heartbeat.stop()
         self.router.socket.close()
         self.webserver.coroutine.result().close()
 
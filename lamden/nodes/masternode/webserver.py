@@ -7,6 +7,8 @@ from contracting.db.encoder import encode, decode
 from contracting.db.driver import ContractDriver
 from contracting.compilation import parser
 from lamden import storage
+from lamden.nodes import events
+from lamden.journal import JournalException
 from lamden.crypto.canonical import tx_hash_from_tx
 from lamden.crypto.transaction import TransactionException
 import decimal
@@ -29,11 +31,12 @@ class ByteEncoder(_json.JSONEncoder):
 
 
 class WebServer:
-    def __init__(self, contracting_client: ContractingClient, driver: ContractDriver, wallet, blocks, queue=[], port=8080, ssl_port=443, ssl_enabled=False,
+    def __init__(self, contracting_client: ContractingClient, driver: ContractDriver, wallet, blocks, queue=[], nonces=None, async_blocks=None, journal=None, port=8080, ssl_port=443, ssl_enabled=False,
                  ssl_cert_file='~/.ssh/server.csr',
                  ssl_key_file='~/.ssh/server.key',
                  workers=2, debug=True, access_log=False,
                  max_queue_len=10_000,
+                 max_blocks_per_request=100,
                  ):
 
         # Setup base Sanic class and CORS
@@ -48,15 +51,27 @@ class WebServer:
         # Initialize the backend data interfaces
         self.client = contracting_client
         self.driver = driver
-        self.nonces = storage.NonceStorage()
+        self.nonces = nonces if nonces is not None else storage.NonceStorage()
         self.blocks = blocks
 
+        # Database reads from the handlers run on the storage thread pool so they never stall the event loop
+        self.async_nonces = storage.AsyncNonceStorage(self.nonces)
+        self.async_blocks = async_blocks if async_blocks is not None else storage.AsyncBlockStorage(self.blocks)
+
+        # Historical variable reads are answered from the state journal when the node keeps one
+        self.journal = journal
+        self.async_journal = storage.AsyncStorage(self.journal) if self.journal is not None else None
+
         self.static_headers = {}
 
         self.wallet = wallet
         self.queue = queue
         self.max_queue_len = max_queue_len
 
+        # Wakes the masternode when it is waiting for transactions
+        self.new_tx = events.Signal()
+        self.max_blocks_per_request = max_blocks_per_request
+
         self.port = port
 
         self.ssl_port = ssl_port
@@ -78,6 +93,7 @@ class WebServer:
         self.app.add_route(self.ping, '/ping', methods=['GET', 'OPTIONS'])
         self.app.add_route(self.get_id, '/id', methods=['GET'])
         self.app.add_route(self.get_nonce, '/nonce/<vk>', methods=['GET'])
+        self.app.add_route(self.get_pool_stats, '/pool_stats', methods=['GET'])
 
         # State Routes
         self.app.add_route(self.get_methods, '/contracts/<contract>/methods', methods=['GET'])
@@ -95,6 +111,7 @@ class WebServer:
 
         # General Block Route
         self.app.add_route(self.get_block, '/blocks', methods=['GET'])
+        self.app.add_route(self.get_blocks, '/blocks/range', methods=['GET'])
 
         # TX Route
         self.app.add_route(self.get_tx, '/tx', methods=['GET'])
@@ -174,6 +191,7 @@ class WebServer:
 
         # Add TX to the processing queue
         self.queue.append(tx)
+        self.new_tx.notify()
 
         # Return the TX hash to the user so they can track it
         tx_hash = tx_hash_from_tx(tx)
@@ -191,9 +209,13 @@ class WebServer:
     async def get_id(self, request):
         return response.json({'verifying_key': self.wallet.verifying_key}, headers={'Access-Control-Allow-Origin': '*'})
 
+    # Connection pool usage of each MongoDB server this node talks to
+    async def get_pool_stats(self, request):
+        return response.json(storage.pool_stats(), headers={'Access-Control-Allow-Origin': '*'})
+
     # Get the Nonce of a VK
     async def get_nonce(self, request, vk):
-        latest_nonce = self.nonces.get_latest_nonce(sender=vk, processor=self.wallet.verifying_key)
+        latest_nonce = await self.async_nonces.get_latest_nonce(sender=vk, processor=self.wallet.verifying_key)
 
         return response.json({
             'nonce': latest_nonce,
@@ -247,6 +269,23 @@ class WebServer:
         k = self.client.raw_driver.make_key(contract=contract, variable=variable, args=key)
         value = self.client.raw_driver.get(k)
 
+        height = request.args.get('height')
+        if height is not None:
+            if self.journal is None:
+                return response.json({'error': 'Historical reads are not enabled on this node. It has to run with the state journal.'}, status=400, headers={'Access-Control-Allow-Origin': '*'})
+
+            try:
+                height = int(height)
+            except ValueError:
+                return response.json({'error': 'Height must be an integer.'}, status=400, headers={'Access-Control-Allow-Origin': '*'})
+
+            current = storage.get_latest_block_height(self.driver)
+
+            try:
+                value = await self.async_journal.run(self.journal.value_at_height, k, height, current, value)
+            except JournalException as e:
+                return response.json({'error': str(e)}, status=404, headers={'Access-Control-Allow-Origin': '*'})
+
         if value is None:
             return response.json({'value': None}, status=404, headers={'Access-Control-Allow-Origin': '*'})
         else:
@@ -271,7 +310,7 @@ class WebServer:
     #     return response.json({'values': values, 'next': values[-1]}, status=200)
 
     async def get_latest_block(self, request):
-        index = self.blocks.get_last_n(n=1, collection=storage.BlockStorage.BLOCK)
+        index = await self.async_blocks.get_last_n(n=1, collection=storage.BlockStorage.BLOCK)
         if len(index) == 0:
             block = {
                 'hash': (b'\x00' * 32).hex(),
@@ -295,9 +334,9 @@ class WebServer:
         _hash = request.args.get('hash')
 
         if num is not None:
-            block = self.blocks.get_block(int(num))
+            block = await self.async_blocks.get_block(int(num))
         elif _hash is not None:
-            block = self.blocks.get_block(_hash)
+            block = await self.async_blocks.get_block(_hash)
         else:
             return response.json({'error': 'No number or hash provided.'}, status=400, headers={'Access-Control-Allow-Origin': '*'})
 
@@ -306,13 +345,30 @@ class WebServer:
 
         return response.json(block, dumps=ByteEncoder().encode, headers={'Access-Control-Allow-Origin': '*'})
 
+    async def get_blocks(self, request):
+        try:
+            start = int(request.args.get('start'))
+            end = int(request.args.get('end', start + self.max_blocks_per_request - 1))
+        except (TypeError, ValueError):
+            return response.json({'error': 'No valid start or end provided.'}, status=400, headers={'Access-Control-Allow-Origin': '*'})
+
+        projection = request.args.get('projection', 'full')
+        if projection not in storage.BLOCK_PROJECTIONS:
+            return response.json({'error': 'Invalid projection.'}, status=400, headers={'Access-Control-Allow-Origin': '*'})
+
+        end = min(end, start + self.max_blocks_per_request - 1)
+
+        blocks = await self.async_blocks.get_blocks(start, end, projection=projection)
+
+        return response.json({'blocks': blocks}, dumps=ByteEncoder().encode, headers={'Access-Control-Allow-Origin': '*'})
+
     async def get_tx(self, request):
         _hash = request.args.get('hash')
 
         if _hash is not None:
             try:
                 int(_hash, 16)
-                tx = self.blocks.get_tx(_hash)
+                tx = await self.async_blocks.get_tx(_hash)
             except ValueError:
                 return response.json({'error': 'Malformed hash.'}, status=400, headers={'Access-Control-Allow-Origin': '*'})
         else:
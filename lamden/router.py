@@ -2,12 +2,14 @@ import asyncio
 from lamden.crypto.wallet import Wallet
 import zmq
 import zmq.asyncio
-from contracting.db.encoder import encode, decode
 from zmq.error import ZMQBaseError
-from zmq.auth.certs import load_certificate
 from lamden.logger.base import get_logger
+from lamden import authentication, wire
 import pathlib
-import os
+import time
+from collections import defaultdict
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
 CERT_DIR = 'cilsocks'
 DEFAULT_DIR = pathlib.Path.home() / CERT_DIR
 
@@ -17,19 +19,118 @@ OK = {
     'response': 'ok'
 }
 
+# Sent instead of a reply when the service's queue is full. Requesters treat it as a failed request.
+BUSY = {
+    'response': 'busy'
+}
+
+# Priority classes of services. Each class has its own queue and workers, so a flood of bulk requests such as
+# catchup cannot hold up consensus messages.
+CONSENSUS = 0
+BULK = 1
+
+# Threads that run the checks of CPU bound processors. Signature checks and hashing release the GIL.
+PROCESSOR_THREADS = 4
+
+# Inbox handler concurrency and how many messages each service can have waiting
+WORKERS = 16
+BULK_WORKERS = 4
+MAX_QUEUED = 256
+
+# Assumed round trip time in seconds of peers that have not answered a request yet
+UNKNOWN_RTT = 1
+
+# Every router answers heartbeats from the consensus queue, so a node busy serving catchup still shows as live
+HEARTBEAT_SERVICE = 'heartbeat'
+HEARTBEAT_INTERVAL = 5
+HEARTBEAT_TIMEOUT = 1000
+
+# Binary frames at least this large are compressed. Blocks and contenders compress well.
+COMPRESS_THRESHOLD = 4096
 
-def build_message(service, message):
-    return {
+
+def build_message(service, message, request_id=None, codec=None):
+    message = {
         'service': service,
         'msg': message
     }
 
+    # Pooled requests share a socket, so the reply is matched to its request by id
+    if request_id is not None:
+        message['id'] = request_id
+
+    # Codec the reply should use. Older routers ignore it and answer in JSON.
+    if codec is not None:
+        message['codec'] = codec
+
+    return message
+
+
+async def send_frames(socket, frames):
+    # Frames are sent one at a time, so a stream is made as it is sent. Non-blocking sends finish at once, so the
+    # parts of two messages are never interleaved. Only the first part can fail on a full queue.
+    frames = iter(frames)
+    frame = next(frames)
+
+    for next_frame in frames:
+        await socket.send(frame, flags=zmq.NOBLOCK | zmq.SNDMORE, copy=False)
+        frame = next_frame
+
+    await socket.send(frame, flags=zmq.NOBLOCK, copy=False)
+
+
+async def read_message(socket):
+    # Frames are decoded as they are read, so a stream is never held whole
+    frame = await socket.recv(copy=False)
+
+    try:
+        if not frame.more:
+            return wire.unpack(frame.buffer)
+
+        decoder = wire.StreamDecoder()
+        decoder.feed(frame.buffer)
+
+        while frame.more:
+            frame = await socket.recv(copy=False)
+            decoder.feed(frame.buffer)
+
+        return decoder.finish()
+    except wire.WireException:
+        # The rest of the message is dropped so the next read starts at a message of its own
+        while frame.more:
+            frame = await socket.recv(copy=False)
+        raise
+
 
 class Processor:
     async def process_message(self, msg):
         raise NotImplementedError
 
 
+class HeartbeatProcessor(Processor):
+    async def process_message(self, msg):
+        return OK
+
+
+class CPUProcessor(Processor):
+    # For processors that spend most of their time verifying signatures and hashes. The router runs check in a
+    # thread and hands its result to apply back on the event loop.
+    def received(self, msg):
+        # Runs on the event loop as soon as the router has queued the message, so nothing here may be slow
+        pass
+
+    def check(self, msg):
+        # Must not touch state that is changed on the event loop
+        raise NotImplementedError
+
+    async def apply(self, msg, result):
+        raise NotImplementedError
+
+    async def process_message(self, msg):
+        self.received(msg)
+        return await self.apply(msg, self.check(msg))
+
+
 class QueueProcessor(Processor):
     def __init__(self):
         self.q = []
@@ -52,7 +153,8 @@ a message to the requester.
 
 
 class AsyncInbox:
-    def __init__(self, socket_id, ctx: zmq.Context, wallet=None, linger=1000, poll_timeout=50):
+    def __init__(self, socket_id, ctx: zmq.Context, wallet=None, linger=1000, poll_timeout=50, workers=WORKERS,
+                 bulk_workers=BULK_WORKERS, max_queued=MAX_QUEUED):
         if socket_id.startswith('tcp'):
             _, _, port = socket_id.split(':')
             self.address = f'tcp://*:{port}'
@@ -68,6 +170,19 @@ class AsyncInbox:
         self.linger = linger
         self.poll_timeout = poll_timeout
 
+        # Messages are handled by a fixed number of workers. Each queue holds at most max_queued waiting messages.
+        self.workers = {
+            CONSENSUS: workers,
+            BULK: bulk_workers
+        }
+        self.max_queued = max_queued
+
+        self.queues = {}
+        self.queued = defaultdict(int)
+        self.shed_count = defaultdict(int)
+
+        self.receiving = None
+
         self.running = False
 
     async def serve(self):
@@ -75,37 +190,110 @@ class AsyncInbox:
 
         self.running = True
 
-        while self.running:
+        workers = []
+        for priority, count in self.workers.items():
+            self.queues[priority] = asyncio.Queue()
+            workers.extend(asyncio.ensure_future(self.work(self.queues[priority])) for _ in range(count))
+
+        try:
+            while self.running:
+                # Stopping the inbox cancels the pending receive
+                self.receiving = asyncio.ensure_future(self.receive_message())
+
+                try:
+                    _id, msg = await self.receiving
+                except asyncio.CancelledError:
+                    if self.running:
+                        self.receiving.cancel()
+                        raise
+                    break
+                except zmq.error.ZMQError:
+                    self.socket.close()
+                    self.setup_socket()
+                    continue
+
+                await self.dispatch(_id, msg)
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+            self.receiving = None
+            self.socket.close()
+
+    def queue_key(self, msg):
+        return None
+
+    def priority(self, key):
+        return CONSENSUS
+
+    async def dispatch(self, _id, msg):
+        key = self.queue_key(msg)
+
+        if self.queued[key] >= self.max_queued:
+            self.shed_count[key] += 1
+
+            # Logged on the first drop and then every hundredth so a flood does not flood the log as well
+            if self.shed_count[key] % 100 == 1:
+                logger.warning(f'{key} queue is full. Shed {self.shed_count[key]} messages so far.')
+
+            await self.shed(_id, msg)
+            return
+
+        self.queued[key] += 1
+        self.queues[self.priority(key)].put_nowait((key, _id, msg))
+
+        self.enqueued(key, msg)
+
+    def enqueued(self, key, msg):
+        pass
+
+    async def work(self, queue):
+        while True:
+            key, _id, msg = await queue.get()
+
             try:
-                event = await self.socket.poll(timeout=self.poll_timeout, flags=zmq.POLLIN)
-                if event:
-                    _id, msg = await self.receive_message()
-                    asyncio.ensure_future(self.handle_msg(_id, msg))
-            except zmq.error.ZMQError:
-                self.socket.close()
-                self.setup_socket()
+                await self.handle_msg(_id, msg)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f'Error handling message: {str(e)}')
+            finally:
+                self.queued[key] -= 1
 
-        self.socket.close()
+    async def receive_frames(self):
+        # Frames stay in ZMQ's buffers instead of being copied out
+        _id, *frames = await self.socket.recv_multipart(copy=False)
+
+        return _id.bytes, frames
 
     async def receive_message(self):
-        _id = await self.socket.recv()
-        msg = await self.socket.recv()
+        _id, frames = await self.receive_frames()
+
+        return _id, frames[0].bytes
 
-        return _id, msg
+    async def shed(self, _id, msg):
+        pass
 
     async def handle_msg(self, _id, msg):
         await self.return_msg(_id, msg)
 
     async def return_msg(self, _id, msg):
-        sent = False
-        while not sent:
+        # Anything but bytes is sent as the frames of one multipart message
+        frames = [msg] if isinstance(msg, (bytes, str, zmq.Frame)) else msg
+
+        while True:
             try:
-                await self.socket.send_multipart([_id, msg])
-                sent = True
+                await send_frames(self.socket, chain([_id], frames))
+                return
             except zmq.error.ZMQError:
                 self.socket.close()
                 self.setup_socket()
 
+            # Frames that were made as they were sent cannot be sent again
+            if not isinstance(frames, list):
+                logger.error('Could not return a streamed message.')
+                return
+
     def setup_socket(self):
         try:
             self.socket = self.ctx.socket(zmq.ROUTER)
@@ -118,10 +306,14 @@ class AsyncInbox:
     def stop(self):
         self.running = False
 
+        if self.receiving is not None:
+            self.receiving.cancel()
+
 
 class JSONAsyncInbox(AsyncInbox):
-    def __init__(self, secure=False, *args, **kwargs):
+    def __init__(self, secure=False, compress_threshold=COMPRESS_THRESHOLD, *args, **kwargs):
         self.secure = secure
+        self.compress_threshold = compress_threshold
 
         super().__init__(*args, **kwargs)
 
@@ -138,61 +330,480 @@ class JSONAsyncInbox(AsyncInbox):
         self.socket.bind(self.address)
 
     async def receive_message(self):
-        _id = await self.socket.recv()
-        msg = await self.socket.recv()
+        _id = await self.socket.recv(copy=False)
 
-        return _id, decode(msg)
+        try:
+            msg, _ = await read_message(self.socket)
+        except wire.WireException as e:
+            logger.error(f'Dropping bad frame: {e}')
+            msg = {}
 
-    async def return_msg(self, _id, msg):
-        msg = encode(msg).encode()
-        await super().return_msg(_id, msg)
+        # Anything but a dict is answered like a message without a service
+        if not isinstance(msg, dict):
+            msg = {}
+
+        return _id.bytes, msg
+
+    async def return_msg(self, _id, msg, codec=wire.JSON):
+        frames = wire.pack_frames(msg, codec, compress_threshold=self.compress_threshold)
+        await super().return_msg(_id, frames)
+
+
+_executor = None
+
+
+def get_executor():
+    global _executor
+
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=PROCESSOR_THREADS, thread_name_prefix='processor')
+
+    return _executor
 
 
 class Router(JSONAsyncInbox):
-    def __init__(self, debug=True, *args, **kwargs):
+    def __init__(self, debug=True, executor=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
+        self.executor = executor
+
         self.services = {}
+        self.priorities = {}
         self.log = get_logger(self.address)
         self.log.propagate = debug
 
+        self.add_service(HEARTBEAT_SERVICE, HeartbeatProcessor())
+
+    def queue_key(self, msg):
+        # Unknown services share one queue so made up service names cannot create new queues
+        service = msg.get('service')
+        if service in self.services:
+            return service
+        return None
+
+    def enqueued(self, key, msg):
+        # Tell CPU processors when their messages come in, not when a worker gets to them
+        processor = self.services.get(key)
+        if isinstance(processor, CPUProcessor):
+            processor.received(msg.get('msg'))
+
+    async def shed(self, _id, msg):
+        # Answer right away so the requester can try another peer instead of waiting for its timeout
+        await self.reply(_id, BUSY, msg.get('id'), self.reply_codec(msg))
+
+    def reply_codec(self, msg):
+        codec = msg.get('codec')
+        if codec not in wire.CODECS:
+            return wire.JSON
+        return codec
+
     async def handle_msg(self, _id, msg):
         service = msg.get('service')
         request = msg.get('msg')
+        request_id = msg.get('id')
+
+        codec = self.reply_codec(msg)
 
         self.log.debug(f'Message recieved for: {service}.')
 
         if service is None:
             self.log.debug('No service found for message.')
-            await super().return_msg(_id, OK)
+            await self.reply(_id, OK, request_id, codec)
             return
 
         if request is None:
             self.log.debug('No request found in message.')
-            await super().return_msg(_id, OK)
+            await self.reply(_id, OK, request_id, codec)
             return
 
         processor = self.services.get(service)
 
         if processor is None:
-            await super().return_msg(_id, OK)
+            await self.reply(_id, OK, request_id, codec)
             return
 
-        response = await processor.process_message(request)
+        response = await self.process(processor, request)
 
         if response is None:
-            await super().return_msg(_id, OK)
+            await self.reply(_id, OK, request_id, codec)
             return
 
-        await super().return_msg(_id, response)
+        await self.reply(_id, response, request_id, codec)
+
+    async def process(self, processor, request):
+        if isinstance(processor, CPUProcessor):
+            if self.executor is None:
+                self.executor = get_executor()
+
+            result = await asyncio.get_event_loop().run_in_executor(self.executor, processor.check, request)
+            return await processor.apply(request, result)
+
+        return await processor.process_message(request)
 
-    def add_service(self, name: str, processor: Processor):
+    async def reply(self, _id, response, request_id=None, codec=wire.JSON):
+        if request_id is not None:
+            response = {
+                'id': request_id,
+                'response': response
+            }
+
+        await super().return_msg(_id, response, codec)
+
+    def priority(self, key):
+        # Unknown services and empty messages are answered from the bulk queue
+        return self.priorities.get(key, BULK)
+
+    def add_service(self, name: str, processor: Processor, priority=CONSENSUS):
         self.services[name] = processor
+        self.priorities[name] = priority
 
 
-async def secure_send(msg: dict, service, wallet: Wallet, vk, ip, ctx: zmq.asyncio.Context, linger=500, cert_dir=DEFAULT_DIR):
-    #if wallet.verifying_key == vk:
-    #    return
+class PeerConnection:
+    def __init__(self, vk, ip, server_key, wallet: Wallet, ctx: zmq.asyncio.Context, linger=500, hwm=100,
+                 compress_threshold=COMPRESS_THRESHOLD):
+        self.vk = vk
+        self.ip = ip
+
+        self.compress_threshold = compress_threshold
+
+        self.socket = ctx.socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.LINGER, linger)
+        self.socket.setsockopt(zmq.TCP_KEEPALIVE, 1)
+
+        # Bounds what is queued for a peer that is down. ZMQ reconnects and redoes the handshake on its own.
+        self.socket.setsockopt(zmq.SNDHWM, hwm)
+
+        self.socket.curve_secretkey = wallet.curve_sk
+        self.socket.curve_publickey = wallet.curve_vk
+        self.socket.curve_serverkey = server_key
+
+        try:
+            self.socket.connect(ip)
+        except ZMQBaseError:
+            self.socket.close()
+            raise
+
+        self.requests = {}
+        self.request_id = 0
+
+        # Codec bits the peer has answered in. JSON until it answers in binary, which older nodes never do.
+        self.codec = wire.JSON
+
+        # Whether the peer's replies carry the request id. Older routers answer without it, so their replies cannot be
+        # matched to requests on a shared socket.
+        self.echoes_ids = False
+
+        self.closed = False
+        self.last_used = time.time()
+
+        self.reader = asyncio.ensure_future(self.read())
+
+        # Empty messages that ask for binary and streamed replies tell us which codecs the peer understands. Nodes
+        # that predate one answer in JSON instead. Their ids tell us if the peer echoes ids. No future waits on them,
+        # so the reader drops the replies after noting all that and nothing is left pending.
+        for codec in (wire.BINARY, wire.STREAMED):
+            self.request_id += 1
+            probe = build_message(service=None, message=None, request_id=self.request_id, codec=codec)
+            asyncio.ensure_future(self.send([wire.pack(probe)]))
+
+    async def read(self):
+        while not self.closed:
+            try:
+                response, codec = await read_message(self.socket)
+            except zmq.error.ZMQError:
+                self.close()
+                return
+            except wire.WireException as e:
+                logger.error(f'Dropping bad frame from {self.ip}: {e}')
+                continue
+
+            self.codec |= codec
+
+            # Replies to plain sends carry no id and are dropped
+            if not isinstance(response, dict) or response.get('id') is None:
+                continue
+
+            self.echoes_ids = True
+
+            future = self.requests.pop(response['id'], None)
+            if future is not None and not future.done():
+                future.set_result(response.get('response'))
+
+    async def send(self, frames):
+        self.last_used = time.time()
+
+        try:
+            await send_frames(self.socket, frames)
+            return True
+        except zmq.error.Again:
+            logger.debug(f'Send queue to {self.ip} is full.')
+            return False
+        except zmq.error.ZMQError:
+            self.close()
+            return False
+
+    async def request(self, service, msg: dict, timeout=1000, codec=wire.JSON):
+        self.request_id += 1
+        request_id = self.request_id
+
+        future = asyncio.get_event_loop().create_future()
+        self.requests[request_id] = future
+
+        message = build_message(service=service, message=msg, request_id=request_id, codec=wire.BINARY)
+        frames = wire.pack_frames(message, codec, compress_threshold=self.compress_threshold)
+
+        try:
+            if not await self.send(frames):
+                return None
+
+            return await asyncio.wait_for(future, timeout / 1000)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self.requests.pop(request_id, None)
+
+    def idle(self, now, idle_timeout):
+        return len(self.requests) == 0 and now - self.last_used > idle_timeout
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.closed = True
+        self.reader.cancel()
+        self.socket.close()
+
+        for future in self.requests.values():
+            if not future.done():
+                future.set_result(None)
+
+        self.requests.clear()
+
+
+class ConnectionPool:
+    def __init__(self, wallet: Wallet, ctx: zmq.asyncio.Context, cert_dir=DEFAULT_DIR, linger=500, idle_timeout=60,
+                 hwm=100, binary_services=(), stream_services=()):
+        self.wallet = wallet
+        self.ctx = ctx
+        self.cert_dir = cert_dir
+
+        # Messages for these services are sent in the binary codec to peers that support it
+        self.binary_services = set(binary_services)
+
+        # Messages for these are streamed in chunks instead
+        self.stream_services = set(stream_services)
+
+        self.linger = linger
+        self.idle_timeout = idle_timeout
+        self.hwm = hwm
+
+        # (vk, ip) -> PeerConnection
+        self.connections = {}
+
+    def get(self, vk, ip):
+        self.evict_idle()
+
+        connection = self.connections.get((vk, ip))
+        if connection is not None and not connection.closed:
+            return connection
+
+        server_pub = authentication.get_key_registry(self.cert_dir).get(vk)
+        if server_pub is None:
+            return None
+
+        try:
+            connection = PeerConnection(vk=vk, ip=ip, server_key=server_pub, wallet=self.wallet, ctx=self.ctx,
+                                        linger=self.linger, hwm=self.hwm)
+        except ZMQBaseError:
+            logger.debug(f'Could not connect to {ip}')
+            return None
+
+        self.connections[(vk, ip)] = connection
+
+        return connection
+
+    def codec(self, vk, ip, service):
+        connection = self.connections.get((vk, ip))
+        codec = connection.codec if connection is not None else wire.JSON
+
+        if service in self.stream_services and codec & wire.STREAM:
+            return wire.STREAMED
+
+        # Peers that understand binary but not streams are sent stream services' messages in one binary frame
+        if service in self.binary_services | self.stream_services and codec & wire.BINARY:
+            return wire.BINARY
+
+        return wire.JSON
+
+    async def request(self, msg: dict, service, vk, ip, timeout=1000):
+        connection = self.get(vk, ip)
+        if connection is None:
+            return None
+
+        # Until the peer has echoed an id, which older routers never do, requests go over a socket of their own
+        if not connection.echoes_ids:
+            return await single_request(msg=msg, service=service, wallet=self.wallet, vk=vk, ip=ip, ctx=self.ctx,
+                                        linger=self.linger, timeout=timeout, cert_dir=self.cert_dir)
+
+        return await connection.request(service=service, msg=msg, timeout=timeout, codec=self.codec(vk, ip, service))
+
+    def evict(self, vk, ip):
+        connection = self.connections.pop((vk, ip), None)
+        if connection is not None:
+            connection.close()
+
+    def evict_idle(self):
+        now = time.time()
+
+        for (vk, ip), connection in list(self.connections.items()):
+            if connection.closed or connection.idle(now, self.idle_timeout):
+                self.evict(vk, ip)
+
+    def refresh(self, vks):
+        # Drop connections to nodes that left governance
+        for vk, ip in list(self.connections.keys()):
+            if vk not in vks:
+                self.evict(vk, ip)
+
+    def close(self):
+        for vk, ip in list(self.connections.keys()):
+            self.evict(vk, ip)
+
+
+class PeerHealth:
+    # Smoothed round trip times of requests to each peer. Failed requests demote a peer, and a peer that keeps failing
+    # is skipped until it has rested.
+    def __init__(self, alpha=0.3, max_failures=3, rest=30):
+        self.alpha = alpha
+        self.max_failures = max_failures
+        self.rest = rest
+
+        self.rtts = {}
+        self.failures = {}
+        self.last_failure = {}
+
+    def record(self, vk, response, rtt):
+        # No reply means the request timed out or could not be sent. A busy peer is treated the same.
+        if response is None or response == BUSY:
+            self.failures[vk] = self.failures.get(vk, 0) + 1
+            self.last_failure[vk] = time.time()
+            return
+
+        self.failures.pop(vk, None)
+
+        previous = self.rtts.get(vk)
+        self.rtts[vk] = rtt if previous is None else previous + self.alpha * (rtt - previous)
+
+    def healthy(self, vk, now=None):
+        if self.failures.get(vk, 0) < self.max_failures:
+            return True
+
+        now = time.time() if now is None else now
+        return now - self.last_failure[vk] > self.rest
+
+    def rank(self, vks):
+        # Healthy peers first, then those with fewer recent failures, then the fastest. Unmeasured peers sit in between.
+        now = time.time()
+
+        return sorted(vks, key=lambda vk: (
+            not self.healthy(vk, now), self.failures.get(vk, 0), self.rtts.get(vk, UNKNOWN_RTT)
+        ))
+
+    def fastest(self, vks):
+        ranked = self.rank(vks)
+        return ranked[0] if len(ranked) > 0 else None
+
+
+_health = None
+
+
+def get_peer_health():
+    global _health
+
+    if _health is None:
+        _health = PeerHealth()
+
+    return _health
+
+
+class Heartbeat:
+    # Pings peers in the background. The replies are recorded in PeerHealth, so a peer that stopped answering is known
+    # to be down before anything has to wait on it.
+    def __init__(self, wallet: Wallet, ctx: zmq.asyncio.Context, peers, pool: ConnectionPool=None,
+                 interval=HEARTBEAT_INTERVAL, timeout=HEARTBEAT_TIMEOUT, cert_dir=DEFAULT_DIR):
+        self.wallet = wallet
+        self.ctx = ctx
+        self.pool = pool
+        self.cert_dir = cert_dir
+
+        # Called before every beat and returns the {vk: ip} map of peers to ping
+        self.peers = peers
+
+        self.interval = interval
+        self.timeout = timeout
+
+        self.running = False
+        self.task = None
+
+    async def beat(self):
+        peers = self.peers()
+
+        await asyncio.gather(*[
+            secure_request(
+                msg={},
+                service=HEARTBEAT_SERVICE,
+                wallet=self.wallet,
+                vk=vk,
+                ip=ip,
+                ctx=self.ctx,
+                timeout=self.timeout,
+                cert_dir=self.cert_dir,
+                pool=self.pool
+            ) for vk, ip in peers.items()
+        ])
+
+    async def run(self):
+        while self.running:
+            try:
+                await self.beat()
+            except Exception as e:
+                logger.error(f'Heartbeat failed: {e}')
+
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self.running = True
+        self.task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        self.running = False
+
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def live(self, vks):
+        # Peers that have not been pinged yet are assumed to be live
+        health = get_peer_health()
+        return [vk for vk in vks if health.healthy(vk)]
+
+
+async def send_payload(payload, wallet: Wallet, vk, ip, ctx: zmq.asyncio.Context, linger=500, cert_dir=DEFAULT_DIR,
+                       pool: ConnectionPool=None):
+    # Sends an already serialized message, either one frame or the frames of a multipart message. Returns whether it
+    # was handed to ZMQ.
+    frames = [payload] if isinstance(payload, (bytes, str, zmq.Frame)) else payload
+
+    if pool is not None:
+        connection = pool.get(vk, ip)
+        if connection is None:
+            return False
+
+        return await connection.send(frames)
+
+    server_pub = authentication.get_key_registry(cert_dir).get(vk)
+    if server_pub is None:
+        return False
 
     socket = ctx.socket(zmq.DEALER)
     socket.setsockopt(zmq.LINGER, linger)
@@ -200,34 +811,52 @@ async def secure_send(msg: dict, service, wallet: Wallet, vk, ip, ctx: zmq.async
 
     socket.curve_secretkey = wallet.curve_sk
     socket.curve_publickey = wallet.curve_vk
-
-    filename = str(cert_dir / f'{vk}.key')
-    if not os.path.exists(filename):
-        return None
-
-    server_pub, _ = load_certificate(filename)
-
     socket.curve_serverkey = server_pub
 
     try:
         socket.connect(ip)
+        await send_frames(socket, frames)
+        return True
     except ZMQBaseError:
+        return False
+    finally:
         socket.close()
-        return None
+
+
+async def secure_send(msg: dict, service, wallet: Wallet, vk, ip, ctx: zmq.asyncio.Context, linger=500, cert_dir=DEFAULT_DIR,
+                      pool: ConnectionPool=None):
+    #if wallet.verifying_key == vk:
+    #    return
 
     message = build_message(service=service, message=msg)
 
-    payload = encode(message).encode()
+    codec = pool.codec(vk, ip, service) if pool is not None else wire.JSON
+    payload = wire.pack_frames(message, codec, compress_threshold=COMPRESS_THRESHOLD)
 
-    await socket.send(payload, flags=zmq.NOBLOCK)
-    socket.close()
+    await send_payload(payload=payload, wallet=wallet, vk=vk, ip=ip, ctx=ctx, linger=linger, cert_dir=cert_dir, pool=pool)
 
 
 async def secure_request(msg: dict, service: str, wallet: Wallet, vk: str, ip: str, ctx: zmq.asyncio.Context,
-                         linger=500, timeout=1000, cert_dir=DEFAULT_DIR):
+                         linger=500, timeout=1000, cert_dir=DEFAULT_DIR, pool: ConnectionPool=None, reply_codec=None):
     #if wallet.verifying_key == vk:
     #    return
 
+    started = time.time()
+
+    if pool is not None:
+        response = await pool.request(msg=msg, service=service, vk=vk, ip=ip, timeout=timeout)
+    else:
+        response = await single_request(msg=msg, service=service, wallet=wallet, vk=vk, ip=ip, ctx=ctx, linger=linger,
+                                        timeout=timeout, cert_dir=cert_dir, reply_codec=reply_codec)
+
+    get_peer_health().record(vk, response, time.time() - started)
+
+    return response
+
+
+async def single_request(msg: dict, service: str, wallet: Wallet, vk: str, ip: str, ctx: zmq.asyncio.Context,
+                         linger=500, timeout=1000, cert_dir=DEFAULT_DIR, reply_codec=None):
+    # One request over a socket of its own. Works with peers that predate request ids.
     socket = ctx.socket(zmq.DEALER)
     socket.setsockopt(zmq.LINGER, linger)
     socket.setsockopt(zmq.TCP_KEEPALIVE, 1)
@@ -235,12 +864,10 @@ async def secure_request(msg: dict, service: str, wallet: Wallet, vk: str, ip: s
     socket.curve_secretkey = wallet.curve_sk
     socket.curve_publickey = wallet.curve_vk
 
-    filename = str(cert_dir / f'{vk}.key')
-    if not os.path.exists(filename):
+    server_pub = authentication.get_key_registry(cert_dir).get(vk)
+    if server_pub is None:
         return None
 
-    server_pub, _ = load_certificate(filename)
-
     socket.curve_serverkey = server_pub
 
     try:
@@ -250,9 +877,10 @@ async def secure_request(msg: dict, service: str, wallet: Wallet, vk: str, ip: s
         socket.close()
         return None
 
-    message = build_message(service=service, message=msg)
+    # The request itself stays JSON because the peer may predate the binary codec
+    message = build_message(service=service, message=msg, codec=reply_codec)
 
-    payload = encode(message).encode()
+    payload = wire.pack(message)
 
     await socket.send(payload)
 
@@ -260,20 +888,41 @@ async def secure_request(msg: dict, service: str, wallet: Wallet, vk: str, ip: s
     msg = None
     if event:
         #logger.debug(f'Message received on {ip}')
-        response = await socket.recv()
-
-        msg = decode(response)
+        try:
+            msg, _ = await read_message(socket)
+        except wire.WireException as e:
+            logger.error(f'Bad reply from {ip}: {e}')
 
     socket.close()
 
     return msg
 
 
-async def secure_multicast(msg: dict, service, wallet: Wallet, peer_map: dict, ctx: zmq.asyncio.Context, linger=500, cert_dir=DEFAULT_DIR):
+async def secure_multicast(msg: dict, service, wallet: Wallet, peer_map: dict, ctx: zmq.asyncio.Context, linger=500, cert_dir=DEFAULT_DIR,
+                           pool: ConnectionPool=None):
+    message = build_message(service=service, message=msg)
+
+    # Serialize once per codec. Every peer is sent the same frames, which ZMQ shares instead of copying, so streams
+    # are made whole here rather than as they are sent.
+    payloads = {}
+
+    peers = list(peer_map.items())
+
     coroutines = []
-    for vk, ip in peer_map.items():
+    for vk, ip in peers:
+        codec = pool.codec(vk, ip, service) if pool is not None else wire.JSON
+
+        payload = payloads.get(codec)
+        if payload is None:
+            payload = [zmq.Frame(f) for f in wire.pack_frames(message, codec, compress_threshold=COMPRESS_THRESHOLD)]
+            payloads[codec] = payload
+
         coroutines.append(
-            secure_send(msg=msg, service=service, cert_dir=cert_dir, wallet=wallet, vk=vk, ip=ip, ctx=ctx, linger=linger)
+            send_payload(payload=payload, cert_dir=cert_dir, wallet=wallet, vk=vk, ip=ip, ctx=ctx, linger=linger,
+                         pool=pool)
         )
 
-    await asyncio.gather(*coroutines)
+    results = await asyncio.gather(*coroutines)
+
+    # vk -> whether the message was handed off to that peer
+    return {vk: sent for (vk, _), sent in zip(peers, results)}
@@ -0,0 +1,175 @@
+import hashlib
+import struct
+import zlib
+
+from contracting.db.driver import ContractDriver
+from contracting.db.encoder import encode, decode
+from pymongo import UpdateOne
+
+from lamden import storage
+from lamden.logger.base import get_logger
+
+log = get_logger('Snapshot')
+
+MAGIC = b'LSNP'
+VERSION = 1
+
+STATE = 'state'
+NONCES = 'nonces'
+
+'''
+Snapshot file layout:
+MAGIC | VERSION (1 byte) | header frame | chunk frame * n | empty frame | sha3 of all chunk digests (32 bytes)
+
+Every frame is a 4 byte big endian length followed by the sha3_256 digest of the payload and the payload itself.
+Chunks are zlib compressed, encoded dicts of {'type': 'state' | 'nonces', 'items': [...]}.
+'''
+
+
+class SnapshotException(Exception):
+    pass
+
+
+def write_frame(f, payload: bytes):
+    f.write(struct.pack('>I', len(payload)))
+    digest = hashlib.sha3_256(payload).digest()
+    f.write(digest)
+    f.write(payload)
+    return digest
+
+
+def read_frame(f):
+    length = f.read(4)
+    if len(length) != 4:
+        raise SnapshotException('Snapshot is truncated.')
+
+    length = struct.unpack('>I', length)[0]
+    digest = f.read(32)
+    payload = f.read(length)
+
+    if len(digest) != 32 or len(payload) != length:
+        raise SnapshotException('Snapshot is truncated.')
+
+    if hashlib.sha3_256(payload).digest() != digest:
+        raise SnapshotException('Snapshot chunk checksum mismatch.')
+
+    return payload, digest
+
+
+def write_chunk(f, _type, items):
+    payload = zlib.compress(encode({'type': _type, 'items': items}).encode())
+    return write_frame(f, payload)
+
+
+def export_snapshot(filename, driver: ContractDriver, nonces: storage.NonceStorage, chunk_size=10_000):
+    height = storage.get_latest_block_height(driver)
+    block_hash = storage.get_latest_block_hash(driver)
+
+    total = hashlib.sha3_256()
+
+    with open(filename, 'wb') as f:
+        f.write(MAGIC + bytes([VERSION]))
+        write_frame(f, encode({'height': height, 'hash': block_hash, 'chunk_size': chunk_size}).encode())
+
+        items = []
+        for key in driver.driver.iter(prefix=''):
+            items.append([key, driver.driver.get(key)])
+
+            if len(items) >= chunk_size:
+                total.update(write_chunk(f, STATE, items))
+                items = []
+
+        if len(items) > 0:
+            total.update(write_chunk(f, STATE, items))
+            items = []
+
+        for n in nonces.nonces.find({}, {'_id': False}):
+            items.append([n['sender'], n['processor'], n['value']])
+
+            if len(items) >= chunk_size:
+                total.update(write_chunk(f, NONCES, items))
+                items = []
+
+        if len(items) > 0:
+            total.update(write_chunk(f, NONCES, items))
+
+        write_frame(f, b'')
+        f.write(total.digest())
+
+    log.info(f'Exported snapshot of block #{height} to {filename}.')
+
+    return height, block_hash
+
+
+def read_snapshot(filename):
+    with open(filename, 'rb') as f:
+        if f.read(4) != MAGIC:
+            raise SnapshotException('Not a snapshot file.')
+
+        version = f.read(1)
+        if len(version) != 1 or version[0] != VERSION:
+            raise SnapshotException('Unsupported snapshot version.')
+
+        header, _ = read_frame(f)
+        yield decode(header)
+
+        total = hashlib.sha3_256()
+        while True:
+            payload, digest = read_frame(f)
+
+            if len(payload) == 0:
+                break
+
+            total.update(digest)
+            yield decode(zlib.decompress(payload).decode())
+
+        if f.read(32) != total.digest():
+            raise SnapshotException('Snapshot checksum mismatch.')
+
+
+def verify_snapshot(filename):
+    snapshot = read_snapshot(filename)
+    header = next(snapshot)
+
+    for _ in snapshot:
+        pass
+
+    return header
+
+
+def import_snapshot(filename, driver: ContractDriver, nonces: storage.NonceStorage):
+    # Verify the whole file before touching any state so a corrupt snapshot leaves the node untouched
+    header = verify_snapshot(filename)
+
+    driver.flush()
+    nonces.flush()
+
+    snapshot = read_snapshot(filename)
+    next(snapshot)
+
+    for chunk in snapshot:
+        if chunk['type'] == STATE:
+            for key, value in chunk['items']:
+                driver.driver.set(key, value)
+
+        elif chunk['type'] == NONCES:
+            nonces.nonces.bulk_write([
+                UpdateOne(
+                    {'sender': sender, 'processor': processor},
+                    {'$set': {'value': value}},
+                    upsert=True
+                ) for sender, processor, value in chunk['items']
+            ], ordered=False)
+
+    storage.set_latest_block_hash(header['hash'], driver=driver)
+    storage.set_latest_block_height(header['height'], driver=driver)
+
+    driver.clear_pending_state()
+
+    # The cached storage has to be rebuilt from what was just written
+    if isinstance(nonces, storage.CachedNonceStorage):
+        nonces.rebuild()
+
+    log.info(f'Imported snapshot of block #{header["height"]}. Catchup will continue from #{header["height"] + 1}.')
+
+    return header['height'], header['hash']
@@ -1,8 +1,14 @@
 from contracting.db.driver import ContractDriver
-from pymongo import MongoClient, DESCENDING
+from pymongo import MongoClient, ASCENDING, DESCENDING, InsertOne, UpdateOne, DeleteOne, monitoring
+from pymongo.errors import InvalidOperation, OperationFailure, DuplicateKeyError, BulkWriteError
 
 import lamden
+from lamden import db_config
 from lamden.logger.base import get_logger
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import asyncio
+import threading
 
 BLOCK_HASH_KEY = '_current_block_hash'
 BLOCK_NUM_HEIGHT = '_current_block_height'
@@ -11,18 +17,230 @@ PENDING_NONCE_KEY = '__pn'
 
 log = get_logger('STATE')
 
+BLOCK_INDEXES = [
+    [('number', ASCENDING)],
+    [('hash', ASCENDING)]
+]
+TX_INDEXES = [
+    [('hash', ASCENDING)]
+]
+NONCE_INDEXES = [
+    [('sender', ASCENDING), ('processor', ASCENDING)]
+]
+
+# Named projections for block reads. Headers drop the subblocks, no_payloads keeps everything but the signed txs.
+BLOCK_PROJECTIONS = {
+    'full': {'_id': False},
+    'headers': {'_id': False, 'subblocks': False},
+    'no_payloads': {'_id': False, 'subblocks.transactions.transaction': False}
+}
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        self.created = 0
+        self.closed = 0
+        self.checked_out = 0
+        self.checked_in = 0
+        self.check_out_failures = 0
+        self.cleared = 0
+
+    def increment(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self.increment('cleared')
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self.increment('created')
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self.increment('closed')
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self.increment('check_out_failures')
+
+    def connection_checked_out(self, event):
+        self.increment('checked_out')
+
+    def connection_checked_in(self, event):
+        self.increment('checked_in')
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'open': self.created - self.closed,
+                'in_use': self.checked_out - self.checked_in,
+                'created': self.created,
+                'closed': self.closed,
+                'checked_out': self.checked_out,
+                'check_out_failures': self.check_out_failures,
+                'cleared': self.cleared
+            }
+
+
+# One client, and therefore one connection pool, per (host, port) for the whole process
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(host=None, port=None):
+    host = host if host is not None else db_config.MONGO_HOST
+    port = port if port is not None else db_config.MONGO_PORT
+
+    with _clients_lock:
+        if _clients.get((host, port)) is None:
+            stats = PoolStats()
+            client = MongoClient(
+                host=host,
+                port=port,
+                maxPoolSize=db_config.MONGO_MAX_POOL_SIZE,
+                minPoolSize=db_config.MONGO_MIN_POOL_SIZE,
+                connectTimeoutMS=db_config.MONGO_CONNECT_TIMEOUT_MS,
+                serverSelectionTimeoutMS=db_config.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                socketTimeoutMS=db_config.MONGO_SOCKET_TIMEOUT_MS or None,
+                event_listeners=[stats]
+            )
+            _clients[(host, port)] = (client, stats)
+
+        return _clients[(host, port)][0]
+
+
+def pool_stats():
+    with _clients_lock:
+        return {f'{host}:{port}': stats.to_dict() for (host, port), (_, stats) in _clients.items()}
+
+
+def close_clients():
+    with _clients_lock:
+        for client, _ in _clients.values():
+            client.close()
+        _clients.clear()
+
+
+DUPLICATE_KEY = 11000
+
+
+def only_duplicate_keys(e: OperationFailure):
+    # Bulk write errors list the error of each failed document. Client level ones key them by request index.
+    if isinstance(e, DuplicateKeyError):
+        return True
+
+    details = e.details or {}
+
+    errors = getattr(e, 'write_errors', None)
+    if errors is None:
+        errors = details.get('writeErrors')
+
+    concern_errors = getattr(e, 'write_concern_errors', None) or details.get('writeConcernErrors')
+
+    if not errors or concern_errors:
+        return False
+
+    if isinstance(errors, dict):
+        errors = errors.values()
+
+    return all(error.get('code') == DUPLICATE_KEY for error in errors)
+
+
+def build_indexes(collection, indexes, unique=True):
+    # create_index is a no-op if an identical index already exists, so this is safe to run on every startup. Raises
+    # DuplicateKeyError if the collection already holds documents that break a unique index.
+    return [collection.create_index(keys, unique=unique) for keys in indexes]
+
+
+def duplicates(collection, indexes):
+    # Yields the index name and the _ids of each group of documents that share the keys of a unique index, oldest first
+    for keys in indexes:
+        name = f'{collection.name}.' + '_'.join(k for k, _ in keys)
+
+        groups = collection.aggregate([
+            {'$sort': {'_id': ASCENDING}},
+            {'$group': {'_id': {k: f'${k}' for k, _ in keys}, 'ids': {'$push': '$_id'}}},
+            {'$match': {'ids.1': {'$exists': True}}}
+        ])
+
+        for group in groups:
+            yield name, group['ids']
+
+
+def count_duplicates(collection, indexes):
+    # Documents that would have to be removed before the unique indexes can be built, by index
+    counts = {}
+    for name, ids in duplicates(collection, indexes):
+        counts[name] = counts.get(name, 0) + len(ids) - 1
+
+    return counts
+
+
+def remove_duplicates(collection, indexes):
+    # Keeps the oldest document of each group. It is the one find_one has been returning.
+    removed = 0
+    for _, ids in list(duplicates(collection, indexes)):
+        removed += collection.delete_many({'_id': {'$in': ids[1:]}}).deleted_count
+
+    return removed
+
+
+def missing_indexes(collection, indexes, unique=True):
+    existing = [
+        (list(index['key']), index.get('unique', False)) for index in collection.index_information().values()
+    ]
+
+    missing = []
+    for keys in indexes:
+        if (list(keys), unique) not in existing:
+            missing.append(f'{collection.name}.' + '_'.join(k for k, _ in keys))
+
+    return missing
+
 
 class NonceStorage:
-    def __init__(self, port=27027, db_name='lamden', nonce_collection='nonces', pending_collection='pending_nonces', config_path=lamden.__path__[0]):
+    def __init__(self, port=None, db_name='lamden', nonce_collection='nonces', pending_collection='pending_nonces',
+                 config_path=lamden.__path__[0], create_indexes=False, host=None):
         self.config_path = config_path
 
         self.port = port
 
-        self.client = MongoClient()
+        self.client = get_client(host=host, port=port)
         self.db = self.client.get_database(db_name)
         self.nonces = self.db[nonce_collection]
         self.pending_nonces = self.db[pending_collection]
 
+        if create_indexes:
+            self.build_indexes()
+
+    def build_indexes(self):
+        build_indexes(self.nonces, NONCE_INDEXES)
+        build_indexes(self.pending_nonces, NONCE_INDEXES)
+
+    def missing_indexes(self):
+        return missing_indexes(self.nonces, NONCE_INDEXES) + missing_indexes(self.pending_nonces, NONCE_INDEXES)
+
+    def count_duplicates(self):
+        return {**count_duplicates(self.nonces, NONCE_INDEXES), **count_duplicates(self.pending_nonces, NONCE_INDEXES)}
+
+    def remove_duplicates(self):
+        return remove_duplicates(self.nonces, NONCE_INDEXES) + remove_duplicates(self.pending_nonces, NONCE_INDEXES)
+
     @staticmethod
     def get_one(sender, processor, db):
         v = db.find_one(
@@ -78,9 +296,92 @@ class NonceStorage:
     def flush(self):
         self.nonces.drop()
         self.pending_nonces.drop()
+        self.build_indexes()
 
     def flush_pending(self):
         self.pending_nonces.drop()
+        build_indexes(self.pending_nonces, NONCE_INDEXES)
+
+    def commit(self):
+        # Writes go straight to the database. Only the cached storage has anything to commit.
+        pass
+
+
+class CachedNonceStorage(NonceStorage):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.nonce_cache = {}
+        self.pending_cache = {}
+
+        self.dirty_nonces = set()
+        self.dirty_pending = set()
+
+        self.rebuild()
+
+    def rebuild(self):
+        # Pending nonces belong to txs in the in-memory queue, which does not survive a restart.
+        # Committed nonces are written before the state of their block, so they are always safe to load.
+        self.flush_pending()
+
+        self.nonce_cache = {(n['sender'], n['processor']): n['value'] for n in self.nonces.find({}, {'_id': False})}
+        self.dirty_nonces.clear()
+
+    def get_nonce(self, sender, processor):
+        return self.nonce_cache.get((sender, processor))
+
+    def get_pending_nonce(self, sender, processor):
+        return self.pending_cache.get((sender, processor))
+
+    def set_nonce(self, sender, processor, value):
+        self.nonce_cache[(sender, processor)] = value
+        self.dirty_nonces.add((sender, processor))
+
+    def set_pending_nonce(self, sender, processor, value):
+        self.pending_cache[(sender, processor)] = value
+        self.dirty_pending.add((sender, processor))
+
+    @staticmethod
+    def write_many(keys, cache, db):
+        requests = []
+        for sender, processor in keys:
+            value = cache.get((sender, processor))
+            q = {
+                'sender': sender,
+                'processor': processor
+            }
+
+            if value is None:
+                requests.append(DeleteOne(q))
+            else:
+                requests.append(UpdateOne(q, {'$set': {'value': value}}, upsert=True))
+
+        if len(requests) > 0:
+            db.bulk_write(requests, ordered=False)
+
+    def commit(self):
+        self.write_many(self.dirty_nonces, self.nonce_cache, self.nonces)
+        self.dirty_nonces.clear()
+
+        self.write_many(self.dirty_pending, self.pending_cache, self.pending_nonces)
+        self.dirty_pending.clear()
+
+        # Pending nonces that were cleared by the block do not need to be kept around
+        self.pending_cache = {k: v for k, v in self.pending_cache.items() if v is not None}
+
+    def flush(self):
+        super().flush()
+
+        self.nonce_cache.clear()
+        self.pending_cache.clear()
+        self.dirty_nonces.clear()
+        self.dirty_pending.clear()
+
+    def flush_pending(self):
+        super().flush_pending()
+
+        self.pending_cache.clear()
+        self.dirty_pending.clear()
 
 
 def get_latest_block_hash(driver: ContractDriver):
@@ -106,23 +407,25 @@ def set_latest_block_height(h, driver: ContractDriver):
 
 
 def update_state_with_transaction(tx, driver: ContractDriver, nonces: NonceStorage):
-    nonces_to_delete = []
+    if tx['state'] is None or len(tx['state']) == 0:
+        return
 
-    if tx['state'] is not None and len(tx['state']) > 0:
-        for delta in tx['state']:
-            driver.driver.set(delta['key'], delta['value'])
-            log.debug(f"{delta['key']} -> {delta['value']}")
+    for delta in tx['state']:
+        driver.driver.set(delta['key'], delta['value'])
+        log.debug(f"{delta['key']} -> {delta['value']}")
 
-            nonces.set_nonce(
-                sender=tx['transaction']['payload']['sender'],
-                processor=tx['transaction']['payload']['processor'],
-                value=tx['transaction']['payload']['nonce'] + 1
-            )
+    # One nonce update per tx, not per state delta
+    nonces.set_nonce(
+        sender=tx['transaction']['payload']['sender'],
+        processor=tx['transaction']['payload']['processor'],
+        value=tx['transaction']['payload']['nonce'] + 1
+    )
 
-            nonces_to_delete.append((tx['transaction']['payload']['sender'], tx['transaction']['payload']['processor']))
-
-    for n in nonces_to_delete:
-        nonces.set_pending_nonce(*n, value=None)
+    nonces.set_pending_nonce(
+        sender=tx['transaction']['payload']['sender'],
+        processor=tx['transaction']['payload']['processor'],
+        value=None
+    )
 
 
 def update_state_with_block(block, driver: ContractDriver, nonces: NonceStorage, set_hash_and_height=True):
@@ -141,18 +444,39 @@ class BlockStorage:
     BLOCK = 0
     TX = 1
 
-    def __init__(self, port=27027, config_path=lamden.__path__[0], db='lamden', blocks_collection='blocks', tx_collection='tx'):
+    def __init__(self, port=None, config_path=lamden.__path__[0], db='lamden', blocks_collection='blocks', tx_collection='tx',
+                 bulk=True, batch=False, create_indexes=False, host=None):
         # Setup configuration file to read constants
         self.config_path = config_path
 
         self.port = port
 
-        self.client = MongoClient()
+        # Bulk writes all txs of a block with one insert_many. Batch additionally sends the block in the same request.
+        self.bulk = bulk
+        self.batch = batch
+
+        self.client = get_client(host=host, port=port)
         self.db = self.client.get_database(db)
 
         self.blocks = self.db[blocks_collection]
         self.txs = self.db[tx_collection]
 
+        if create_indexes:
+            self.build_indexes()
+
+    def build_indexes(self):
+        build_indexes(self.blocks, BLOCK_INDEXES)
+        build_indexes(self.txs, TX_INDEXES)
+
+    def missing_indexes(self):
+        return missing_indexes(self.blocks, BLOCK_INDEXES) + missing_indexes(self.txs, TX_INDEXES)
+
+    def count_duplicates(self):
+        return {**count_duplicates(self.blocks, BLOCK_INDEXES), **count_duplicates(self.txs, TX_INDEXES)}
+
+    def remove_duplicates(self):
+        return remove_duplicates(self.blocks, BLOCK_INDEXES) + remove_duplicates(self.txs, TX_INDEXES)
+
     def q(self, v):
         if isinstance(v, int):
             return {'number': v}
@@ -182,6 +506,27 @@ class BlockStorage:
 
         return _id is not None
 
+    def put_many(self, data, collection=TX):
+        if collection == BlockStorage.BLOCK:
+            c = self.blocks
+        elif collection == BlockStorage.TX:
+            c = self.txs
+        else:
+            return False
+
+        if len(data) == 0:
+            return True
+
+        # Insert shallow copies so the generated _ids never leak into documents that are still referenced by a block
+        try:
+            result = c.insert_many([dict(d) for d in data], ordered=False)
+        except BulkWriteError as e:
+            # Unordered inserts still write every document that is not a duplicate
+            log.error(f'{len(e.details["writeErrors"])} of {len(data)} documents were not inserted.')
+            return False
+
+        return len(result.inserted_ids) == len(data)
+
     def get_last_n(self, n, collection=BLOCK):
         if collection == BlockStorage.BLOCK:
             c = self.blocks
@@ -202,6 +547,19 @@ class BlockStorage:
 
         return blocks
 
+    def get_blocks(self, start, end, batch_size=100, projection='full'):
+        # Inclusive range served from one cursor sorted by the number index, fetched batch_size blocks at a time
+        cursor = self.blocks.find(
+            {'number': {'$gte': start, '$lte': end}},
+            BLOCK_PROJECTIONS[projection]
+        ).sort('number', ASCENDING).batch_size(batch_size)
+
+        try:
+            for block in cursor:
+                yield block
+        finally:
+            cursor.close()
+
     def get_tx(self, h, no_id=True):
         tx = self.txs.find_one({'hash': h})
 
@@ -213,33 +571,173 @@ class BlockStorage:
     def drop_collections(self):
         self.blocks.drop()
         self.txs.drop()
+        self.build_indexes()
 
     def flush(self):
         self.drop_collections()
 
     def store_block(self, block):
-        self.put(block, BlockStorage.BLOCK)
+        if self.batch and self.batch_block(block):
+            return
+
+        try:
+            self.put(block, BlockStorage.BLOCK)
+        except DuplicateKeyError:
+            # A block that is stored again may have lost some of its txs the first time. Stored ones are skipped.
+            block.pop('_id', None)
+            log.error(f'Block #{block.get("number")} is already stored. Storing any missing txs.')
+            self.put_many(self.get_txs_from_block(block), BlockStorage.TX)
+            return
+
         self.store_txs(block)
 
-    def store_txs(self, block):
+    def batch_block(self, block):
+        # Client level bulk writes need pymongo >= 4.9 and MongoDB >= 8.0. Returns False so the caller can fall back.
+        if not hasattr(self.client, 'bulk_write'):
+            return False
+
+        requests = [InsertOne(namespace=self.blocks.full_name, document=dict(block))]
+        requests.extend(
+            InsertOne(namespace=self.txs.full_name, document=dict(tx)) for tx in self.get_txs_from_block(block)
+        )
+
+        try:
+            self.client.bulk_write(requests, ordered=False)
+        except InvalidOperation as e:
+            log.error(f'Batched block writes not supported by the server, falling back to bulk writes: {e}')
+            return False
+        except OperationFailure as e:
+            # Unordered writes go on past documents that are already stored. Anything else may have lost some of them.
+            if not only_duplicate_keys(e):
+                log.error(f'Batched block write for block #{block.get("number")} was not fully applied: {e}')
+                raise
+
+            log.error(f'Block #{block.get("number")} was already partly stored. Skipped the stored documents.')
+
+        return True
+
+    @staticmethod
+    def get_txs_from_block(block):
         if block.get('subblocks') is None:
+            return []
+
+        return [tx for subblock in block['subblocks'] for tx in subblock['transactions']]
+
+    def store_txs(self, block):
+        txs = self.get_txs_from_block(block)
+
+        if self.bulk:
+            self.put_many(txs, BlockStorage.TX)
             return
 
-        for subblock in block['subblocks']:
-            for tx in subblock['transactions']:
-                self.put(tx, BlockStorage.TX)
+        for tx in txs:
+            self.put(tx, BlockStorage.TX)
 
     def delete_tx(self, h):
         self.txs.delete_one({'hash': h})
 
+    def delete_txs(self, hashes):
+        self.txs.delete_many({'hash': {'$in': hashes}})
+
     def delete_block(self, v):
         block = self.get_block(v, no_id=False)
 
         if block is None:
             return
 
-        for subblock in block['subblocks']:
-            for tx in subblock['transactions']:
-                self.delete_tx(tx['hash'])
+        self.delete_txs([tx['hash'] for tx in self.get_txs_from_block(block)])
 
         self.blocks.delete_one({'_id': block['_id']})
+
+
+# Bounded pool shared by every async storage facade so a slow database cannot spawn unlimited threads
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=db_config.STORAGE_THREADS, thread_name_prefix='storage')
+
+        return _executor
+
+
+def log_write_exception(future):
+    if future.exception() is not None:
+        log.error(f'Deferred storage write failed: {future.exception()}')
+
+
+class AsyncStorage:
+    def __init__(self, storage, executor=None):
+        self.storage = storage
+        self.executor = executor if executor is not None else get_executor()
+
+        # Writes go through a single thread so they are applied in the order they were made
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='storage-writer')
+        self.last_write = None
+
+    async def run(self, f, *args, **kwargs):
+        # Reads always see writes that were deferred before them
+        await self.wait_for_writes()
+
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, partial(f, *args, **kwargs))
+
+    def run_nowait(self, f, *args, **kwargs):
+        self.last_write = self.writer.submit(f, *args, **kwargs)
+        self.last_write.add_done_callback(log_write_exception)
+
+        return self.last_write
+
+    async def wait_for_writes(self):
+        if self.last_write is not None and not self.last_write.done():
+            await asyncio.wrap_future(self.last_write)
+
+
+class AsyncBlockStorage(AsyncStorage):
+    def __init__(self, blocks: BlockStorage, executor=None):
+        super().__init__(storage=blocks, executor=executor)
+
+    async def get_block(self, v=None, no_id=True):
+        return await self.run(self.storage.get_block, v, no_id=no_id)
+
+    async def get_last_n(self, n, collection=BlockStorage.BLOCK):
+        return await self.run(self.storage.get_last_n, n, collection=collection)
+
+    async def get_blocks(self, start, end, batch_size=100, projection='full'):
+        return await self.run(
+            lambda: list(self.storage.get_blocks(start, end, batch_size=batch_size, projection=projection))
+        )
+
+    async def get_tx(self, h, no_id=True):
+        return await self.run(self.storage.get_tx, h, no_id=no_id)
+
+    async def store_block(self, block):
+        await asyncio.wrap_future(self.store_block_nowait(block))
+
+    def store_block_nowait(self, block):
+        return self.run_nowait(self.storage.store_block, block)
+
+
+class AsyncNonceStorage(AsyncStorage):
+    def __init__(self, nonces: NonceStorage, executor=None):
+        super().__init__(storage=nonces, executor=executor)
+
+    async def run(self, f, *args, **kwargs):
+        # Cached nonces never touch the database and must not be shared with other threads
+        if isinstance(self.storage, CachedNonceStorage):
+            return f(*args, **kwargs)
+
+        return await super().run(f, *args, **kwargs)
+
+    async def get_nonce(self, sender, processor):
+        return await self.run(self.storage.get_nonce, sender, processor)
+
+    async def get_pending_nonce(self, sender, processor):
+        return await self.run(self.storage.get_pending_nonce, sender, processor)
+
+    async def get_latest_nonce(self, sender, processor):
+        return await self.run(self.storage.get_latest_nonce, sender, processor)
@@ -5,6 +5,7 @@ from contracting.client import ContractingClient
 
 from lamden.logger.base import get_logger
 import lamden
+from lamden.nodes import events
 import contracting
 import os
 import importlib
@@ -45,10 +46,22 @@ class UpgradeManager:
         self.votes = self.get(arguments=['votes'])
         self.voters = self.get(arguments=['voters'])
 
+        # Notified whenever the upgrade flag changes
+        self.upgrade_changed = events.Signal()
+
         self.upgrade = False
         self.testing = testing
         self.testing_flag = False
 
+    @property
+    def upgrade(self):
+        return self._upgrade
+
+    @upgrade.setter
+    def upgrade(self, upgrade):
+        self._upgrade = upgrade
+        self.upgrade_changed.notify()
+
     def refresh(self):
         self.locked = self.get(arguments=['locked'])
         self.consensus = self.get(arguments=['consensus'])
@@ -0,0 +1,312 @@
+import json
+import msgpack
+import zlib
+from contracting.db.encoder import encode, decode
+
+'''
+Router frames are either plain JSON text, which is what every node before the binary codec sends, or a version byte
+followed by the body. JSON always starts with a printable character, so a leading byte below 0x20 can only be a
+version byte. Its bits say whether the body is msgpack and whether it is zlib compressed.
+
+Large blocks are sent as streams: a multipart message whose frames all carry the BINARY | STREAM version byte. The
+message is flattened into tokens (the start of a map or list with its length, or a whole value) and the tokens are
+split over frames of about STREAM_CHUNK_SIZE bytes. Each frame is compressed on its own. The sender makes each frame
+as it is sent and the receiver decodes and drops each frame as it is read. ZMQ delivers a multipart message whole, so
+its compressed frames are still buffered by ZMQ until the last one is sent.
+
+Streams are only sent to peers that answered a STREAMED request in kind. Nodes that predate streams answer it in JSON.
+'''
+
+JSON = 0
+BINARY = 1
+
+COMPRESSED = 2
+STREAM = 4
+
+STREAMED = BINARY | STREAM
+
+CODECS = {JSON, BINARY, STREAMED}
+
+STREAM_CHUNK_SIZE = 256 * 1024
+
+# Maps and lists are only opened this many levels down. Below that, values such as single transactions are one token.
+STREAM_DEPTH = 6
+
+MAP_TOKEN = 0
+LIST_TOKEN = 1
+VALUE_TOKEN = 2
+
+COMPRESSION_LEVEL = 1
+
+# Upper bound for a decompressed frame so a bad frame cannot exhaust memory
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+
+class WireException(Exception):
+    pass
+
+# Values msgpack has no type for (decimals, datetimes, big ints) are stored as their contracting JSON encoding so both
+# codecs decode them to exactly the same objects
+CONTRACTING_EXT = 0
+
+
+def default(o):
+    return msgpack.ExtType(CONTRACTING_EXT, encode(o).encode())
+
+
+def ext_hook(code, data):
+    if code == CONTRACTING_EXT:
+        return decode(data.decode())
+    return msgpack.ExtType(code, data)
+
+
+def json_key(k):
+    # JSON turns these keys into strings and cannot encode any other kind
+    if isinstance(k, (int, float)) or k is None:
+        return json.dumps(k)
+
+    raise TypeError(f'Unsupported map key type {type(k).__name__}.')
+
+
+def object_hook(d):
+    # Map keys are strings after decoding, as they are with JSON
+    if not all(isinstance(k, str) for k in d):
+        d = {k if isinstance(k, str) else json_key(k): v for k, v in d.items()}
+
+    # Already encoded values such as {'__fixed__': '1.5'} in stored blocks are turned into objects, as JSON decoding does
+    if len(d) == 1:
+        key = next(iter(d))
+        if isinstance(key, str) and key.startswith('__') and key.endswith('__'):
+            return decode(encode(d))
+    return d
+
+
+def frame(header, body, compress_threshold=None):
+    # Only peers that speak the binary codec are sent compressed frames
+    if compress_threshold is not None and len(body) >= compress_threshold:
+        compressed = zlib.compress(body, COMPRESSION_LEVEL)
+
+        if len(compressed) < len(body):
+            header |= COMPRESSED
+            body = compressed
+
+    return bytes([header]) + body
+
+
+def pack(msg, codec=JSON, compress_threshold=None):
+    if not codec & BINARY:
+        return encode(msg).encode()
+
+    return frame(BINARY, msgpack.packb(msg, default=default, use_bin_type=True), compress_threshold)
+
+
+def tokens(o, depth=STREAM_DEPTH):
+    if depth > 0 and isinstance(o, dict):
+        yield [MAP_TOKEN, len(o)]
+        for k, v in o.items():
+            yield [VALUE_TOKEN, k]
+            yield from tokens(v, depth - 1)
+
+    elif depth > 0 and isinstance(o, (list, tuple)):
+        yield [LIST_TOKEN, len(o)]
+        for v in o:
+            yield from tokens(v, depth - 1)
+
+    else:
+        yield [VALUE_TOKEN, o]
+
+
+def pack_stream(msg, compress_threshold=None, chunk_size=STREAM_CHUNK_SIZE):
+    # Frames are made as they are asked for, so the sender only holds the one being sent
+    packer = msgpack.Packer(default=default, use_bin_type=True)
+
+    chunk = []
+    size = 0
+
+    for token in tokens(msg):
+        packed = packer.pack(token)
+        chunk.append(packed)
+        size += len(packed)
+
+        if size >= chunk_size:
+            yield frame(STREAMED, b''.join(chunk), compress_threshold)
+            chunk = []
+            size = 0
+
+    if len(chunk) > 0:
+        yield frame(STREAMED, b''.join(chunk), compress_threshold)
+
+
+def pack_frames(msg, codec=JSON, compress_threshold=None):
+    # Frames of one message. Streams are generated lazily and should be sent frame by frame.
+    if codec == STREAMED:
+        return pack_stream(msg, compress_threshold)
+
+    return [pack(msg, codec, compress_threshold)]
+
+
+def decompress(body):
+    d = zlib.decompressobj()
+
+    try:
+        body = d.decompress(body, MAX_FRAME_SIZE)
+    except zlib.error as e:
+        raise WireException(f'Bad compressed frame: {e}')
+
+    if d.unconsumed_tail:
+        raise WireException('Decompressed frame is too large.')
+
+    return body
+
+
+# Marks a map that is waiting for its next key
+NO_KEY = object()
+
+
+class StreamDecoder:
+    def __init__(self):
+        self.unpacker = msgpack.Unpacker(ext_hook=ext_hook, object_hook=object_hook, raw=False, strict_map_key=False,
+                                         max_buffer_size=MAX_FRAME_SIZE)
+
+        # [container, values still expected, key of the next map value]
+        self.stack = []
+
+        self.size = 0
+        self.done = False
+        self.msg = None
+
+    def feed(self, payload):
+        payload = memoryview(payload)
+
+        if len(payload) == 0 or payload[0] & ~COMPRESSED != STREAMED:
+            raise WireException('Bad stream frame.')
+
+        if self.done:
+            raise WireException('Stream continues after its message.')
+
+        body = payload[1:]
+        if payload[0] & COMPRESSED:
+            body = decompress(body)
+
+        self.size += len(body)
+        if self.size > MAX_FRAME_SIZE:
+            raise WireException('Stream is too large.')
+
+        self.unpacker.feed(body)
+
+        try:
+            for token in self.unpacker:
+                self.add(token)
+        except (ValueError, TypeError, msgpack.UnpackException) as e:
+            raise WireException(f'Bad stream: {e}')
+
+    def finish(self):
+        if not self.done:
+            raise WireException('Stream ended before its message.')
+
+        return self.msg, STREAMED
+
+    def add(self, token):
+        if not isinstance(token, list) or len(token) != 2:
+            raise WireException('Bad stream token.')
+
+        kind, value = token
+
+        if kind == VALUE_TOKEN:
+            self.put(value)
+
+        elif kind in (MAP_TOKEN, LIST_TOKEN) and isinstance(value, int) and value >= 0:
+            container = {} if kind == MAP_TOKEN else []
+
+            if value == 0:
+                self.put(container)
+            elif len(self.stack) >= STREAM_DEPTH:
+                raise WireException('Stream is nested too deeply.')
+            else:
+                self.stack.append([container, value, NO_KEY])
+
+        else:
+            raise WireException('Bad stream token.')
+
+    def put(self, value):
+        if self.done:
+            raise WireException('Stream continues after its message.')
+
+        if len(self.stack) == 0:
+            self.msg = object_hook(value) if isinstance(value, dict) else value
+            self.done = True
+            return
+
+        top = self.stack[-1]
+        container = top[0]
+
+        if isinstance(container, dict):
+            if top[2] is NO_KEY:
+                top[2] = value
+                return
+
+            container[top[2]] = value
+            top[2] = NO_KEY
+
+        else:
+            container.append(value)
+
+        top[1] -= 1
+
+        if top[1] == 0:
+            self.stack.pop()
+            self.put(object_hook(container) if isinstance(container, dict) else container)
+
+
+def unpack_frames(frames):
+    # Frames are decoded one at a time, so each one can be freed before the next is read
+    frames = iter(frames)
+    return unpack(next(frames), frames)
+
+
+def unpack(payload, more=()):
+    more = iter(more)
+
+    if not isinstance(payload, bytes):
+        payload = memoryview(payload)
+
+    if len(payload) == 0 or payload[0] >= 0x20:
+        if next(more, None) is not None:
+            raise WireException('Only streams can span several frames.')
+
+        if not isinstance(payload, bytes):
+            payload = bytes(payload)
+
+        try:
+            return decode(payload), JSON
+        except (ValueError, TypeError) as e:
+            raise WireException(f'Bad JSON frame: {e}')
+
+    header = payload[0]
+    body = memoryview(payload)[1:]
+
+    # Version bytes are only ever sent for msgpack bodies
+    if header & ~(BINARY | COMPRESSED | STREAM) or not header & BINARY:
+        raise WireException(f'Unknown frame version {header}.')
+
+    if header & STREAM:
+        decoder = StreamDecoder()
+        decoder.feed(payload)
+
+        for frame in more:
+            decoder.feed(frame)
+
+        return decoder.finish()
+
+    if next(more, None) is not None:
+        raise WireException('Only streams can span several frames.')
+
+    if header & COMPRESSED:
+        body = decompress(body)
+
+    try:
+        msg = msgpack.unpackb(body, ext_hook=ext_hook, object_hook=object_hook, raw=False, strict_map_key=False)
+    except (ValueError, TypeError, msgpack.UnpackException) as e:
+        raise WireException(f'Bad binary frame: {e}')
+
+    return msg, BINARY
@@ -16,6 +16,7 @@ setup(
         "coloredlogs",
         "pymongo",
         "pyzmq",
+        "msgpack",
         "requests",
         "contracting",
         "checksumdir",
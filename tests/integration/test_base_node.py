@@ -112,6 +112,78 @@ class TestNode(TestCase):
 
         self.assertEqual(storage.get_latest_block_height(node.driver), 3)
 
+    def test_catchup_multiple_ranges(self):
+        driver = ContractDriver(driver=InMemDriver())
+
+        mn_bootnode = 'tcp://127.0.0.1:18001'
+        mn_wallet = Wallet()
+        mn_router = router.Router(
+            socket_id=mn_bootnode,
+            ctx=self.ctx,
+            secure=True,
+            wallet=mn_wallet
+        )
+
+        mn_router.add_service(base.BLOCK_SERVICE, self.b)
+
+        nw = Wallet()
+        dlw = Wallet()
+        node = base.Node(
+            socket_base='tcp://127.0.0.1:18002',
+            ctx=self.ctx,
+            wallet=nw,
+            constitution={
+                'masternodes': [mn_wallet.verifying_key],
+                'delegates': [dlw.verifying_key]
+            },
+            driver=driver
+        )
+
+        self.authenticator.add_verifying_key(mn_wallet.verifying_key)
+        self.authenticator.add_verifying_key(nw.verifying_key)
+        self.authenticator.add_verifying_key(dlw.verifying_key)
+        self.authenticator.configure()
+
+        total = base.MAX_BLOCKS_PER_REQUEST * 2 + 5
+        for block in generate_blocks(total):
+            self.blocks.store_block(block)
+
+        storage.set_latest_block_height(total, self.driver)
+
+        tasks = asyncio.gather(
+            mn_router.serve(),
+            node.catchup('tcp://127.0.0.1:18001', mn_wallet.verifying_key),
+            stop_server(mn_router, 4)
+        )
+
+        self.loop.run_until_complete(tasks)
+
+        self.assertEqual(storage.get_latest_block_height(node.driver), total)
+
+    def test_pipelined_catchup_raises_when_no_peer_has_the_blocks(self):
+        node = base.Node(
+            socket_base='tcp://127.0.0.1:18002',
+            ctx=self.ctx,
+            wallet=Wallet(),
+            constitution={
+                'masternodes': [Wallet().verifying_key],
+                'delegates': [Wallet().verifying_key]
+            },
+            driver=ContractDriver(driver=InMemDriver())
+        )
+
+        async def request_blocks(start, end, peer):
+            return None
+
+        node.request_blocks = request_blocks
+
+        peers = [(Wallet().verifying_key, 'tcp://127.0.0.1:18001')]
+
+        with self.assertRaises(base.CatchupException):
+            self.loop.run_until_complete(node.pipelined_catchup(start=1, end=10, peers=peers))
+
+        self.assertEqual(storage.get_latest_block_height(node.driver), 0)
+
     def test_catchup_with_nbn_added(self):
         driver = ContractDriver(driver=InMemDriver())
 
@@ -291,7 +363,7 @@ class TestNode(TestCase):
             driver=driver
         )
 
-        node.process_new_block(block)
+        self.loop.run_until_complete(node.process_new_block(block))
 
         self.assertEqual(storage.get_latest_block_height(node.driver), 1)
         self.assertEqual(storage.get_latest_block_hash(node.driver), block['hash'])
@@ -317,12 +389,56 @@ class TestNode(TestCase):
             blocks=self.blocks,
         )
 
-        node.process_new_block(block)
+        self.loop.run_until_complete(node.process_new_block(block))
 
         b = node.blocks.get_block(1)
 
         self.assertEqual(b, block)
 
+    def test_process_new_block_changes_nothing_if_store_fails(self):
+        tx = {
+            'state': [{'key': 'currency.balances:stu', 'value': 100}],
+            'transaction': {'payload': {'sender': 'stu', 'processor': 'mn', 'nonce': 0}}
+        }
+
+        block = canonical.block_from_subblocks(
+            subblocks=[{'subblock': 0, 'transactions': [tx]}],
+            previous_hash='0' * 64,
+            block_num=1
+        )
+
+        class FailingBlocks:
+            async def store_block(self, block):
+                raise storage.OperationFailure('disk full')
+
+        nonces = storage.NonceStorage()
+        nonces.flush()
+
+        driver = ContractDriver(driver=InMemDriver())
+        node = base.Node(
+            socket_base='tcp://127.0.0.1:18002',
+            ctx=self.ctx,
+            wallet=Wallet(),
+            constitution={
+                'masternodes': [Wallet().verifying_key],
+                'delegates': [Wallet().verifying_key]
+            },
+            driver=driver,
+            store=True,
+            blocks=self.blocks,
+            nonces=nonces
+        )
+
+        node.async_blocks = FailingBlocks()
+
+        with self.assertRaises(storage.OperationFailure):
+            self.loop.run_until_complete(node.process_new_block(block))
+
+        self.assertEqual(storage.get_latest_block_height(node.driver), 0)
+        self.assertEqual(storage.get_latest_block_hash(node.driver), '0' * 64)
+        self.assertIsNone(node.driver.driver.get('currency.balances:stu'))
+        self.assertIsNone(nonces.get_nonce(sender='stu', processor='mn'))
+
     def test_process_new_block_clears_cache(self):
         block = canonical.block_from_subblocks(
             subblocks=[],
@@ -346,7 +462,7 @@ class TestNode(TestCase):
 
         node.driver.cache['test'] = 123
 
-        node.process_new_block(block)
+        self.loop.run_until_complete(node.process_new_block(block))
 
         self.assertIsNone(node.driver.cache.get('test'))
 
@@ -372,7 +488,7 @@ class TestNode(TestCase):
         node.new_block_processor.q.append(blocks[0])
         node.new_block_processor.q.append(blocks[1])
 
-        node.process_new_block(blocks[0])
+        self.loop.run_until_complete(node.process_new_block(blocks[0]))
 
         block = node.new_block_processor.q[0]
 
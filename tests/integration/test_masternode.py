@@ -7,6 +7,7 @@ from contracting.db.driver import InMemDriver, ContractDriver
 from contracting.client import ContractingClient
 import zmq.asyncio
 import asyncio
+import time
 
 from unittest import TestCase
 
@@ -90,6 +91,7 @@ class TestMasternode(TestCase):
         async def late_tx(timeout=0.2):
             await asyncio.sleep(timeout)
             node.tx_batcher.queue.append('MOCK TX')
+            node.webserver.new_tx.notify()
 
         tasks = asyncio.gather(
             node.hang(),
@@ -116,6 +118,7 @@ class TestMasternode(TestCase):
         async def late_tx(timeout=0.2):
             await asyncio.sleep(timeout)
             node.new_block_processor.q.append('MOCK BLOCK')
+            node.new_block_processor.new_block.notify()
 
         tasks = asyncio.gather(
             node.hang(),
@@ -331,6 +334,36 @@ class TestMasternode(TestCase):
 
         self.assertFalse(r)
 
+    def test_send_work_waits_for_upgrade(self):
+        driver = ContractDriver(driver=InMemDriver())
+        node = masternode.Masternode(
+            socket_base='tcp://127.0.0.1:18003',
+            ctx=self.ctx,
+            wallet=Wallet(),
+            constitution={
+                'masternodes': [Wallet().verifying_key],
+                'delegates': [Wallet().verifying_key]
+            },
+            driver=driver
+        )
+
+        node.running = True
+        node.upgrade_manager.upgrade = True
+
+        async def finish_upgrade():
+            await asyncio.sleep(0.2)
+            node.upgrade_manager.upgrade = False
+            return time.time()
+
+        async def send():
+            r = await node.send_work()
+            return r, time.time()
+
+        finished, (r, sent) = self.loop.run_until_complete(asyncio.gather(finish_upgrade(), send()))
+
+        self.assertFalse(r)
+        self.assertGreaterEqual(sent, finished)
+
     def test_send_work_multicasts_tx_batch_to_delegates(self):
         ips = [
             'tcp://127.0.0.1:18001',
@@ -458,6 +491,7 @@ class TestMasternode(TestCase):
         async def late_tx(timeout=0.2):
             await asyncio.sleep(timeout)
             node.tx_batcher.queue.append('MOCK TX')
+            node.webserver.new_tx.notify()
 
         async def late_kill(timeout=1):
             node.running = False
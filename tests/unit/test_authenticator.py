@@ -1,8 +1,11 @@
 from unittest import TestCase
 import zmq.asyncio
 from lamden.crypto.wallet import Wallet
-from lamden.authentication import SocketAuthenticator
+from lamden.authentication import SocketAuthenticator, KeyRegistry
 import os
+import pathlib
+import shutil
+import tempfile
 from nacl.signing import SigningKey
 from lamden.contracts import sync
 import lamden
@@ -99,3 +102,98 @@ class TestAuthenticator(TestCase):
         self.assertTrue(os.path.exists(os.path.join(s.cert_dir, f'{w1.verifying_key}.key')))
         self.assertTrue(os.path.exists(os.path.join(s.cert_dir, f'{w2.verifying_key}.key')))
         self.assertTrue(os.path.exists(os.path.join(s.cert_dir, f'{w3.verifying_key}.key')))
+
+    def test_add_verifying_key_adds_to_registry(self):
+        s = SocketAuthenticator(client=self.c, ctx=self.ctx)
+
+        w = Wallet()
+        s.add_verifying_key(w.verifying_key)
+        s.authenticator.stop()
+
+        key = s.keys.get(w.verifying_key)
+
+        self.assertIsNotNone(key)
+        self.assertTrue(s.keys.callback('*', key))
+
+    def test_refresh_governance_sockets_removes_old_keys(self):
+        s = SocketAuthenticator(client=self.c, ctx=self.ctx)
+
+        w = Wallet()
+        s.add_verifying_key(w.verifying_key)
+        key = s.keys.get(w.verifying_key)
+
+        s.refresh_governance_sockets()
+        s.authenticator.stop()
+
+        self.assertIsNone(s.keys.get(w.verifying_key))
+        self.assertFalse(s.keys.callback('*', key))
+        self.assertFalse(os.path.exists(os.path.join(s.cert_dir, f'{w.verifying_key}.key')))
+
+        for m in self.masternodes:
+            self.assertIsNotNone(s.keys.get(m))
+
+    def test_registry_loads_persisted_keys(self):
+        s = SocketAuthenticator(client=self.c, ctx=self.ctx)
+
+        w = Wallet()
+        s.add_verifying_key(w.verifying_key)
+        s.authenticator.stop()
+
+        registry = KeyRegistry(s.cert_dir)
+
+        self.assertEqual(registry.get(w.verifying_key), s.keys.get(w.verifying_key))
+
+    def test_registry_skips_files_not_named_after_keys(self):
+        cert_dir = tempfile.mkdtemp()
+        w = Wallet()
+
+        for name in ['abc', 'zz', 'ab', '', w.verifying_key]:
+            pathlib.Path(cert_dir, f'{name}.key').touch()
+
+        registry = KeyRegistry(cert_dir)
+        shutil.rmtree(cert_dir)
+
+        self.assertEqual(list(registry.keys), [w.verifying_key])
+
+    def test_refresh_with_block_without_member_writes_is_skipped(self):
+        s = SocketAuthenticator(client=self.c, ctx=self.ctx)
+        s.refresh_governance_sockets()
+
+        new_mn = Wallet().verifying_key
+        self.c.set_var(
+            contract='masternodes',
+            variable='S',
+            arguments=['members'],
+            value=self.masternodes + [new_mn]
+        )
+
+        block = {'subblocks': [{'transactions': [{'state': [{'key': 'currency.balances:stu', 'value': 1}]}]}]}
+
+        members = s.refresh_governance_sockets(block=block)
+        s.authenticator.stop()
+
+        self.assertEqual(members, self.masternodes + self.delegates)
+        self.assertIsNone(s.keys.get(new_mn))
+
+    def test_refresh_with_member_writes_applies_diff(self):
+        s = SocketAuthenticator(client=self.c, ctx=self.ctx)
+        s.refresh_governance_sockets()
+
+        new_mn = Wallet().verifying_key
+        new_members = self.masternodes[1:] + [new_mn]
+        self.c.set_var(
+            contract='masternodes',
+            variable='S',
+            arguments=['members'],
+            value=new_members
+        )
+
+        block = {'subblocks': [{'transactions': [{'state': [{'key': 'masternodes.S:members', 'value': new_members}]}]}]}
+
+        members = s.refresh_governance_sockets(block=block)
+        s.authenticator.stop()
+
+        self.assertEqual(members, new_members + self.delegates)
+        self.assertIsNotNone(s.keys.get(new_mn))
+        self.assertIsNone(s.keys.get(self.masternodes[0]))
+        self.assertFalse(os.path.exists(os.path.join(s.cert_dir, f'{self.masternodes[0]}.key')))
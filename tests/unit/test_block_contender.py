@@ -6,6 +6,7 @@ from lamden.crypto.wallet import Wallet
 from lamden.nodes.masternode import contender
 import asyncio
 import secrets
+import time
 
 from decimal import Decimal
 
@@ -52,7 +53,7 @@ class MockSBC:
             'subblock': self.subBlockNum,
             'signer': self.signer,
             'transactions': [],
-            'previous': secrets.token_hex(8)
+            'previous': '0' * 64
         }
 
 
@@ -560,7 +561,102 @@ class TestAggregator(TestCase):
         self.assertNotEqual(res['hash'], 'f' * 64)
 
 
+    def test_gather_subblocks_stops_once_live_delegates_answered(self):
+        a = contender.Aggregator(driver=ContractDriver(), seconds_to_timeout=5)
+
+        c1 = [MockSBC('input_1', 'res_1', 0).to_dict(),
+              MockSBC('input_2', 'res_2', 1).to_dict(),
+              MockSBC('input_3', 'res_3', 2).to_dict(),
+              MockSBC('input_4', 'res_4', 3).to_dict()]
+
+        a.sbc_inbox.q = [c1]
+
+        started = time.time()
+        res = self.loop.run_until_complete(a.gather_subblocks(2, live=['a'], adequate_ratio=0.3))
+
+        self.assertLess(time.time() - started, 1)
+        self.assertEqual(res['subblocks'][0]['merkle_leaves'][0], 'res_1')
+
+    def test_straggler_wait_is_full_timeout_without_samples(self):
+        a = contender.Aggregator(driver=ContractDriver(), seconds_to_timeout=6)
+        a.delays['a'].extend([0.1] * contender.MIN_RESPONSE_SAMPLES)
+
+        self.assertEqual(a.straggler_wait(['a', 'b']), 6)
+        self.assertEqual(a.straggler_wait(None), 6)
+
+    def test_straggler_wait_follows_slowest_delegate(self):
+        a = contender.Aggregator(driver=ContractDriver(), seconds_to_timeout=6, min_straggler_wait=0.1)
+        a.delays['a'].extend([0.1] * 10)
+        a.delays['b'].extend([1] * 10)
+
+        self.assertAlmostEqual(a.straggler_wait(['a', 'b']), 1 * contender.TIMEOUT_SLACK)
+        self.assertAlmostEqual(a.straggler_wait(['a']), 0.1 * contender.TIMEOUT_SLACK)
+
+        a.delays['b'].extend([10] * 10)
+        self.assertEqual(a.straggler_wait(['a', 'b']), 6)
+
+    def test_end_round_records_late_contenders(self):
+        a = contender.Aggregator(driver=ContractDriver())
+
+        a.round = 'h'
+        a.first = 100
+        a.sbc_inbox.arrivals['h'] = {'a': 100, 'b': 102.5}
+        a.sbc_inbox.arrivals['next'] = {'a': 103}
+
+        a.end_round()
+
+        self.assertEqual(list(a.delays['a']), [0])
+        self.assertEqual(list(a.delays['b']), [2.5])
+        self.assertEqual(dict(a.sbc_inbox.arrivals), {'next': {'a': 103}})
+        self.assertIsNone(a.first)
+
+    def test_contenders_for_other_blocks_are_ignored(self):
+        a = contender.Aggregator(driver=ContractDriver(), seconds_to_timeout=5)
+
+        late = [MockSBC('input_1', 'res_X', 0).to_dict()]
+        late[0]['previous'] = 'a' * 64
+
+        current = [MockSBC('input_1', 'res_1', 0).to_dict()]
+
+        a.sbc_inbox.q = [late, current]
+        a.sbc_inbox.arrivals['a' * 64] = {late[0]['signer']: time.time() - 10}
+        a.sbc_inbox.arrivals['0' * 64] = {current[0]['signer']: time.time()}
+
+        res = self.loop.run_until_complete(
+            a.gather_subblocks(2, live=[current[0]['signer']], adequate_ratio=0.3, expected_subblocks=1)
+        )
+
+        self.assertEqual(res['subblocks'][0]['merkle_leaves'][0], 'res_1')
+        self.assertEqual(res['subblocks'][0]['signatures'][0]['signer'], current[0]['signer'])
+        self.assertAlmostEqual(a.first, time.time(), delta=1)
+        self.assertNotIn('a' * 64, a.sbc_inbox.arrivals)
+
+
 class TestSBCProcessor(TestCase):
+    def test_arrival_is_when_contender_was_received(self):
+        s = contender.SBCInbox(expected_subblocks=1)
+        sbcs = [MockSBC('input_1', 'res_1', 0).to_dict()]
+
+        s.received(sbcs)
+        received = time.time()
+        time.sleep(0.2)
+
+        asyncio.new_event_loop().run_until_complete(s.apply(sbcs, True))
+
+        self.assertLessEqual(s.arrivals['0' * 64][sbcs[0]['signer']], received)
+        self.assertEqual(s.receipts, {})
+
+    def test_invalid_contender_leaves_no_arrival(self):
+        s = contender.SBCInbox(expected_subblocks=1)
+        sbcs = [MockSBC('input_1', 'res_1', 0).to_dict()]
+
+        s.received(sbcs)
+        asyncio.new_event_loop().run_until_complete(s.apply(sbcs, False))
+
+        self.assertEqual(dict(s.arrivals), {})
+        self.assertEqual(s.receipts, {})
+        self.assertEqual(s.q, [])
+
     def test_subblock_with_bad_sb_idx_returns_false(self):
         sbc = {
             'subblock': 1
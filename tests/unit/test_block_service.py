@@ -120,6 +120,58 @@ class TestBlockService(TestCase):
 
         self.assertIsNone(res)
 
+    def test_service_returns_blocks_for_range(self):
+        for i in range(1, 6):
+            self.b.blocks.store_block({
+                'hash': str(i) * 64,
+                'number': i,
+                'previous': '0' * 64,
+                'subblocks': []
+            })
+
+        msg = {
+            'name': base.GET_BLOCKS,
+            'arg': {
+                'start': 2,
+                'end': 4
+            }
+        }
+
+        res = self.loop.run_until_complete(self.b.process_message(msg))
+
+        self.assertEqual([b['number'] for b in res], [2, 3, 4])
+
+    def test_service_truncates_large_ranges(self):
+        for i in range(1, base.MAX_BLOCKS_PER_REQUEST + 5):
+            self.b.blocks.store_block({
+                'hash': f'{i:064x}',
+                'number': i,
+                'previous': '0' * 64,
+                'subblocks': []
+            })
+
+        msg = {
+            'name': base.GET_BLOCKS,
+            'arg': {
+                'start': 1,
+                'end': base.MAX_BLOCKS_PER_REQUEST + 5
+            }
+        }
+
+        res = self.loop.run_until_complete(self.b.process_message(msg))
+
+        self.assertEqual(len(res), base.MAX_BLOCKS_PER_REQUEST)
+
+    def test_service_returns_none_if_range_malformed(self):
+        msg = {
+            'name': base.GET_BLOCKS,
+            'arg': 5
+        }
+
+        res = self.loop.run_until_complete(self.b.process_message(msg))
+
+        self.assertIsNone(res)
+
     def test_get_latest_block_height(self):
         storage.set_latest_block_height(1337, self.b.driver)
 
@@ -252,3 +304,53 @@ class TestBlockService(TestCase):
         _, res, _ = self.loop.run_until_complete(tasks)
 
         self.assertDictEqual(res, router.OK)
+
+    def test_router_returns_blocks_for_range(self):
+        blocks = []
+        for i in range(1, 4):
+            block = {
+                'hash': str(i) * 64,
+                'number': i,
+                'previous': '0' * 64,
+                'subblocks': []
+            }
+            self.b.blocks.store_block(block)
+            blocks.append(block)
+
+        vk = Wallet()
+        w = Wallet()
+
+        self.authenticator.add_verifying_key(vk.verifying_key)
+        self.authenticator.add_verifying_key(w.verifying_key)
+        self.authenticator.configure()
+
+        mn_bootnode = 'tcp://127.0.0.1:18001'
+        mn_router = router.Router(
+            socket_id=mn_bootnode,
+            ctx=self.ctx,
+            secure=True,
+            wallet=vk
+        )
+
+        mn_router.add_service(base.BLOCK_SERVICE, self.b)
+
+        async def send_msg():
+            res = await base.get_blocks(
+                start=1,
+                end=3,
+                ip=mn_bootnode,
+                vk=vk.verifying_key,
+                wallet=w,
+                ctx=self.ctx
+            )
+            return res
+
+        tasks = asyncio.gather(
+            mn_router.serve(),
+            send_msg(),
+            stop_server(mn_router, 1)
+        )
+
+        _, res, _ = self.loop.run_until_complete(tasks)
+
+        self.assertEqual(res, blocks)
@@ -31,3 +31,71 @@ class TestCanonicalCoding(TestCase):
         s = canonical.format_dictionary(unsorted)
 
         self.assertDictEqual(s, sorted_dict)
+
+
+def make_contender(index, results, signer='a' * 64):
+    leaves = canonical.merklize([r.encode() for r in results])
+
+    return {
+        'input_hash': str(index) * 64,
+        'transactions': results,
+        'merkle_tree': {
+            'leaves': leaves,
+            'signature': 'sig'
+        },
+        'signer': signer,
+        'subblock': index,
+        'previous': '0' * 64
+    }
+
+
+def make_block(contenders):
+    # The aggregator's view of the same contenders, signed by two delegates
+    subblocks = [{
+        'input_hash': sbc['input_hash'],
+        'transactions': sbc['transactions'],
+        'merkle_leaves': sbc['merkle_tree']['leaves'],
+        'subblock': sbc['subblock'],
+        'signatures': [{'signature': 'sig', 'signer': 'a' * 64}, {'signature': 'sig', 'signer': 'b' * 64}]
+    } for sbc in contenders]
+
+    return canonical.block_from_subblocks(subblocks, previous_hash='0' * 64, block_num=1)
+
+
+class TestCompactBlocks(TestCase):
+    def test_compact_block_has_no_transactions(self):
+        block = make_block([make_contender(0, ['tx1', 'tx2'])])
+
+        compact = canonical.compact_block(block)
+
+        self.assertNotIn('transactions', compact['subblocks'][0])
+        self.assertEqual(compact['subblocks'][0]['merkle_root'], block['subblocks'][0]['merkle_leaves'][0])
+
+    def test_block_from_compact_rebuilds_block(self):
+        contenders = [make_contender(0, ['tx1', 'tx2']), make_contender(1, ['tx3'])]
+        block = make_block(contenders)
+
+        rebuilt = canonical.block_from_compact(canonical.compact_block(block), contenders)
+
+        self.assertDictEqual(rebuilt, block)
+
+    def test_block_from_compact_with_other_results_returns_none(self):
+        block = make_block([make_contender(0, ['tx1', 'tx2'])])
+
+        ours = [make_contender(0, ['tx1', 'tx3'])]
+
+        self.assertIsNone(canonical.block_from_compact(canonical.compact_block(block), ours))
+
+    def test_block_from_compact_missing_subblock_returns_none(self):
+        contenders = [make_contender(0, ['tx1']), make_contender(1, ['tx2'])]
+        block = make_block(contenders)
+
+        self.assertIsNone(canonical.block_from_compact(canonical.compact_block(block), contenders[:1]))
+
+    def test_block_from_compact_with_wrong_hash_returns_none(self):
+        contenders = [make_contender(0, ['tx1'])]
+
+        compact = canonical.compact_block(make_block(contenders))
+        compact['hash'] = 'f' * 64
+
+        self.assertIsNone(canonical.block_from_compact(compact, contenders))
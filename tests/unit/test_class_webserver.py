@@ -7,6 +7,7 @@ from contracting.db.driver import ContractDriver, decode, encode
 from lamden.storage import BlockStorage
 from lamden.crypto.transaction import build_transaction
 from lamden import storage
+from lamden.journal import StateJournal
 
 n = ContractDriver()
 
@@ -39,6 +40,13 @@ class TestClassWebserver(TestCase):
         _, response = self.ws.app.test_client.get('/id')
         self.assertDictEqual(response.json, {'verifying_key': self.w.verifying_key})
 
+    def test_get_pool_stats(self):
+        self.ws.blocks.get_block(1)
+
+        _, response = self.ws.app.test_client.get('/pool_stats')
+
+        self.assertGreater(response.json['localhost:27017']['checked_out'], 0)
+
     def test_get_nonce_pending_nonce_is_none_returns_0(self):
         w2 = Wallet()
         _, response = self.ws.app.test_client.get('/nonce/{}'.format(w2.verifying_key))
@@ -268,6 +276,59 @@ def get():
 
         self.assertDictEqual(response.json, {'value': None})
 
+    def test_get_variable_at_height_without_journal_returns_error(self):
+        code = '''
+v = Variable()
+
+@construct
+def seed():
+    v.set(12345)
+        '''
+
+        self.ws.client.submit(f=code, name='testing')
+
+        _, response = self.ws.app.test_client.get('/contracts/testing/v?height=1')
+
+        self.assertDictEqual(response.json, {'error': 'Historical reads are not enabled on this node. It has to run with the state journal.'})
+
+    def test_get_variable_at_height_returns_journaled_value(self):
+        code = '''
+v = Variable()
+
+@construct
+def seed():
+    v.set(12345)
+        '''
+
+        self.ws.client.submit(f=code, name='testing')
+
+        journal = StateJournal()
+        journal.prune_after(-1)
+
+        self.ws.journal = journal
+        self.ws.async_journal = storage.AsyncStorage(journal)
+
+        storage.set_latest_block_height(1, self.ws.driver)
+
+        block = {'number': 2, 'hash': 'a' * 64}
+        journal.begin_block(block, driver=self.ws.client.raw_driver, nonces=self.ws.nonces)
+        self.ws.client.raw_driver.driver.set('testing.v', 54321)
+        storage.set_latest_block_height(2, self.ws.driver)
+        journal.end_block(block, driver=self.ws.client.raw_driver)
+
+        _, response = self.ws.app.test_client.get('/contracts/testing/v?height=1')
+        self.assertDictEqual(response.json, {'value': 12345})
+
+        _, response = self.ws.app.test_client.get('/contracts/testing/v')
+        self.assertDictEqual(response.json, {'value': 54321})
+
+        _, response = self.ws.app.test_client.get('/contracts/testing/v?height=0')
+        self.assertDictEqual(response.json, {
+            'error': 'State at block #0 is not journaled. This node has state history from block #1.'
+        })
+
+        journal.prune_after(-1)
+
     def test_get_latest_block(self):
         block = {
             'hash': 'a',
@@ -340,6 +401,26 @@ def get():
         _, response = self.ws.app.test_client.get(f'/blocks?hash={h}')
         self.assertDictEqual(response.json, expected)
 
+    def test_get_blocks_range(self):
+        for i in range(1, 6):
+            self.ws.blocks.put({'hash': str(i), 'number': i, 'subblocks': []})
+
+        _, response = self.ws.app.test_client.get('/blocks/range?start=2&end=4')
+
+        self.assertEqual([b['number'] for b in response.json['blocks']], [2, 3, 4])
+
+    def test_get_blocks_range_headers_only(self):
+        self.ws.blocks.put({'hash': '1', 'number': 1, 'previous': '0', 'subblocks': []})
+
+        _, response = self.ws.app.test_client.get('/blocks/range?start=1&end=1&projection=headers')
+
+        self.assertDictEqual(response.json, {'blocks': [{'hash': '1', 'number': 1, 'previous': '0'}]})
+
+    def test_get_blocks_range_no_start_returns_error(self):
+        _, response = self.ws.app.test_client.get('/blocks/range')
+
+        self.assertDictEqual(response.json, {'error': 'No valid start or end provided.'})
+
     def test_get_block_by_hash_that_doesnt_exist_returns_error(self):
         _, response = self.ws.app.test_client.get('/blocks?hash=zzz')
         self.assertDictEqual(response.json, {'error': 'Block not found.'})
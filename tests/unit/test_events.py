@@ -0,0 +1,78 @@
+from unittest import TestCase
+
+from lamden.nodes import events
+import asyncio
+import time
+
+
+class TestEvents(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_wait_for_returns_when_signalled(self):
+        q = []
+        signal = events.Signal()
+
+        async def fill():
+            await asyncio.sleep(0.05)
+            q.append(1)
+            signal.notify()
+            return time.time()
+
+        async def wait():
+            await events.wait_for(lambda: len(q) > 0, signal)
+            return time.time()
+
+        filled, woke = self.loop.run_until_complete(asyncio.gather(fill(), wait()))
+
+        # Woken by the signal itself
+        self.assertLess(woke - filled, 0.05)
+
+    def test_wait_for_true_condition_returns_immediately(self):
+        self.assertTrue(self.loop.run_until_complete(events.wait_for(lambda: True, events.Signal(), timeout=0)))
+
+    def test_wait_for_times_out(self):
+        start = time.time()
+        done = self.loop.run_until_complete(events.wait_for(lambda: False, events.Signal(), timeout=0.2))
+
+        self.assertFalse(done)
+        self.assertGreaterEqual(time.time() - start, 0.2)
+
+    def test_wait_for_does_not_poll(self):
+        q = []
+        signal = events.Signal()
+
+        async def fill():
+            await asyncio.sleep(0.05)
+            q.append(1)
+
+        async def wait():
+            start = time.time()
+            await events.wait_for(lambda: len(q) > 0, signal, timeout=0.3)
+            return time.time() - start
+
+        _, waited = self.loop.run_until_complete(asyncio.gather(fill(), wait()))
+
+        # The change was never signalled, so the waiter only saw it once it timed out
+        self.assertGreaterEqual(waited, 0.3)
+
+    def test_notify_wakes_every_waiter(self):
+        ready = []
+        signal = events.Signal()
+
+        async def wait():
+            return await events.wait_for(lambda: len(ready) > 0, signal, timeout=1)
+
+        async def notify():
+            await asyncio.sleep(0.05)
+            ready.append(True)
+            signal.notify()
+
+        res = self.loop.run_until_complete(asyncio.gather(wait(), wait(), notify()))
+
+        self.assertEqual(res[:2], [True, True])
+        self.assertEqual(len(signal.waiters), 0)
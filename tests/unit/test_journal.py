@@ -0,0 +1,184 @@
+from unittest import TestCase
+
+from contracting.db.driver import ContractDriver, InMemDriver
+
+from lamden import storage
+from lamden.journal import StateJournal, JournalDriver, JournalException
+
+
+def make_block(number, h, writes, sender='stu', nonce=0):
+    return {
+        'number': number,
+        'hash': h,
+        'subblocks': [
+            {
+                'transactions': [
+                    {
+                        'hash': h,
+                        'transaction': {
+                            'payload': {
+                                'sender': sender,
+                                'processor': 'mn',
+                                'nonce': nonce
+                            }
+                        },
+                        'state': [{'key': k, 'value': v} for k, v in writes.items()]
+                    }
+                ]
+            }
+        ]
+    }
+
+
+class TestStateJournal(TestCase):
+    def setUp(self):
+        self.driver = ContractDriver(driver=InMemDriver())
+        self.nonces = storage.NonceStorage()
+        self.journal = StateJournal(max_blocks=10)
+
+        self.nonces.flush()
+        self.journal.prune_after(-1)
+
+        storage.set_latest_block_hash('0' * 64, self.driver)
+        storage.set_latest_block_height(0, self.driver)
+
+    def tearDown(self):
+        self.nonces.flush()
+        self.journal.prune_after(-1)
+
+    def apply(self, block):
+        self.journal.begin_block(block, driver=self.driver, nonces=self.nonces)
+        storage.update_state_with_block(block, driver=self.driver, nonces=self.nonces)
+        self.driver.commit()
+        self.journal.end_block(block, driver=self.driver)
+
+    def test_attach_wraps_driver_once(self):
+        self.journal.attach(self.driver)
+        self.journal.attach(self.driver)
+
+        self.assertIsInstance(self.driver.driver, JournalDriver)
+        self.assertNotIsInstance(self.driver.driver.driver, JournalDriver)
+
+    def test_end_block_records_previous_values(self):
+        self.driver.driver.set('currency.balances:stu', 100)
+
+        self.apply(make_block(1, 'a' * 64, {'currency.balances:stu': 90, 'currency.balances:jeff': 10}))
+
+        writes = {w['key']: w['value'] for w in self.journal.writes.find({'number': 1})}
+
+        self.assertEqual(writes['currency.balances:stu'], '100')
+        self.assertEqual(writes['currency.balances:jeff'], 'null')
+        self.assertEqual(writes[storage.BLOCK_NUM_HEIGHT], '0')
+
+    def test_end_block_without_begin_does_nothing(self):
+        self.journal.attach(self.driver)
+        self.journal.end_block(make_block(1, 'a' * 64, {}), driver=self.driver)
+
+        self.assertIsNone(self.journal.blocks.find_one({'number': 1}))
+
+    def test_rollback_restores_state_nonces_and_height(self):
+        self.driver.driver.set('currency.balances:stu', 100)
+
+        self.apply(make_block(1, 'a' * 64, {'currency.balances:stu': 90}, nonce=0))
+        self.apply(make_block(2, 'b' * 64, {'currency.balances:stu': 80, 'currency.balances:jeff': 10}, nonce=1))
+        self.apply(make_block(3, 'c' * 64, {'currency.balances:stu': 70}, nonce=2))
+
+        self.assertTrue(self.journal.rollback_to(1, driver=self.driver, nonces=self.nonces))
+
+        self.assertEqual(self.driver.driver.get('currency.balances:stu'), 90)
+        self.assertIsNone(self.driver.driver.get('currency.balances:jeff'))
+        self.assertEqual(self.nonces.get_nonce(sender='stu', processor='mn'), 1)
+        self.assertEqual(storage.get_latest_block_height(self.driver), 1)
+        self.assertEqual(storage.get_latest_block_hash(self.driver), 'a' * 64)
+
+        self.assertIsNone(self.journal.blocks.find_one({'number': 2}))
+
+    def test_writes_committed_through_contract_driver_are_journaled(self):
+        self.driver.driver.set('currency.balances:mn', 10)
+        self.driver.driver.set('currency.balances:dev', 5)
+
+        block = make_block(1, 'a' * 64, {'currency.balances:stu': 90})
+
+        self.journal.begin_block(block, driver=self.driver, nonces=self.nonces)
+        storage.update_state_with_block(block, driver=self.driver, nonces=self.nonces)
+
+        # Rewards are pending writes of the contract driver and only reach the state driver on commit
+        self.driver.set('currency.balances:mn', 15)
+        self.driver.set('currency.balances:dev', None)
+        self.driver.commit()
+
+        self.journal.end_block(block, driver=self.driver)
+
+        self.assertEqual(self.driver.driver.get('currency.balances:mn'), 15)
+
+        self.assertTrue(self.journal.rollback_to(0, driver=self.driver, nonces=self.nonces))
+
+        self.assertEqual(self.driver.driver.get('currency.balances:mn'), 10)
+        self.assertEqual(self.driver.driver.get('currency.balances:dev'), 5)
+        self.assertIsNone(self.driver.driver.get('currency.balances:stu'))
+
+    def test_rollback_to_current_height_returns_false(self):
+        self.apply(make_block(1, 'a' * 64, {'currency.balances:stu': 90}))
+
+        self.assertFalse(self.journal.rollback_to(1, driver=self.driver, nonces=self.nonces))
+
+    def test_rollback_past_journal_returns_false_and_leaves_state(self):
+        self.apply(make_block(1, 'a' * 64, {'currency.balances:stu': 90}))
+        self.apply(make_block(2, 'b' * 64, {'currency.balances:stu': 80}))
+
+        self.journal.prune(1)
+
+        self.assertFalse(self.journal.rollback_to(0, driver=self.driver, nonces=self.nonces))
+
+        self.assertEqual(self.driver.driver.get('currency.balances:stu'), 80)
+        self.assertEqual(storage.get_latest_block_height(self.driver), 2)
+
+    def test_old_blocks_are_pruned(self):
+        for i in range(1, 16):
+            self.apply(make_block(i, str(i) * 64, {'currency.balances:stu': i}))
+
+        self.assertEqual(self.journal.earliest_height(), 6)
+
+    def test_every_block_is_kept_without_max_blocks(self):
+        self.journal = StateJournal()
+
+        for i in range(1, 16):
+            self.apply(make_block(i, str(i) * 64, {'currency.balances:stu': i}))
+
+        self.assertEqual(self.journal.earliest_height(), 1)
+
+    def test_read_before_history_names_the_limit(self):
+        for i in range(1, 16):
+            self.apply(make_block(i, str(i) * 64, {'currency.balances:stu': i}))
+
+        with self.assertRaises(JournalException) as e:
+            self.driver.driver.get_at_height('currency.balances:stu', 2)
+
+        self.assertEqual(
+            str(e.exception),
+            'State at block #2 is not journaled. This node has state history from block #5 and keeps the last 10 blocks.'
+        )
+
+    def test_get_at_height_returns_value_before_later_writes(self):
+        self.driver.driver.set('currency.balances:stu', 100)
+
+        self.apply(make_block(1, 'a' * 64, {'currency.balances:stu': 90}))
+        self.apply(make_block(2, 'b' * 64, {'currency.balances:jeff': 10}))
+        self.apply(make_block(3, 'c' * 64, {'currency.balances:stu': 70}))
+
+        self.assertEqual(self.driver.driver.get_at_height('currency.balances:stu', 0), 100)
+        self.assertEqual(self.driver.driver.get_at_height('currency.balances:stu', 1), 90)
+        self.assertEqual(self.driver.driver.get_at_height('currency.balances:stu', 2), 90)
+        self.assertEqual(self.driver.driver.get_at_height('currency.balances:stu', 3), 70)
+
+        self.assertIsNone(self.driver.driver.get_at_height('currency.balances:jeff', 1))
+        self.assertEqual(self.driver.driver.get_at_height('currency.balances:jeff', 2), 10)
+
+    def test_get_at_height_before_journal_raises(self):
+        self.apply(make_block(1, 'a' * 64, {'currency.balances:stu': 90}))
+        self.apply(make_block(2, 'b' * 64, {'currency.balances:stu': 80}))
+
+        self.journal.prune(1)
+
+        with self.assertRaises(JournalException):
+            self.driver.driver.get_at_height('currency.balances:stu', 0)
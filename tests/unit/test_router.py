@@ -1,10 +1,12 @@
 from unittest import TestCase
 
-from lamden import router, authentication
+from lamden import router, authentication, wire
 
 from lamden.crypto.wallet import Wallet
 import zmq.asyncio
 import asyncio
+import threading
+import time
 from contracting.db.encoder import encode, decode
 from contracting.client import ContractingClient
 
@@ -225,6 +227,216 @@ class TestRouter(TestCase):
         self.assertDictEqual(res[1], expected_msg)
 
 
+    def test_overloaded_service_replies_busy(self):
+        r = router.Router(socket_id='ipc:///tmp/router', ctx=self.ctx, linger=50, workers=1, max_queued=1)
+
+        class SlowProcessor(router.Processor):
+            async def process_message(self, msg):
+                await asyncio.sleep(0.5)
+                return {
+                    'done': msg['i']
+                }
+
+        r.add_service('test', SlowProcessor())
+
+        async def request():
+            socket = self.ctx.socket(zmq.DEALER)
+            socket.connect('ipc:///tmp/router')
+
+            for i in range(3):
+                await socket.send(encode({'service': 'test', 'msg': {'i': i}, 'id': i}).encode())
+
+            responses = [decode(await socket.recv()) for _ in range(3)]
+            socket.close()
+
+            return responses
+
+        tasks = asyncio.gather(
+            r.serve(),
+            request(),
+            stop_server(r, 1),
+        )
+
+        loop = asyncio.get_event_loop()
+        res = loop.run_until_complete(tasks)
+
+        responses = {response['id']: response['response'] for response in res[1]}
+
+        self.assertDictEqual(responses[0], {'done': 0})
+        self.assertDictEqual(responses[1], router.BUSY)
+        self.assertDictEqual(responses[2], router.BUSY)
+        self.assertEqual(r.shed_count['test'], 2)
+
+    def test_consensus_service_is_not_delayed_by_bulk_service(self):
+        r = router.Router(socket_id='ipc:///tmp/router', ctx=self.ctx, linger=50, workers=1, bulk_workers=1)
+
+        class SlowProcessor(router.Processor):
+            async def process_message(self, msg):
+                await asyncio.sleep(0.3)
+                return {
+                    'slow': msg['i']
+                }
+
+        class FastProcessor(router.Processor):
+            async def process_message(self, msg):
+                return {
+                    'fast': msg['i']
+                }
+
+        r.add_service('catchup', SlowProcessor(), priority=router.BULK)
+        r.add_service('work', FastProcessor())
+
+        async def request():
+            socket = self.ctx.socket(zmq.DEALER)
+            socket.connect('ipc:///tmp/router')
+
+            await socket.send(encode({'service': 'catchup', 'msg': {'i': 0}}).encode())
+            await socket.send(encode({'service': 'catchup', 'msg': {'i': 1}}).encode())
+            await socket.send(encode({'service': 'work', 'msg': {'i': 2}}).encode())
+
+            responses = [decode(await socket.recv()) for _ in range(3)]
+            socket.close()
+
+            return responses
+
+        tasks = asyncio.gather(
+            r.serve(),
+            request(),
+            stop_server(r, 1),
+        )
+
+        loop = asyncio.get_event_loop()
+        res = loop.run_until_complete(tasks)
+
+        self.assertListEqual(res[1], [{'fast': 2}, {'slow': 0}, {'slow': 1}])
+
+    def test_unknown_services_are_bulk(self):
+        r = router.Router(socket_id='ipc:///tmp/router', ctx=self.ctx, linger=50)
+        r.add_service('test', router.QueueProcessor())
+
+        self.assertEqual(r.priority(r.queue_key({'service': 'test'})), router.CONSENSUS)
+        self.assertEqual(r.priority(r.queue_key({'service': 'nope'})), router.BULK)
+
+    def test_cpu_processor_checks_off_the_loop(self):
+        r = router.Router(socket_id='ipc:///tmp/router', ctx=self.ctx, linger=50)
+
+        class CheckProcessor(router.CPUProcessor):
+            def check(self, msg):
+                return threading.get_ident()
+
+            async def apply(self, msg, result):
+                return {
+                    'checked_on_loop': result == threading.get_ident()
+                }
+
+        r.add_service('test', CheckProcessor())
+
+        async def request():
+            socket = self.ctx.socket(zmq.DEALER)
+            socket.connect('ipc:///tmp/router')
+
+            await socket.send(encode({'service': 'test', 'msg': {}}).encode())
+
+            response = decode(await socket.recv())
+            socket.close()
+
+            return response
+
+        tasks = asyncio.gather(
+            r.serve(),
+            request(),
+            stop_server(r, 1),
+        )
+
+        loop = asyncio.get_event_loop()
+        res = loop.run_until_complete(tasks)
+
+        self.assertDictEqual(res[1], {'checked_on_loop': False})
+
+    def test_cpu_processor_hears_of_messages_before_they_wait_for_a_worker(self):
+        r = router.Router(socket_id='ipc:///tmp/router', ctx=self.ctx, linger=50, workers=1)
+
+        class SlowProcessor(router.CPUProcessor):
+            def __init__(self):
+                self.received_at = {}
+
+            def received(self, msg):
+                self.received_at[msg['n']] = time.time()
+
+            def check(self, msg):
+                time.sleep(0.3)
+                return True
+
+            async def apply(self, msg, result):
+                return {
+                    'n': msg['n']
+                }
+
+        p = SlowProcessor()
+        r.add_service('test', p)
+
+        async def request():
+            socket = self.ctx.socket(zmq.DEALER)
+            socket.connect('ipc:///tmp/router')
+
+            await socket.send(encode({'service': 'test', 'msg': {'n': 1}}).encode())
+            await socket.send(encode({'service': 'test', 'msg': {'n': 2}}).encode())
+
+            responses = [decode(await socket.recv()), decode(await socket.recv())]
+            socket.close()
+
+            return responses
+
+        tasks = asyncio.gather(
+            r.serve(),
+            request(),
+            stop_server(r, 1.5),
+        )
+
+        loop = asyncio.get_event_loop()
+        res = loop.run_until_complete(tasks)
+
+        self.assertEqual(len(res[1]), 2)
+        self.assertLess(p.received_at[2] - p.received_at[1], 0.2)
+
+    def test_handler_error_does_not_stop_workers(self):
+        r = router.Router(socket_id='ipc:///tmp/router', ctx=self.ctx, linger=50, workers=1)
+
+        class BadProcessor(router.Processor):
+            async def process_message(self, msg):
+                if msg.get('fail'):
+                    raise Exception('bad')
+                return {
+                    'whats': 'good'
+                }
+
+        r.add_service('test', BadProcessor())
+
+        async def request():
+            socket = self.ctx.socket(zmq.DEALER)
+            socket.connect('ipc:///tmp/router')
+
+            await socket.send(encode({'service': 'test', 'msg': {'fail': True}}).encode())
+            await socket.send(encode({'service': 'test', 'msg': {'fail': False}}).encode())
+
+            response = decode(await socket.recv())
+            socket.close()
+
+            return response
+
+        tasks = asyncio.gather(
+            r.serve(),
+            request(),
+            stop_server(r, 1),
+        )
+
+        loop = asyncio.get_event_loop()
+        res = loop.run_until_complete(tasks)
+
+        self.assertDictEqual(res[1], {'whats': 'good'})
+        self.assertEqual(r.queued['test'], 0)
+
+
 class TestAsyncServer(TestCase):
     def setUp(self):
         self.ctx = zmq.asyncio.Context()
@@ -279,6 +491,21 @@ class TestAsyncServer(TestCase):
         self.assertEqual(res[1], b'howdy')
 
 
+    def test_stop_returns_without_messages(self):
+        m = router.AsyncInbox('tcp://127.0.0.1:10000', self.ctx, linger=500)
+
+        tasks = asyncio.gather(
+            m.serve(),
+            stop_server(m, 0.1),
+        )
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(asyncio.wait_for(tasks, 1))
+
+        self.assertFalse(m.running)
+        self.assertTrue(m.socket.closed)
+
+
 class TestJSONAsyncInbox(TestCase):
     def setUp(self):
         self.ctx = zmq.asyncio.Context()
@@ -588,3 +815,620 @@ class TestJSONAsyncInbox(TestCase):
 
         self.assertEqual(q1.q[0], {'hello': 'there'})
         self.assertEqual(q2.q[0], {'hello': 'there'})
+
+    def test_multicast_reports_per_peer_results(self):
+        authenticator = authentication.SocketAuthenticator(client=ContractingClient(), ctx=self.ctx)
+
+        w1 = Wallet()
+        w2 = Wallet()
+        w3 = Wallet()
+
+        authenticator.add_verifying_key(w1.verifying_key)
+        authenticator.add_verifying_key(w3.verifying_key)
+        authenticator.configure()
+
+        m1 = router.Router(
+            socket_id='tcp://127.0.0.1:10000',
+            ctx=self.ctx,
+            linger=2000,
+            poll_timeout=50,
+            secure=True,
+            wallet=w1
+        )
+
+        q1 = router.QueueProcessor()
+        m1.add_service('something', q1)
+
+        async def get():
+            peers = {
+                w1.verifying_key: 'tcp://127.0.0.1:10000',
+                w2.verifying_key: 'tcp://127.0.0.1:10001'
+            }
+
+            return await router.secure_multicast(
+                msg={'hello': 'there'},
+                service='something',
+                wallet=w3,
+                peer_map=peers,
+                ctx=self.ctx
+            )
+
+        tasks = asyncio.gather(
+            m1.serve(),
+            get(),
+            stop_server(m1, 1),
+        )
+
+        loop = asyncio.get_event_loop()
+        res = loop.run_until_complete(tasks)
+
+        self.assertDictEqual(res[1], {w1.verifying_key: True, w2.verifying_key: False})
+        self.assertEqual(q1.q[0], {'hello': 'there'})
+
+        authenticator.authenticator.stop()
+
+
+class TestPeerHealth(TestCase):
+    def test_rank_orders_by_round_trip_time(self):
+        health = router.PeerHealth()
+
+        health.record('a', {}, 0.5)
+        health.record('b', {}, 0.1)
+        health.record('c', {}, 0.3)
+
+        self.assertEqual(health.rank(['a', 'b', 'c']), ['b', 'c', 'a'])
+        self.assertEqual(health.fastest(['a', 'b', 'c']), 'b')
+
+    def test_round_trip_times_are_smoothed(self):
+        health = router.PeerHealth(alpha=0.5)
+
+        health.record('a', {}, 0.2)
+        health.record('a', {}, 0.4)
+
+        self.assertAlmostEqual(health.rtts['a'], 0.3)
+
+    def test_failures_demote_peers(self):
+        health = router.PeerHealth()
+
+        health.record('a', {}, 0.1)
+        health.record('b', {}, 0.5)
+        health.record('a', None, 1)
+
+        self.assertEqual(health.rank(['a', 'b']), ['b', 'a'])
+
+        # A reply clears the failures
+        health.record('a', {}, 0.1)
+
+        self.assertEqual(health.rank(['a', 'b']), ['a', 'b'])
+
+    def test_busy_replies_count_as_failures(self):
+        health = router.PeerHealth()
+        health.record('a', router.BUSY, 0.1)
+
+        self.assertEqual(health.failures['a'], 1)
+
+    def test_failing_peers_are_unhealthy_until_rested(self):
+        health = router.PeerHealth(max_failures=2, rest=10)
+
+        health.record('a', None, 1)
+        self.assertTrue(health.healthy('a'))
+
+        health.record('a', None, 1)
+        self.assertFalse(health.healthy('a'))
+        self.assertTrue(health.healthy('a', now=time.time() + 11))
+
+    def test_unmeasured_peers_rank_between_fast_and_slow(self):
+        health = router.PeerHealth()
+
+        health.record('fast', {}, 0.1)
+        health.record('slow', {}, 2)
+
+        self.assertEqual(health.rank(['slow', 'new', 'fast']), ['fast', 'new', 'slow'])
+
+    def test_fastest_of_nothing_is_none(self):
+        self.assertIsNone(router.PeerHealth().fastest([]))
+
+
+class TestConnectionPool(TestCase):
+    def setUp(self):
+        self.ctx = zmq.asyncio.Context()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.authenticator = authentication.SocketAuthenticator(client=ContractingClient(), ctx=self.ctx)
+
+        self.w1 = Wallet()
+        self.w2 = Wallet()
+
+        self.authenticator.add_verifying_key(self.w1.verifying_key)
+        self.authenticator.add_verifying_key(self.w2.verifying_key)
+        self.authenticator.configure()
+
+    def tearDown(self):
+        self.authenticator.authenticator.stop()
+        self.ctx.destroy()
+        self.loop.close()
+
+    def test_get_reuses_connection(self):
+        pool = router.ConnectionPool(wallet=self.w2, ctx=self.ctx)
+
+        async def get():
+            c1 = pool.get(self.w1.verifying_key, 'tcp://127.0.0.1:10000')
+            c2 = pool.get(self.w1.verifying_key, 'tcp://127.0.0.1:10000')
+            pool.close()
+            return c1, c2
+
+        c1, c2 = self.loop.run_until_complete(get())
+
+        self.assertIs(c1, c2)
+        self.assertTrue(c1.closed)
+
+    def test_get_unknown_key_returns_none(self):
+        pool = router.ConnectionPool(wallet=self.w2, ctx=self.ctx)
+
+        self.assertIsNone(pool.get(Wallet().verifying_key, 'tcp://127.0.0.1:10000'))
+
+    def test_refresh_evicts_removed_members(self):
+        pool = router.ConnectionPool(wallet=self.w2, ctx=self.ctx)
+
+        async def get():
+            c = pool.get(self.w1.verifying_key, 'tcp://127.0.0.1:10000')
+            pool.refresh(vks=[self.w2.verifying_key])
+            return c
+
+        c = self.loop.run_until_complete(get())
+
+        self.assertTrue(c.closed)
+        self.assertEqual(len(pool.connections), 0)
+
+    def test_evict_idle_closes_unused_connections(self):
+        pool = router.ConnectionPool(wallet=self.w2, ctx=self.ctx, idle_timeout=0)
+
+        async def get():
+            c = pool.get(self.w1.verifying_key, 'tcp://127.0.0.1:10000')
+            await asyncio.sleep(0.01)
+            pool.evict_idle()
+            return c
+
+        c = self.loop.run_until_complete(get())
+
+        self.assertTrue(c.closed)
+
+    def test_connection_waiting_on_reply_is_not_idle(self):
+        pool = router.ConnectionPool(wallet=self.w2, ctx=self.ctx, idle_timeout=0)
+
+        async def get():
+            c = pool.get(self.w1.verifying_key, 'tcp://127.0.0.1:10000')
+            await asyncio.sleep(0.01)
+
+            idle = c.idle(time.time(), 0)
+            c.requests[1] = asyncio.get_event_loop().create_future()
+            busy = c.idle(time.time(), 0)
+
+            pool.close()
+            return idle, busy
+
+        idle, busy = self.loop.run_until_complete(get())
+
+        self.assertTrue(idle)
+        self.assertFalse(busy)
+
+    def test_pooled_requests_get_their_own_responses(self):
+        class SlowEcho(router.Processor):
+            async def process_message(self, msg):
+                # Later requests finish first so replies come back out of order
+                await asyncio.sleep(msg['delay'])
+                return {'echo': msg['n']}
+
+        m = router.Router(
+            socket_id='tcp://127.0.0.1:10000',
+            ctx=self.ctx,
+            linger=2000,
+            poll_timeout=50,
+            secure=True,
+            wallet=self.w1
+        )
+        m.add_service('something', SlowEcho())
+
+        pool = router.ConnectionPool(wallet=self.w2, ctx=self.ctx)
+
+        async def get():
+            # The probes' replies show the router echoes ids, so the requests share the pooled socket
+            connection = pool.get(self.w1.verifying_key, 'tcp://127.0.0.1:10000')
+            await asyncio.sleep(0.3)
+            self.assertTrue(connection.echoes_ids)
+
+            results = await asyncio.gather(*[
+                router.secure_request(
+                    msg={'n': i, 'delay': 0.3 - i * 0.1},
+                    service='something',
+                    wallet=self.w2,
+                    vk=self.w1.verifying_key,
+                    ip='tcp://127.0.0.1:10000',
+                    ctx=self.ctx,
+                    pool=pool
+                ) for i in range(3)
+            ])
+            pool.close()
+            return results
+
+        tasks = asyncio.gather(
+            m.serve(),
+            get(),
+            stop_server(m, 1),
+        )
+
+        res = self.loop.run_until_complete(tasks)
+
+        self.assertEqual(res[1], [{'echo': 0}, {'echo': 1}, {'echo': 2}])
+
+    def test_pooled_request_to_router_that_does_not_echo_ids(self):
+        class OldRouter(router.Router):
+            # Routers from before request ids answer without them
+            async def reply(self, _id, response, request_id=None, codec=wire.JSON):
+                await super().reply(_id, response, None, wire.JSON)
+
+        class Echo(router.Processor):
+            async def process_message(self, msg):
+                return {'echo': msg['n']}
+
+        m = OldRouter(
+            socket_id='tcp://127.0.0.1:10000',
+            ctx=self.ctx,
+            linger=2000,
+            poll_timeout=50,
+            secure=True,
+            wallet=self.w1
+        )
+        m.add_service('something', Echo())
+
+        pool = router.ConnectionPool(wallet=self.w2, ctx=self.ctx)
+
+        async def get():
+            connection = pool.get(self.w1.verifying_key, 'tcp://127.0.0.1:10000')
+            await asyncio.sleep(0.3)
+
+            started = time.time()
+            response = await router.secure_request(
+                msg={'n': 1},
+                service='something',
+                wallet=self.w2,
+                vk=self.w1.verifying_key,
+                ip='tcp://127.0.0.1:10000',
+                ctx=self.ctx,
+                timeout=2000,
+                pool=pool
+            )
+            waited = time.time() - started
+
+            pool.close()
+            return connection.echoes_ids, response, waited
+
+        tasks = asyncio.gather(
+            m.serve(),
+            get(),
+            stop_server(m, 1),
+        )
+
+        res = self.loop.run_until_complete(tasks)
+
+        echoes_ids, response, waited = res[1]
+
+        self.assertFalse(echoes_ids)
+        self.assertEqual(response, {'echo': 1})
+        self.assertLess(waited, 1)
+
+    def test_heartbeat_marks_routers_that_do_not_echo_ids_live(self):
+        class OldRouter(router.Router):
+            # Routers from before request ids and heartbeats answer every message with OK and no id
+            async def reply(self, _id, response, request_id=None, codec=wire.JSON):
+                await super().reply(_id, router.OK, None, wire.JSON)
+
+        m = OldRouter(
+            socket_id='tcp://127.0.0.1:10000',
+            ctx=self.ctx,
+            linger=2000,
+            poll_timeout=50,
+            secure=True,
+            wallet=self.w1
+        )
+
+        pool = router.ConnectionPool(wallet=self.w2, ctx=self.ctx)
+
+        heartbeat = router.Heartbeat(
+            wallet=self.w2,
+            ctx=self.ctx,
+            peers=lambda: {self.w1.verifying_key: 'tcp://127.0.0.1:10000'},
+            pool=pool,
+            timeout=500
+        )
+
+        async def beat():
+            pool.get(self.w1.verifying_key, 'tcp://127.0.0.1:10000')
+            await asyncio.sleep(0.3)
+
+            for _ in range(router.get_peer_health().max_failures):
+                await heartbeat.beat()
+            pool.close()
+
+        tasks = asyncio.gather(
+            m.serve(),
+            beat(),
+            stop_server(m, 1),
+        )
+
+        self.loop.run_until_complete(tasks)
+
+        # Every beat was answered
+        self.assertIn(self.w1.verifying_key, router.get_peer_health().rtts)
+        self.assertNotIn(self.w1.verifying_key, router.get_peer_health().failures)
+        self.assertEqual(heartbeat.live([self.w1.verifying_key]), [self.w1.verifying_key])
+
+    def test_heartbeat_marks_silent_peers_not_live(self):
+        m = router.Router(
+            socket_id='tcp://127.0.0.1:10000',
+            ctx=self.ctx,
+            linger=2000,
+            poll_timeout=50,
+            secure=True,
+            wallet=self.w1
+        )
+
+        w3 = Wallet()
+        self.authenticator.add_verifying_key(w3.verifying_key)
+        self.authenticator.configure()
+
+        pool = router.ConnectionPool(wallet=self.w2, ctx=self.ctx)
+
+        heartbeat = router.Heartbeat(
+            wallet=self.w2,
+            ctx=self.ctx,
+            peers=lambda: {self.w1.verifying_key: 'tcp://127.0.0.1:10000', w3.verifying_key: 'tcp://127.0.0.1:10001'},
+            pool=pool,
+            timeout=100
+        )
+
+        async def beat():
+            for _ in range(router.get_peer_health().max_failures):
+                await heartbeat.beat()
+            pool.close()
+
+        tasks = asyncio.gather(
+            m.serve(),
+            beat(),
+            stop_server(m, 1),
+        )
+
+        self.loop.run_until_complete(tasks)
+
+        self.assertEqual(heartbeat.live([self.w1.verifying_key, w3.verifying_key]), [self.w1.verifying_key])
+
+    def test_pooled_send_reuses_socket(self):
+        m = router.Router(
+            socket_id='tcp://127.0.0.1:10000',
+            ctx=self.ctx,
+            linger=2000,
+            poll_timeout=50,
+            secure=True,
+            wallet=self.w1
+        )
+
+        q = router.QueueProcessor()
+        m.add_service('something', q)
+
+        pool = router.ConnectionPool(wallet=self.w2, ctx=self.ctx)
+
+        async def get():
+            for i in range(3):
+                await router.secure_send(
+                    msg={'n': i},
+                    service='something',
+                    wallet=self.w2,
+                    vk=self.w1.verifying_key,
+                    ip='tcp://127.0.0.1:10000',
+                    ctx=self.ctx,
+                    pool=pool
+                )
+            connections = len(pool.connections)
+            await asyncio.sleep(0.5)
+            pool.close()
+            return connections
+
+        tasks = asyncio.gather(
+            m.serve(),
+            get(),
+            stop_server(m, 1),
+        )
+
+        res = self.loop.run_until_complete(tasks)
+
+        self.assertEqual(res[1], 1)
+        self.assertEqual(q.q, [{'n': 0}, {'n': 1}, {'n': 2}])
+
+    def test_pool_negotiates_binary_codec(self):
+        m = router.Router(
+            socket_id='tcp://127.0.0.1:10000',
+            ctx=self.ctx,
+            linger=2000,
+            poll_timeout=50,
+            secure=True,
+            wallet=self.w1
+        )
+
+        q = router.QueueProcessor()
+        m.add_service('something', q)
+
+        pool = router.ConnectionPool(wallet=self.w2, ctx=self.ctx, binary_services=['something'])
+
+        async def get():
+            pool.get(self.w1.verifying_key, 'tcp://127.0.0.1:10000')
+            await asyncio.sleep(0.3)
+
+            codec = pool.codec(self.w1.verifying_key, 'tcp://127.0.0.1:10000', 'something')
+
+            await router.secure_send(
+                msg={'raw': b'\x00\x01'},
+                service='something',
+                wallet=self.w2,
+                vk=self.w1.verifying_key,
+                ip='tcp://127.0.0.1:10000',
+                ctx=self.ctx,
+                pool=pool
+            )
+            await asyncio.sleep(0.3)
+            pool.close()
+            return codec
+
+        tasks = asyncio.gather(
+            m.serve(),
+            get(),
+            stop_server(m, 1),
+        )
+
+        res = self.loop.run_until_complete(tasks)
+
+        self.assertEqual(res[1], wire.BINARY)
+        self.assertEqual(q.q, [{'raw': b'\x00\x01'}])
+
+    def test_pool_streams_large_messages(self):
+        m = router.Router(
+            socket_id='tcp://127.0.0.1:10000',
+            ctx=self.ctx,
+            linger=2000,
+            poll_timeout=50,
+            secure=True,
+            wallet=self.w1
+        )
+
+        q = router.QueueProcessor()
+        m.add_service('something', q)
+
+        pool = router.ConnectionPool(wallet=self.w2, ctx=self.ctx, stream_services=['something'])
+
+        block = {'number': 1, 'subblocks': [{'transactions': [{'n': i, 'hash': str(i) * 32} for i in range(20_000)]}]}
+
+        async def get():
+            pool.get(self.w1.verifying_key, 'tcp://127.0.0.1:10000')
+            await asyncio.sleep(0.3)
+
+            codec = pool.codec(self.w1.verifying_key, 'tcp://127.0.0.1:10000', 'something')
+
+            await router.secure_send(
+                msg=block,
+                service='something',
+                wallet=self.w2,
+                vk=self.w1.verifying_key,
+                ip='tcp://127.0.0.1:10000',
+                ctx=self.ctx,
+                pool=pool
+            )
+            await asyncio.sleep(0.5)
+            pool.close()
+            return codec
+
+        tasks = asyncio.gather(
+            m.serve(),
+            get(),
+            stop_server(m, 1.5),
+        )
+
+        res = self.loop.run_until_complete(tasks)
+
+        self.assertEqual(res[1], wire.STREAMED)
+        self.assertEqual(q.q, [block])
+
+    def test_pool_does_not_stream_to_peers_that_predate_streams(self):
+        class OldRouter(router.Router):
+            # Routers from before streams answer a streamed request in JSON
+            def reply_codec(self, msg):
+                codec = super().reply_codec(msg)
+                return wire.JSON if codec == wire.STREAMED else codec
+
+        m = OldRouter(
+            socket_id='tcp://127.0.0.1:10000',
+            ctx=self.ctx,
+            linger=2000,
+            poll_timeout=50,
+            secure=True,
+            wallet=self.w1
+        )
+
+        q = router.QueueProcessor()
+        m.add_service('something', q)
+
+        pool = router.ConnectionPool(wallet=self.w2, ctx=self.ctx, stream_services=['something'])
+
+        async def get():
+            pool.get(self.w1.verifying_key, 'tcp://127.0.0.1:10000')
+            await asyncio.sleep(0.3)
+
+            codec = pool.codec(self.w1.verifying_key, 'tcp://127.0.0.1:10000', 'something')
+            pool.close()
+            return codec
+
+        tasks = asyncio.gather(
+            m.serve(),
+            get(),
+            stop_server(m, 0.5),
+        )
+
+        res = self.loop.run_until_complete(tasks)
+
+        self.assertEqual(res[1], wire.BINARY)
+
+    def test_request_gets_streamed_reply(self):
+        blocks = [{'number': i, 'transactions': [{'hash': str(j) * 32} for j in range(5_000)]} for i in range(3)]
+
+        class Blocks(router.Processor):
+            async def process_message(self, msg):
+                return blocks
+
+        m = router.Router(
+            socket_id='tcp://127.0.0.1:10000',
+            ctx=self.ctx,
+            linger=2000,
+            poll_timeout=50,
+            secure=True,
+            wallet=self.w1
+        )
+        m.add_service('something', Blocks())
+
+        async def get():
+            return await router.secure_request(
+                msg={},
+                service='something',
+                wallet=self.w2,
+                vk=self.w1.verifying_key,
+                ip='tcp://127.0.0.1:10000',
+                ctx=self.ctx,
+                reply_codec=wire.STREAMED
+            )
+
+        tasks = asyncio.gather(
+            m.serve(),
+            get(),
+            stop_server(m, 1),
+        )
+
+        res = self.loop.run_until_complete(tasks)
+
+        self.assertEqual(res[1], blocks)
+
+    def test_secure_request_records_failures(self):
+        vk = self.w1.verifying_key
+
+        async def get():
+            return await router.secure_request(
+                msg={},
+                service='something',
+                wallet=self.w2,
+                vk=vk,
+                ip='tcp://127.0.0.1:10001',
+                ctx=self.ctx,
+                timeout=100
+            )
+
+        failures = router.get_peer_health().failures.get(vk, 0)
+
+        self.assertIsNone(self.loop.run_until_complete(get()))
+        self.assertEqual(router.get_peer_health().failures[vk], failures + 1)
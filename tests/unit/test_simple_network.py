@@ -449,3 +449,65 @@ class TestNetwork(TestCase):
         self.assertDictEqual(n1.peers, bootnodes)
         self.assertDictEqual(n2.peers, bootnodes)
         self.assertDictEqual(n3.peers, bootnodes)
+
+    def test_start_checks_each_peer_identity_once(self):
+        me = Wallet()
+        w_1 = Wallet()
+        w_2 = Wallet()
+
+        ips = ['tcp://127.0.0.1:18003', 'tcp://127.0.0.1:18004']
+
+        # Both bootnodes know about both peers
+        peers = {
+            'peers': [{'vk': w_1.verifying_key, 'ip': ips[0]}, {'vk': w_2.verifying_key, 'ip': ips[1]}]
+        }
+
+        class Join(router.Processor):
+            async def process_message(self, msg):
+                return peers
+
+        class Identity(router.Processor):
+            def __init__(self):
+                self.requests = 0
+
+            async def process_message(self, msg):
+                self.requests += 1
+                return {'ok': True}
+
+        identities = []
+        routers = []
+        for w, ip in zip([w_1, w_2], ips):
+            r = router.Router(socket_id=ip, ctx=self.ctx, secure=True, wallet=w)
+            r.add_service(JOIN_SERVICE, Join())
+
+            identity = Identity()
+            r.add_service(IDENTITY_SERVICE, identity)
+
+            routers.append(r)
+            identities.append(identity)
+
+        n_router = router.Router(socket_id='tcp://127.0.0.1:18002', ctx=self.ctx, secure=True, wallet=me)
+        n = Network(wallet=me, ip_string='tcp://127.0.0.1:18002', ctx=self.ctx, router=n_router)
+
+        for vk in [w_1.verifying_key, w_2.verifying_key, me.verifying_key]:
+            self.authenticator.add_verifying_key(vk)
+        self.authenticator.configure()
+
+        bootnodes = {
+            w_1.verifying_key: ips[0],
+            w_2.verifying_key: ips[1]
+        }
+
+        tasks = asyncio.gather(
+            routers[0].serve(),
+            routers[1].serve(),
+            n.start(bootnodes, [w_1.verifying_key, w_2.verifying_key]),
+            stop_server(routers[0], 1),
+            stop_server(routers[1], 1)
+        )
+
+        self.loop.run_until_complete(tasks)
+
+        self.assertEqual([i.requests for i in identities], [1, 1])
+        self.assertEqual(n.discovery_rounds, 1)
+        self.assertIsNotNone(n.discovery_time)
@@ -0,0 +1,88 @@
+from unittest import TestCase
+
+from contracting.db.driver import ContractDriver, InMemDriver
+from contracting.stdlib.bridge.decimal import ContractingDecimal
+
+from lamden import snapshot, storage
+
+import os
+
+SNAPSHOT_FILE = '/tmp/lamden_snapshot_test'
+
+
+class TestSnapshot(TestCase):
+    def setUp(self):
+        self.driver = ContractDriver(driver=InMemDriver())
+        self.nonces = storage.NonceStorage()
+        self.nonces.flush()
+
+        self.driver.driver.set('currency.balances:stu', ContractingDecimal('100.5'))
+        self.driver.driver.set('currency.balances:jeff', 1000)
+        self.driver.driver.set('masternodes.S:members', ['a', 'b'])
+
+        storage.set_latest_block_hash('a' * 64, self.driver)
+        storage.set_latest_block_height(123, self.driver)
+
+        self.nonces.set_nonce(sender='stu', processor='mn', value=5)
+        self.nonces.set_nonce(sender='jeff', processor='mn', value=7)
+
+    def tearDown(self):
+        self.nonces.flush()
+        if os.path.exists(SNAPSHOT_FILE):
+            os.remove(SNAPSHOT_FILE)
+
+    def test_export_returns_height_and_hash(self):
+        height, block_hash = snapshot.export_snapshot(SNAPSHOT_FILE, driver=self.driver, nonces=self.nonces)
+
+        self.assertEqual(height, 123)
+        self.assertEqual(block_hash, 'a' * 64)
+
+    def test_verify_returns_header(self):
+        snapshot.export_snapshot(SNAPSHOT_FILE, driver=self.driver, nonces=self.nonces)
+
+        header = snapshot.verify_snapshot(SNAPSHOT_FILE)
+
+        self.assertEqual(header['height'], 123)
+        self.assertEqual(header['hash'], 'a' * 64)
+
+    def test_import_restores_state_and_nonces(self):
+        snapshot.export_snapshot(SNAPSHOT_FILE, driver=self.driver, nonces=self.nonces, chunk_size=2)
+
+        new_driver = ContractDriver(driver=InMemDriver())
+        new_driver.driver.set('stale', 'value')
+        self.nonces.flush()
+
+        snapshot.import_snapshot(SNAPSHOT_FILE, driver=new_driver, nonces=self.nonces)
+
+        self.assertEqual(new_driver.driver.get('currency.balances:stu'), ContractingDecimal('100.5'))
+        self.assertEqual(new_driver.driver.get('currency.balances:jeff'), 1000)
+        self.assertEqual(new_driver.driver.get('masternodes.S:members'), ['a', 'b'])
+        self.assertIsNone(new_driver.driver.get('stale'))
+
+        self.assertEqual(storage.get_latest_block_height(new_driver), 123)
+        self.assertEqual(storage.get_latest_block_hash(new_driver), 'a' * 64)
+
+        self.assertEqual(self.nonces.get_nonce(sender='stu', processor='mn'), 5)
+        self.assertEqual(self.nonces.get_nonce(sender='jeff', processor='mn'), 7)
+
+    def test_corrupt_snapshot_raises_and_leaves_state(self):
+        snapshot.export_snapshot(SNAPSHOT_FILE, driver=self.driver, nonces=self.nonces)
+
+        with open(SNAPSHOT_FILE, 'r+b') as f:
+            f.seek(-40, os.SEEK_END)
+            f.write(b'\x00')
+
+        new_driver = ContractDriver(driver=InMemDriver())
+        new_driver.driver.set('stale', 'value')
+
+        with self.assertRaises(snapshot.SnapshotException):
+            snapshot.import_snapshot(SNAPSHOT_FILE, driver=new_driver, nonces=self.nonces)
+
+        self.assertEqual(new_driver.driver.get('stale'), 'value')
+
+    def test_not_a_snapshot_raises(self):
+        with open(SNAPSHOT_FILE, 'wb') as f:
+            f.write(b'hello')
+
+        with self.assertRaises(snapshot.SnapshotException):
+            snapshot.verify_snapshot(SNAPSHOT_FILE)
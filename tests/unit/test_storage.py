@@ -1,3 +1,4 @@
+import asyncio
 from lamden import storage
 from contracting.db.driver import ContractDriver
 from unittest import TestCase
@@ -5,6 +6,29 @@ from unittest import TestCase
 from lamden.storage import BlockStorage
 
 
+class TestClientRegistry(TestCase):
+    def test_storages_share_one_client(self):
+        n = storage.NonceStorage()
+        b = BlockStorage()
+
+        self.assertIs(n.client, b.client)
+
+    def test_get_client_same_host_port_returns_same_client(self):
+        self.assertIs(storage.get_client(), storage.get_client())
+
+    def test_get_client_different_port_returns_different_client(self):
+        self.assertIsNot(storage.get_client(), storage.get_client(port=27018))
+
+    def test_pool_stats_reports_checked_out_connections(self):
+        n = storage.NonceStorage()
+        n.get_nonce(sender='test', processor='test2')
+
+        stats = storage.pool_stats()['localhost:27017']
+
+        self.assertGreater(stats['checked_out'], 0)
+        self.assertEqual(stats['in_use'], 0)
+
+
 class TestNonce(TestCase):
     def setUp(self):
         self.nonces = storage.NonceStorage()
@@ -94,6 +118,76 @@ class TestNonce(TestCase):
         self.assertEqual(n, 2)
 
 
+class TestCachedNonce(TestCase):
+    def setUp(self):
+        self.nonces = storage.CachedNonceStorage()
+        self.nonces.flush()
+
+    def tearDown(self):
+        self.nonces.flush()
+
+    def test_get_nonce_none_if_not_set_first(self):
+        self.assertIsNone(self.nonces.get_nonce(sender='test', processor='test2'))
+        self.assertIsNone(self.nonces.get_pending_nonce(sender='test', processor='test2'))
+
+    def test_set_then_get_nonce_returns_set_nonce(self):
+        self.nonces.set_nonce(sender='test', processor='test2', value=2)
+        self.nonces.set_pending_nonce(sender='test', processor='test2', value=3)
+
+        self.assertEqual(self.nonces.get_nonce(sender='test', processor='test2'), 2)
+        self.assertEqual(self.nonces.get_pending_nonce(sender='test', processor='test2'), 3)
+
+    def test_set_nonce_not_written_until_commit(self):
+        self.nonces.set_nonce(sender='test', processor='test2', value=2)
+
+        self.assertIsNone(storage.NonceStorage.get_one('test', 'test2', self.nonces.nonces))
+
+        self.nonces.commit()
+
+        self.assertEqual(storage.NonceStorage.get_one('test', 'test2', self.nonces.nonces), 2)
+
+    def test_commit_deletes_cleared_pending_nonces(self):
+        self.nonces.set_pending_nonce(sender='test', processor='test2', value=2)
+        self.nonces.commit()
+
+        self.assertEqual(storage.NonceStorage.get_one('test', 'test2', self.nonces.pending_nonces), 2)
+
+        self.nonces.set_pending_nonce(sender='test', processor='test2', value=None)
+        self.nonces.commit()
+
+        self.assertIsNone(storage.NonceStorage.get_one('test', 'test2', self.nonces.pending_nonces))
+        self.assertEqual(self.nonces.pending_cache, {})
+
+    def test_rebuild_loads_committed_nonces_and_drops_pending(self):
+        self.nonces.set_nonce(sender='test', processor='test2', value=2)
+        self.nonces.set_pending_nonce(sender='test', processor='test2', value=5)
+        self.nonces.commit()
+
+        self.nonces.set_nonce(sender='test', processor='test2', value=3)
+
+        restarted = storage.CachedNonceStorage()
+
+        self.assertEqual(restarted.get_nonce(sender='test', processor='test2'), 2)
+        self.assertIsNone(restarted.get_pending_nonce(sender='test', processor='test2'))
+
+    def test_update_state_with_block_then_commit_sets_nonces(self):
+        self.nonces.set_pending_nonce(sender='abc', processor='def', value=122)
+
+        storage.update_state_with_block(
+            block=block,
+            driver=ContractDriver(),
+            nonces=self.nonces
+        )
+
+        self.nonces.commit()
+
+        self.assertIsNone(storage.NonceStorage.get_one('abc', 'def', self.nonces.pending_nonces))
+        self.assertEqual(storage.NonceStorage.get_one('abc', 'def', self.nonces.nonces), 125)
+        self.assertEqual(storage.NonceStorage.get_one('xxx', 'yyy', self.nonces.nonces), 43)
+
+        ContractDriver().flush()
+
+
 class TestStorage(TestCase):
     def setUp(self):
         self.driver = ContractDriver()
@@ -444,6 +538,113 @@ class TestUpdatingState(TestCase):
         self.assertEqual(v5, 'else')
 
 
+class TestIndexes(TestCase):
+    def setUp(self):
+        self.blocks = BlockStorage(create_indexes=True)
+        self.nonces = storage.NonceStorage(create_indexes=True)
+
+    def tearDown(self):
+        self.blocks.drop_collections()
+        self.nonces.flush()
+
+    def test_indexes_built_on_init_if_asked(self):
+        self.assertEqual(self.blocks.missing_indexes(), [])
+        self.assertEqual(self.nonces.missing_indexes(), [])
+
+    def test_indexes_not_built_by_default(self):
+        self.blocks.blocks.drop()
+        self.blocks.txs.drop()
+
+        BlockStorage()
+
+        self.assertEqual(self.blocks.missing_indexes(), ['blocks.number', 'blocks.hash', 'tx.hash'])
+
+    def test_missing_indexes_reported_if_not_built(self):
+        self.blocks.blocks.drop()
+        self.blocks.txs.drop()
+
+        b = BlockStorage(create_indexes=False)
+
+        self.assertEqual(b.missing_indexes(), ['blocks.number', 'blocks.hash', 'tx.hash'])
+
+    def test_build_indexes_idempotent(self):
+        self.blocks.build_indexes()
+        self.nonces.build_indexes()
+
+        self.assertEqual(self.blocks.missing_indexes(), [])
+        self.assertEqual(self.nonces.missing_indexes(), [])
+
+    def test_store_same_block_twice_only_stores_once(self):
+        block = {
+            'hash': 'a',
+            'number': 1,
+            'subblocks': [
+                {
+                    'transactions': [{'hash': 'something1', 'key': '1'}]
+                }
+            ]
+        }
+
+        self.blocks.store_block(block)
+        self.blocks.store_block(block)
+
+        self.assertEqual(self.blocks.blocks.count_documents({}), 1)
+        self.assertEqual(self.blocks.txs.count_documents({}), 1)
+        self.assertIsNone(block.get('_id'))
+
+    def test_storing_block_again_stores_missing_txs(self):
+        block = {
+            'hash': 'a',
+            'number': 1,
+            'subblocks': [
+                {
+                    'transactions': [{'hash': 'something1', 'key': '1'}, {'hash': 'something2', 'key': '2'}]
+                }
+            ]
+        }
+
+        self.blocks.store_block(block)
+        self.blocks.delete_tx('something2')
+
+        self.blocks.store_block(block)
+
+        self.assertEqual(self.blocks.blocks.count_documents({}), 1)
+        self.assertEqual(self.blocks.txs.count_documents({}), 2)
+
+    def test_duplicates_counted_and_removed(self):
+        self.blocks.blocks.drop()
+        self.blocks.txs.drop()
+
+        self.blocks.blocks.insert_many([
+            {'hash': 'a', 'number': 1, 'copy': 1},
+            {'hash': 'a', 'number': 1, 'copy': 2},
+            {'hash': 'b', 'number': 2}
+        ])
+
+        self.assertEqual(self.blocks.count_duplicates(), {'blocks.number': 1, 'blocks.hash': 1})
+
+        self.assertEqual(self.blocks.remove_duplicates(), 1)
+        self.assertEqual(self.blocks.blocks.find_one({'number': 1})['copy'], 1)
+        self.assertEqual(self.blocks.count_duplicates(), {})
+
+        self.blocks.build_indexes()
+        self.assertEqual(self.blocks.missing_indexes(), [])
+
+    def test_only_duplicate_keys(self):
+        duplicate = storage.BulkWriteError({'writeErrors': [{'code': 11000}, {'code': 11000}]})
+        other = storage.BulkWriteError({'writeErrors': [{'code': 11000}, {'code': 121}]})
+
+        self.assertTrue(storage.only_duplicate_keys(duplicate))
+        self.assertFalse(storage.only_duplicate_keys(other))
+        self.assertFalse(storage.only_duplicate_keys(storage.OperationFailure('timeout')))
+
+    def test_set_nonce_twice_keeps_one_document(self):
+        self.nonces.set_nonce(sender='test', processor='test2', value=1)
+        self.nonces.set_nonce(sender='test', processor='test2', value=2)
+
+        self.assertEqual(self.nonces.nonces.count_documents({}), 1)
+
+
 class TestMasterStorage(TestCase):
     def setUp(self):
         self.db = BlockStorage()
@@ -567,10 +768,10 @@ class TestMasterStorage(TestCase):
         blocks = []
 
         blocks.append({'hash': 'a', 'number': 1, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 2, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 3, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 4, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 5, 'data': 'woop'})
+        blocks.append({'hash': 'b', 'number': 2, 'data': 'woop'})
+        blocks.append({'hash': 'c', 'number': 3, 'data': 'woop'})
+        blocks.append({'hash': 'd', 'number': 4, 'data': 'woop'})
+        blocks.append({'hash': 'e', 'number': 5, 'data': 'woop'})
 
         for block in blocks:
             self.db.put(block)
@@ -585,10 +786,10 @@ class TestMasterStorage(TestCase):
         blocks = []
 
         blocks.append({'hash': 'a', 'number': 1, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 2, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 3, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 4, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 5, 'data': 'woop'})
+        blocks.append({'hash': 'b', 'number': 2, 'data': 'woop'})
+        blocks.append({'hash': 'c', 'number': 3, 'data': 'woop'})
+        blocks.append({'hash': 'd', 'number': 4, 'data': 'woop'})
+        blocks.append({'hash': 'e', 'number': 5, 'data': 'woop'})
 
         for block in blocks:
             self.db.put(block, BlockStorage.BLOCK)
@@ -603,10 +804,10 @@ class TestMasterStorage(TestCase):
         blocks = []
 
         blocks.append({'hash': 'a', 'number': 1, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 2, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 3, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 4, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 5, 'data': 'woop'})
+        blocks.append({'hash': 'b', 'number': 2, 'data': 'woop'})
+        blocks.append({'hash': 'c', 'number': 3, 'data': 'woop'})
+        blocks.append({'hash': 'd', 'number': 4, 'data': 'woop'})
+        blocks.append({'hash': 'e', 'number': 5, 'data': 'woop'})
 
         for block in blocks:
             self.db.put(block, BlockStorage.BLOCK)
@@ -854,3 +1055,193 @@ class TestMasterStorage(TestCase):
         self.assertIsNone(got_1)
         self.assertIsNone(got_2)
         self.assertIsNone(got_3)
+
+    def test_get_blocks_returns_inclusive_range_ascending(self):
+        for i in [3, 1, 5, 2, 4]:
+            self.db.put({'hash': str(i), 'number': i, 'subblocks': []})
+
+        got_blocks = list(self.db.get_blocks(2, 4, batch_size=1))
+
+        self.assertEqual([b['number'] for b in got_blocks], [2, 3, 4])
+
+    def test_get_blocks_headers_projection_drops_subblocks(self):
+        self.db.put({'hash': 'a', 'number': 1, 'previous': '0', 'subblocks': [{'transactions': []}]})
+
+        got_blocks = list(self.db.get_blocks(1, 1, projection='headers'))
+
+        self.assertEqual(got_blocks, [{'hash': 'a', 'number': 1, 'previous': '0'}])
+
+    def test_get_blocks_no_payloads_projection_drops_transactions(self):
+        tx = {'hash': 'something1', 'transaction': {'payload': {}}, 'state': []}
+        self.db.put({'hash': 'a', 'number': 1, 'subblocks': [{'transactions': [tx]}]})
+
+        got_blocks = list(self.db.get_blocks(1, 1, projection='no_payloads'))
+
+        self.assertEqual(got_blocks[0]['subblocks'][0]['transactions'], [{'hash': 'something1', 'state': []}])
+
+    def test_put_many_txs(self):
+        txs = [
+            {'hash': 'something1', 'key': '1'},
+            {'hash': 'something2', 'key': '2'}
+        ]
+
+        res = self.db.put_many(txs, BlockStorage.TX)
+
+        self.assertTrue(res)
+
+        self.assertDictEqual(txs[0], self.db.get_tx(h='something1'))
+        self.assertDictEqual(txs[1], self.db.get_tx(h='something2'))
+
+    def test_put_many_empty_returns_true(self):
+        self.assertTrue(self.db.put_many([], BlockStorage.TX))
+
+    def test_put_many_other_returns_false(self):
+        self.assertFalse(self.db.put_many([{'hash': 'a'}], 999))
+
+    def test_store_block_bulk_does_not_add_ids_to_txs(self):
+        tx_1 = {
+            'hash': 'something1',
+            'key': '1'
+        }
+
+        block = {
+            'hash': 'hello',
+            'number': 1,
+            'subblocks': [
+                {
+                    'transactions': [tx_1]
+                }
+            ]
+        }
+
+        self.db.store_block(block)
+
+        self.assertIsNone(tx_1.get('_id'))
+        self.assertIsNone(block.get('_id'))
+
+    def test_store_block_not_bulk_stores_txs_and_block(self):
+        self.db.bulk = False
+
+        tx_1 = {
+            'hash': 'something1',
+            'key': '1'
+        }
+
+        tx_2 = {
+            'hash': 'something2',
+            'key': '2'
+        }
+
+        block = {
+            'hash': 'hello',
+            'number': 1,
+            'subblocks': [
+                {
+                    'transactions': [tx_1, tx_2]
+                }
+            ]
+        }
+
+        self.db.store_block(block)
+
+        self.assertDictEqual(tx_1, self.db.get_tx(h='something1'))
+        self.assertDictEqual(tx_2, self.db.get_tx(h='something2'))
+        self.assertDictEqual(block, self.db.get_block('hello'))
+
+    def test_store_block_batch_stores_txs_and_block(self):
+        self.db.batch = True
+
+        tx_1 = {
+            'hash': 'something1',
+            'key': '1'
+        }
+
+        block = {
+            'hash': 'hello',
+            'number': 1,
+            'subblocks': [
+                {
+                    'transactions': [tx_1]
+                }
+            ]
+        }
+
+        self.db.store_block(block)
+
+        self.assertDictEqual(tx_1, self.db.get_tx(h='something1'))
+        self.assertDictEqual(block, self.db.get_block('hello'))
+
+
+class TestAsyncBlockStorage(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.db = BlockStorage()
+        self.async_db = storage.AsyncBlockStorage(self.db)
+
+    def tearDown(self):
+        self.db.drop_collections()
+        self.loop.close()
+
+    def test_get_block_returns_stored_block(self):
+        block = {
+            'hash': 'a',
+            'number': 1,
+            'data': 'woop'
+        }
+
+        self.db.put(block)
+
+        got_block = self.loop.run_until_complete(self.async_db.get_block(1))
+
+        self.assertEqual(block, got_block)
+
+    def test_get_block_waits_for_deferred_store(self):
+        block = {
+            'hash': 'a',
+            'number': 1,
+            'subblocks': [
+                {
+                    'transactions': [{'hash': 'something1', 'key': '1'}]
+                }
+            ]
+        }
+
+        self.async_db.store_block_nowait(block)
+
+        got_block = self.loop.run_until_complete(self.async_db.get_block(1))
+        got_tx = self.loop.run_until_complete(self.async_db.get_tx('something1'))
+
+        self.assertEqual(block, got_block)
+        self.assertEqual({'hash': 'something1', 'key': '1'}, got_tx)
+
+    def test_store_block_raises_when_write_fails(self):
+        class FailingBlocks:
+            def store_block(self, block):
+                raise storage.OperationFailure('disk full')
+
+        async_db = storage.AsyncBlockStorage(FailingBlocks())
+
+        with self.assertRaises(storage.OperationFailure):
+            self.loop.run_until_complete(async_db.store_block({'hash': 'a', 'number': 1}))
+
+    def test_get_last_n_returns_blocks_descending(self):
+        for i in range(1, 4):
+            self.db.put({'hash': str(i), 'number': i})
+
+        got_blocks = self.loop.run_until_complete(self.async_db.get_last_n(2))
+
+        self.assertEqual([b['number'] for b in got_blocks], [3, 2])
+
+    def test_cached_nonces_read_inline(self):
+        nonces = storage.CachedNonceStorage()
+        nonces.set_pending_nonce(sender='test', processor='test2', value=5)
+
+        async_nonces = storage.AsyncNonceStorage(nonces)
+
+        n = self.loop.run_until_complete(async_nonces.get_latest_nonce(sender='test', processor='test2'))
+
+        self.assertEqual(n, 5)
+
+        nonces.flush()
@@ -0,0 +1,182 @@
+from unittest import TestCase
+
+from contracting.db.encoder import encode, decode
+from contracting.stdlib.bridge.decimal import ContractingDecimal
+from contracting.stdlib.bridge.time import Datetime, Timedelta
+
+from lamden import wire
+
+
+class TestWire(TestCase):
+    def setUp(self):
+        self.msg = {
+            'service': 'new_blocks',
+            'msg': {
+                'hash': 'a' * 64,
+                'number': 123,
+                'amount': ContractingDecimal('100.12345'),
+                'when': Datetime(2021, 1, 2, 3, 4, 5),
+                'how_long': Timedelta(days=1, seconds=10),
+                'raw': b'\x00\x01\x02',
+                'big': 2 ** 80,
+                'list': [1, 'two', None, True, 1.5],
+                'nested': [{'a': {'b': ContractingDecimal('0.1')}}]
+            }
+        }
+
+    def test_json_is_unchanged(self):
+        self.assertEqual(wire.pack(self.msg), encode(self.msg).encode())
+
+    def test_binary_starts_with_version_byte(self):
+        self.assertEqual(wire.pack(self.msg, wire.BINARY)[0], wire.BINARY)
+
+    def test_binary_round_trips_like_json(self):
+        msg, codec = wire.unpack(wire.pack(self.msg, wire.BINARY))
+
+        self.assertEqual(codec, wire.BINARY)
+        self.assertEqual(encode(msg), encode(decode(encode(self.msg))))
+
+    def test_binary_keeps_types(self):
+        msg, _ = wire.unpack(wire.pack(self.msg, wire.BINARY))
+
+        self.assertIsInstance(msg['msg']['amount'], ContractingDecimal)
+        self.assertIsInstance(msg['msg']['when'], Datetime)
+        self.assertIsInstance(msg['msg']['how_long'], Timedelta)
+        self.assertEqual(msg['msg']['raw'], b'\x00\x01\x02')
+        self.assertEqual(msg['msg']['big'], 2 ** 80)
+
+    def test_binary_map_keys_are_strings_like_json(self):
+        msg = {'a': {1: 'one', 2.5: 'half', None: 'none', False: 'no'}}
+
+        binary, _ = wire.unpack(wire.pack(msg, wire.BINARY))
+        streamed, _ = wire.unpack_frames(wire.pack_frames(msg, wire.STREAMED))
+        text, _ = wire.unpack(wire.pack(msg))
+
+        self.assertEqual(binary, text)
+        self.assertEqual(streamed, text)
+
+    def test_unpack_json_payload(self):
+        msg, codec = wire.unpack(wire.pack(self.msg))
+
+        self.assertEqual(codec, wire.JSON)
+        self.assertEqual(encode(msg), encode(decode(encode(self.msg))))
+
+    def test_encoded_values_are_decoded_as_objects(self):
+        stored = {'amount': {'__fixed__': '1.5'}}
+
+        msg, _ = wire.unpack(wire.pack(stored, wire.BINARY))
+        json_msg, _ = wire.unpack(wire.pack(stored))
+
+        self.assertEqual(msg, json_msg)
+
+    def test_binary_is_smaller(self):
+        self.assertLess(len(wire.pack(self.msg, wire.BINARY)), len(wire.pack(self.msg)))
+
+    def test_large_binary_frames_are_compressed(self):
+        msg = {'txs': [{'sender': 'a' * 64, 'signature': 'b' * 128} for _ in range(100)]}
+
+        payload = wire.pack(msg, wire.BINARY, compress_threshold=1024)
+
+        self.assertTrue(payload[0] & wire.COMPRESSED)
+        self.assertLess(len(payload), len(wire.pack(msg, wire.BINARY)))
+
+        unpacked, codec = wire.unpack(payload)
+
+        self.assertEqual(codec, wire.BINARY)
+        self.assertEqual(unpacked, msg)
+
+    def test_small_frames_are_not_compressed(self):
+        payload = wire.pack({'a': 1}, wire.BINARY, compress_threshold=1024)
+
+        self.assertFalse(payload[0] & wire.COMPRESSED)
+
+    def test_json_frames_are_never_compressed(self):
+        msg = {'txs': ['a' * 64] * 100}
+
+        self.assertEqual(wire.pack(msg, wire.JSON, compress_threshold=1), encode(msg).encode())
+
+    def test_corrupt_compressed_frame_raises(self):
+        payload = bytes([wire.BINARY | wire.COMPRESSED]) + b'not zlib'
+
+        with self.assertRaises(wire.WireException):
+            wire.unpack(payload)
+
+    def test_unknown_version_raises(self):
+        with self.assertRaises(wire.WireException):
+            wire.unpack(b'\x10abc')
+
+    def test_version_byte_without_binary_raises(self):
+        with self.assertRaises(wire.WireException):
+            wire.unpack(b'\x00{}')
+
+    def test_corrupt_binary_frame_raises(self):
+        for payload in (b'\x01\xc1', b'\x01\x92\x01'):
+            with self.assertRaises(wire.WireException):
+                wire.unpack(payload)
+
+    def test_corrupt_json_frame_raises(self):
+        with self.assertRaises(wire.WireException):
+            wire.unpack(b'{"a": ')
+
+    def block(self, txs):
+        return {
+            'number': 1,
+            'hash': 'a' * 64,
+            'subblocks': [
+                {
+                    'transactions': [
+                        {'hash': str(i), 'stamps_used': i, 'amount': ContractingDecimal('1.5')} for i in range(txs)
+                    ],
+                    'signatures': []
+                }
+            ]
+        }
+
+    def test_large_message_is_streamed_in_chunks(self):
+        msg = {'service': 'new_blocks', 'msg': self.block(20_000)}
+
+        frames = list(wire.pack_frames(msg, wire.STREAMED))
+
+        self.assertGreater(len(frames), 1)
+        for frame in frames:
+            self.assertEqual(frame[0] & ~wire.COMPRESSED, wire.STREAMED)
+            self.assertLess(len(frame), wire.STREAM_CHUNK_SIZE * 2)
+
+        unpacked, codec = wire.unpack_frames(frames)
+
+        self.assertEqual(codec, wire.STREAMED)
+        self.assertEqual(encode(unpacked), encode(msg))
+
+    def test_stream_keeps_types_and_encoded_values(self):
+        msg = dict(self.msg)
+        msg['stored'] = {'amount': {'__fixed__': '1.5'}}
+
+        unpacked, _ = wire.unpack_frames(wire.pack_frames(msg, wire.STREAMED))
+
+        self.assertIsInstance(unpacked['msg']['amount'], ContractingDecimal)
+        self.assertIsInstance(unpacked['msg']['nested'][0]['a']['b'], ContractingDecimal)
+        self.assertIsInstance(unpacked['stored']['amount'], ContractingDecimal)
+        self.assertEqual(unpacked['msg']['raw'], b'\x00\x01\x02')
+
+    def test_compressed_stream_round_trips(self):
+        msg = self.block(5_000)
+
+        frames = list(wire.pack_frames(msg, wire.STREAMED, compress_threshold=1024))
+
+        self.assertTrue(frames[0][0] & wire.COMPRESSED)
+        self.assertEqual(encode(wire.unpack_frames(frames)[0]), encode(msg))
+
+    def test_truncated_stream_raises(self):
+        frames = list(wire.pack_frames(self.block(20_000), wire.STREAMED))
+
+        with self.assertRaises(wire.WireException):
+            wire.unpack_frames(frames[:-1])
+
+    def test_stream_frames_are_made_as_they_are_sent(self):
+        frames = wire.pack_frames(self.block(20_000), wire.STREAMED)
+
+        self.assertEqual(next(frames)[0] & ~wire.COMPRESSED, wire.STREAMED)
+
+    def test_only_streams_span_frames(self):
+        with self.assertRaises(wire.WireException):
+            wire.unpack_frames([wire.pack({'a': 1}, wire.BINARY), wire.pack({'b': 2}, wire.BINARY)])